@@ -23,8 +23,12 @@ _backy2_completions() {
         _backy2_versions
     elif [[ "${COMP_WORDS[1]}" == "rm" ]]; then
         _backy2_versions
+    elif [[ "${COMP_WORDS[1]}" == "clone" ]]; then
+        _backy2_versions
     elif [[ "${COMP_WORDS[1]}" == "scrub" ]]; then
         _backy2_versions
+    elif [[ "${COMP_WORDS[1]}" == "verify-target" ]]; then
+        _backy2_versions
     elif [[ "${COMP_WORDS[1]}" == "export" ]]; then
         _backy2_versions
     elif [[ "${COMP_WORDS[1]}" == "du" ]]; then
@@ -37,6 +41,8 @@ _backy2_completions() {
         _backy2_versions
     elif [[ "${COMP_WORDS[1]}" == "expire" ]]; then
         _backy2_versions
+    elif [[ "${COMP_WORDS[1]}" == "prune" ]]; then
+        _backy2_names
     elif [[ "${COMP_WORDS[1]}" == "due" ]]; then
         _backy2_names
     elif [[ "${COMP_WORDS[1]}" == "sla" ]]; then
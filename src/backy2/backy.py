@@ -1,22 +1,31 @@
 # -*- encoding: utf-8 -*-
 
 from backy2 import notify
+from backy2.blockreader import BlobCache, BlockReader, VersionBlocks
+from backy2.checkpoint import Checkpoint
 from backy2.crypt import get_crypt
 from backy2.logging import logger
 from backy2.locking import Locking
+from backy2.locking import LockError
 from backy2.locking import find_other_procs
+from backy2.sketch import estimate_space
 from backy2.utils import grouper
 from backy2.utils import status
 from backy2.utils import MinSequential
+from backy2.utils import TokenBucket
+from backy2.utils import humanize
 from backy2.utils import chunks
+from backy2.utils import parse_size
 from dateutil.relativedelta import relativedelta
 from urllib import parse
 import binascii
 import datetime
 import importlib
 import math
+import os
 import queue
 import random
+import threading
 import time
 import sys
 
@@ -32,11 +41,30 @@ def blocks_from_hints(hints, block_size):
     return blocks
 
 
-class LockError(Exception):
-    def __init__(self, value):
-        self.value = value
-    def __str__(self):
-        return repr(self.value)
+def blocks_from_ranges(ranges, block_size, size, pack=False):
+    """ Helper method
+    ranges must be tuples of (offset, length). Returns a dict of
+    block_id: [(block_offset, length, target_offset), ...] with the parts of
+    each block that are covered by the ranges.
+    If pack is True, the ranges are placed one after another in the target,
+    otherwise each range keeps its offset.
+    """
+    segments = {}
+    target_offset = 0
+    for offset, length in ranges:
+        if offset < 0 or length <= 0 or offset + length > size:
+            raise ValueError('Range {}:{} is outside of the version (size is {}).'.format(offset, length, size))
+        if not pack:
+            target_offset = offset
+        end = offset + length
+        while offset < end:
+            block_id = offset // block_size
+            block_offset = offset % block_size
+            _length = min(block_size - block_offset, end - offset)
+            segments.setdefault(block_id, []).append((block_offset, _length, target_offset))
+            offset += _length
+            target_offset += _length
+    return segments
 
 
 class Backy():
@@ -70,22 +98,60 @@ class Backy():
         self.locking.unlock('backy')
 
 
-    def ls(self):
-        versions = self.meta_backend.get_versions()
+    def ls(self, name=None, snapshot_name=None, tag=None, expired=False, valid=None):
+        versions = self.meta_backend.get_versions(name, snapshot_name, tag, expired, valid)
         return versions
 
 
     def ls_version(self, version_uid):
         # don't lock here, this is not really error-prone.
-        blocks = self.meta_backend.get_blocks_by_version(version_uid).all()
+        blocks = list(self.meta_backend.get_blocks_by_version(version_uid))
         return blocks
 
 
+    def get_block_map(self, version_uid):
+        """ Returns the blob ids of all blocks of a version, indexed by
+        block id. """
+        return self.meta_backend.get_block_map(version_uid)
+
+
     def stats(self, version_uid=None, limit=None):
         stats = self.meta_backend.get_stats(version_uid, limit)
         return stats
 
 
+    def _checkpoint(self, operation, key, size):
+        config_DEFAULTS = self.config(section='DEFAULTS')
+        path = config_DEFAULTS.get('checkpoint_dir', config_DEFAULTS.get('cachedir', '/tmp'))
+        interval = config_DEFAULTS.getint('checkpoint_interval', 10)
+        return Checkpoint(path, operation, key, size, interval)
+
+
+    def _check_restored(self, version_uid, targets, continue_from, num_blocks=16):
+        """ Compares a random sample of the blocks an interrupted restore has
+        written (block ids below continue_from) with the targets. Returns the
+        targets which differ. """
+        blocks = [block for block in self.meta_backend.get_blocks_by_version_deref(version_uid)
+            if block.id < continue_from and block.uid]
+        blocks = {block.id: block for block in random.sample(blocks, min(num_blocks, len(blocks)))}
+        changed_targets = []
+        for target in targets:
+            io = self.get_io_by_source(target)
+            io.open_r(target)
+            for block_id in blocks:
+                io.read(block_id)
+            for i in range(len(blocks)):
+                block_id, data, data_checksum, metadata = io.get()
+                block = blocks[block_id]
+                if len(data) > block.size:
+                    data_checksum = self.hash_function(data[:block.size]).hexdigest()
+                if data_checksum != block.checksum:
+                    logger.debug('Block {} of {} differs.'.format(block_id, target))
+                    changed_targets.append(target)
+            io.close()
+        return sorted(set(changed_targets), key=targets.index)
+
+
     def get_io_by_source(self, source):
         res = parse.urlparse(source)
         if res.params or res.query or res.fragment:
@@ -113,10 +179,29 @@ class Backy():
         return self.meta_backend.du(version_uid)
 
 
-    def scrub(self, version_uid, source=None, percentile=100):
+    def du_approx(self, groups):
+        """ Returns estimated disk usage statistics for groups of versions.
+        groups is a dict name: list of version_uids. The estimate is based
+        on per-version sketches of the blobs and so doesn't need to look
+        at every block of the versions. See backy2.sketch.estimate_space.
+        """
+        sketches = self.meta_backend.get_version_sketches([v.uid for v in self.ls()])
+        return estimate_space(sketches, groups)
+
+
+    def scrub(self, version_uid, source=None, percentile=100, mode='full'):
         """ Returns a boolean (state). If False, there were errors, if True
-        all was ok
+        all was ok.
+        mode 'full' reads and checks all blobs, mode 'crypto' reads all blobs
+        but only checks the authentication tag of encrypted blobs instead of
+        decompressing and hashing them and mode 'light' only compares the
+        blobs' sizes and etags as listed by the data backend with the ones
+        recorded when they have been written.
         """
+        if mode not in ('full', 'crypto', 'light'):
+            raise ValueError('Unknown scrub mode: {}'.format(mode))
+        if mode != 'full' and source:
+            raise ValueError('A {} scrub cannot compare to the source.'.format(mode))
         if not self.locking.lock(version_uid):
             raise LockError('Version {} is locked.'.format(version_uid))
         self.locking.unlock(version_uid)  # No need to keep it locked.
@@ -129,14 +214,17 @@ class Backy():
             }
 
         version = self.meta_backend.get_version(version_uid)  # raise if version not exists
-        blocks = self.meta_backend.get_blocks_by_version(version_uid)
 
         # check if the backup is at least complete
-        if blocks.count() != version.size:
+        if self.meta_backend.get_num_blocks_by_version(version_uid) != version.size:
             logger.error("Version is incomplete.")
             self.meta_backend.set_version_invalid(version_uid)
             return
 
+        blocks = self.meta_backend.get_blocks_by_version_deref(version_uid)
+        if mode == 'light':
+            return self._scrub_light(version_uid, blocks, percentile)
+
         if source:
             io = self.get_io_by_source(source)
             io.open_r(source)
@@ -146,7 +234,8 @@ class Backy():
         notify(self.process_name, 'Preparing Scrub of version {}'.format(version_uid))
         # prepare
         read_jobs = 0
-        for block in blocks.yield_per(1000):
+        blob_uids = set()
+        for block in blocks:
             if block.uid:
                 if percentile < 100 and random.randint(1, 100) > percentile:
                     logger.debug('Scrub of block {} (UID {}) skipped (percentile is {}).'.format(
@@ -155,7 +244,11 @@ class Backy():
                         percentile,
                         ))
                 else:
-                    self.data_backend.read(block.deref())  # async queue
+                    self.data_backend.read(block)  # async queue
+                    if source:
+                        io.read(block.id)  # async queue
+                    if mode == 'crypto':
+                        blob_uids.add(block.uid)
                     read_jobs += 1
             else:
                 logger.debug('Scrub of block {} (UID {}) skipped (sparse).'.format(
@@ -163,6 +256,55 @@ class Backy():
                     block.uid,
                     ))
 
+        # Source and backend reads finish in any order, so their checksums
+        # are matched up by block id.
+        source_checksums = {}  # block_id: (checksum, length) from the source
+        backend_checksums = {}  # block_id: (block, checksum) from the backend, checksum None if broken
+        source_results = 0
+
+        # stored sizes of the blobs for the crypto mode
+        blob_sizes = self.meta_backend.get_blobs(blob_uids)
+
+        def _compare_source(block_id):
+            nonlocal state
+            if block_id not in source_checksums or block_id not in backend_checksums:
+                return
+            source_checksum, source_length = source_checksums.pop(block_id)
+            block, data_checksum = backend_checksums.pop(block_id)
+            stats['source_blocks_read'] += 1
+            stats['source_bytes_read'] += source_length
+            if data_checksum is not None and source_checksum != data_checksum:
+                logger.error('Source data has changed for block {} '
+                    '(UID {}) (is: {} should-be: {}). NOT setting '
+                    'this block invalid, because the source looks '
+                    'wrong.'.format(
+                        block.id,
+                        block.uid,
+                        source_checksum,
+                        data_checksum,
+                        ))
+                state = False
+                # We are not setting the block invalid here because
+                # when the block is there AND the checksum is good,
+                # then the source is invalid.
+
+        def _backend_done(block, data_checksum):
+            if source:
+                backend_checksums[block.id] = (block, data_checksum)
+                _compare_source(block.id)
+
+        def _get_source(block=False):
+            """ Matches finished source reads. With block, waits for all. """
+            nonlocal source_results
+            while source and source_results < read_jobs:
+                try:
+                    block_id, source_data, source_checksum, metadata = io.get(block=block)
+                except queue.Empty:
+                    break
+                source_results += 1
+                source_checksums[block_id] = (source_checksum, len(source_data))
+                _compare_source(block_id)
+
         # and read
         _log_every_jobs = read_jobs // 200 + 1  # about every half percent
         _log_jobs_counter = 0
@@ -173,8 +315,9 @@ class Backy():
             try:
                 while True:
                     try:
-                        block, offset, length, data = self.data_backend.read_get(timeout=1)
+                        block, offset, length, data = self.data_backend.read_get(timeout=1, decrypt=mode != 'crypto')
                     except queue.Empty:  # timeout occured
+                        _get_source()
                         continue
                     except FileNotFoundError as e:
                         logger.error("Exception during reading from the data backend: {}".format(str(e.args[0])))
@@ -190,70 +333,86 @@ class Backy():
                 raise  # use if you want to debug.
                 # exit with error
                 sys.exit(6)
+            _get_source()
             if data is None:
                 logger.error('Blob not found: {}'.format(str(block)))
                 self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+                _backend_done(block, None)
                 state = False
                 continue
+            authentic = None
+            if mode == 'crypto':
+                authentic = self.data_backend.verify(block, data)
+                if authentic is None:
+                    # not encrypted, so this needs the checksum
+                    data = self.data_backend.decrypt(block, data)
             stats['blocks_read'] += 1
             stats['bytes_read'] += len(data)
-            if len(data) != block.size:
-                logger.error('Blob has wrong size: {} is: {} should be: {}'.format(
-                    block.uid,
-                    len(data),
-                    block.size,
-                    ))
-                self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
-                state = False
-                continue
-            data_checksum = self.hash_function(data).hexdigest()
-            if data_checksum != block.checksum:
-                logger.error('Checksum mismatch during scrub for block '
-                    '{} (UID {}) (is: {} should-be: {}).'.format(
-                        block.id,
+            if authentic is not None:
+                blob_size = blob_sizes.get(block.uid, (None, None))[0]
+                if blob_size is not None and len(data) != blob_size:
+                    logger.error('Blob has wrong size: {} is: {} should be: {}'.format(
                         block.uid,
-                        data_checksum,
-                        block.checksum,
+                        len(data),
+                        blob_size,
                         ))
-                self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
-                state = False
-                continue
-
-            if source:
-                source_data = io.read(block.id, sync=True)  # TODO: This is still sync, but how could we do better (easily)?
-                stats['source_blocks_read'] += 1
-                stats['source_bytes_read'] += len(source_data)
-                if source_data != data:
-                    logger.error('Source data has changed for block {} '
-                        '(UID {}) (is: {} should-be: {}). NOT setting '
-                        'this block invalid, because the source looks '
-                        'wrong.'.format(
+                    self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+                    _backend_done(block, None)
+                    state = False
+                    continue
+                if not authentic:
+                    logger.error('Authentication failed during scrub for block '
+                        '{} (UID {}).'.format(
+                            block.id,
+                            block.uid,
+                            ))
+                    self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+                    _backend_done(block, None)
+                    state = False
+                    continue
+                data_checksum = block.checksum
+            else:
+                if len(data) != block.size:
+                    logger.error('Blob has wrong size: {} is: {} should be: {}'.format(
+                        block.uid,
+                        len(data),
+                        block.size,
+                        ))
+                    self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+                    _backend_done(block, None)
+                    state = False
+                    continue
+                data_checksum = self.hash_function(data).hexdigest()
+                if data_checksum != block.checksum:
+                    logger.error('Checksum mismatch during scrub for block '
+                        '{} (UID {}) (is: {} should-be: {}).'.format(
                             block.id,
                             block.uid,
-                            self.hash_function(source_data).hexdigest(),
                             data_checksum,
+                            block.checksum,
                             ))
+                    self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+                    _backend_done(block, None)
                     state = False
-                    # We are not setting the block invalid here because
-                    # when the block is there AND the checksum is good,
-                    # then the source is invalid.
+                    continue
+
+            _backend_done(block, data_checksum)
             logger.debug('Scrub of block {} (UID {}) ok.'.format(
                 block.id,
                 block.uid,
                 ))
 
             if time.time() - t_last_run >= 1:
-                # TODO: Log source io status
                 t_last_run = time.time()
                 t2 = time.time()
                 dt = t2-t1
-                logger.debug(self.data_backend.thread_status())
+                logger.debug(self.data_backend.thread_status() + (" " + io.thread_status() if source else ""))
 
                 db_queue_status = self.data_backend.queue_status()
                 _status = status(
                     'Scrubbing {} ({})'.format(version.name, version_uid),
                     db_queue_status['rq_filled']*100,
-                    0,
+                    io.queue_status()['rq_filled']*100 if source else 0,
                     (i + 1) / read_jobs * 100,
                     stats['bytes_read'] / dt,
                     round(read_jobs / (i+1) * dt - dt),
@@ -263,6 +422,9 @@ class Backy():
                     _log_jobs_counter = _log_every_jobs
                     logger.info(_status)
 
+        # wait for the remaining source reads
+        _get_source(block=True)
+
         if state == True:
             self.meta_backend.set_version_valid(version_uid)
             logger.info('Marked version valid: {}'.format(version_uid))
@@ -276,7 +438,291 @@ class Backy():
         return state
 
 
-    def restore(self, version_uid, target, sparse=False, force=False, continue_from=0):
+    def _scrub_light(self, version_uid, blocks, percentile=100):
+        """ Checks that all blobs of a version exist in the data backend with
+        the size and etag which have been recorded when they were written.
+        No blob data is transferred.
+        """
+        notify(self.process_name, 'Light scrub of version {}'.format(version_uid))
+        checksums = {}  # blob uid: checksum
+        for block in blocks:
+            if block.uid and (percentile == 100 or random.randint(1, 100) <= percentile):
+                checksums[block.uid] = block.checksum
+
+        recorded = self.meta_backend.get_blobs(checksums.keys())
+        found = self.data_backend.stat_many(checksums.keys())
+
+        state = True
+        unverified = 0
+        for uid, checksum in checksums.items():
+            if uid not in found:
+                logger.error('Blob not found: {}'.format(uid))
+            elif recorded.get(uid, (None, None))[0] is None or found[uid][0] is None:
+                unverified += 1  # written before sizes were recorded or unknown to the backend
+                continue
+            elif found[uid][0] != recorded[uid][0]:
+                logger.error('Blob {} has the wrong size (is: {} should-be: {})'.format(uid, found[uid][0], recorded[uid][0]))
+            elif found[uid][1] and recorded[uid][1] and found[uid][1] != recorded[uid][1]:
+                logger.error('Blob {} has the wrong etag (is: {} should-be: {})'.format(uid, found[uid][1], recorded[uid][1]))
+            else:
+                continue
+            self.meta_backend.set_blocks_invalid(uid, checksum)
+            state = False
+
+        logger.info('Light scrub checked {} blobs ({} without recorded size, only checked for existence).'.format(
+            len(checksums),
+            unverified,
+            ))
+        # A light scrub doesn't read the data, so it never marks an invalid
+        # version valid again.
+        if state == False:
+            # version is set invalid by set_blocks_invalid.
+            logger.error('Marked version invalid because it has errors: {}'.format(version_uid))
+        notify(self.process_name)
+        return state
+
+
+    def scrub_all(self, max_age=None, rate=0):
+        """ Scrubs all versions but reads each blob only once, no matter how
+        many versions reference it. Only blobs which have not been scrubbed
+        within max_age (a timedelta, None means all blobs) are read, at most
+        rate blobs per second (0 means unlimited).
+        Versions are then marked valid or invalid from the recorded blob
+        results. Returns a boolean (state). If False, there were errors.
+        """
+        version_uids = []
+        locked_version_uids = []
+        for version in self.meta_backend.get_versions():
+            if not self.locking.lock(version.uid):
+                logger.info('Skipping locked version {}.'.format(version.uid))
+                locked_version_uids.append(version.uid)
+                continue
+            self.locking.unlock(version.uid)  # No need to keep it locked.
+            version_uids.append(version.uid)
+
+        older_than = datetime.datetime.utcnow()
+        if max_age is not None:
+            older_than -= max_age
+        throttling = TokenBucket()
+        throttling.set_rate(rate)  # 0 disables throttling
+
+        stats = {
+                'bytes_read': 0,
+                'blocks_read': 0,
+            }
+        state = True
+
+        def _check(block, data):
+            nonlocal state
+            if data is None:
+                logger.error('Blob not found: {}'.format(str(block)))
+            elif len(data) != block.size:
+                logger.error('Blob has wrong size: {} is: {} should be: {}'.format(
+                    block.uid,
+                    len(data),
+                    block.size,
+                    ))
+            elif self.hash_function(data).hexdigest() != block.checksum:
+                logger.error('Checksum mismatch during scrub for blob '
+                    '{} (is: {} should-be: {}).'.format(
+                        block.uid,
+                        self.hash_function(data).hexdigest(),
+                        block.checksum,
+                        ))
+            else:
+                stats['blocks_read'] += 1
+                stats['bytes_read'] += len(data)
+                logger.debug('Scrub of blob {} ok.'.format(block.uid))
+                self.meta_backend.set_blob_scrubbed(block.uid, True, _commit=False)
+                return
+            self.meta_backend.set_blob_scrubbed(block.uid, False, _commit=False)
+            self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
+            state = False
+
+        def _read_get(timeout):
+            try:
+                block, offset, length, data = self.data_backend.read_get(timeout=timeout)
+            except FileNotFoundError as e:
+                logger.error("Exception during reading from the data backend: {}".format(str(e.args[0])))
+                if len(e.args) < 2:
+                    raise
+                block, data = e.args[1], None
+            _check(block, data)
+
+        notify(self.process_name, 'Scrubbing all versions')
+        t1 = time.time()
+        t_last_run = 0
+        read_jobs = 0
+        in_flight = 0
+        for block in self.meta_backend.get_scrub_candidates(older_than, locked_version_uids):
+            time.sleep(throttling.consume(1))
+            self.data_backend.read(block)  # async queue
+            read_jobs += 1
+            in_flight += 1
+            # keep the read queue short and process what's there
+            while in_flight:
+                try:
+                    _read_get(timeout=1 if in_flight > 100 else 0)
+                except queue.Empty:
+                    if in_flight <= 100:
+                        break
+                else:
+                    in_flight -= 1
+
+            if time.time() - t_last_run >= 1:
+                t_last_run = time.time()
+                dt = t_last_run - t1
+                self.meta_backend._commit()
+                _status = 'Scrubbing all versions: {} blobs ({}) read, {:.1f}MB/s'.format(
+                    stats['blocks_read'],
+                    humanize(stats['bytes_read']),
+                    stats['bytes_read'] / dt / 1024 / 1024,
+                    )
+                notify(self.process_name, _status)
+                logger.info(_status)
+
+        while in_flight:
+            try:
+                _read_get(timeout=1)
+            except queue.Empty:
+                continue
+            in_flight -= 1
+        self.meta_backend._commit()
+        logger.info('Scrubbed {} blobs ({} ok).'.format(read_jobs, stats['blocks_read']))
+
+        # Mark versions from the recorded blob results
+        for version_uid, (invalid_blobs, unscrubbed_blobs) in self.meta_backend.get_versions_scrub_state(version_uids).items():
+            version = self.meta_backend.get_version(version_uid)
+            if invalid_blobs:
+                state = False
+                if version.valid:
+                    self.meta_backend.set_version_invalid(version_uid)
+                logger.error('Version {} has {} invalid blobs.'.format(version_uid, invalid_blobs))
+            elif unscrubbed_blobs:
+                logger.info('Version {} has {} blobs which have never been scrubbed. Not changing its state.'.format(version_uid, unscrubbed_blobs))
+            elif not version.valid:
+                if self.meta_backend.get_num_blocks_by_version(version_uid) != version.size:
+                    logger.info('Version {} is incomplete. Not changing its state.'.format(version_uid))
+                else:
+                    self.meta_backend.set_version_valid(version_uid)
+                    logger.info('Marked version valid: {}'.format(version_uid))
+
+        notify(self.process_name)
+        return state
+
+
+    def verify_target(self, version_uid, target):
+        """ Compares a target (e.g. a restored image) with the checksums of a
+        version without reading anything from the data backend.
+        Returns a list of (offset, length) byte ranges in which the target
+        differs, i.e. an empty list if it matches the version.
+        """
+        if not self.locking.lock(version_uid):
+            raise LockError('Version {} is locked.'.format(version_uid))
+        self.locking.unlock(version_uid)  # No need to keep it locked.
+
+        version = self.meta_backend.get_version(version_uid)  # raise if version not exists
+        if self.meta_backend.get_num_blocks_by_version(version_uid) != version.size:
+            raise ValueError('Version {} is incomplete.'.format(version_uid))
+        blocks = self.meta_backend.get_blocks_by_version_deref(version_uid)
+
+        io = self.get_io_by_source(target)
+        io.open_r(target)
+        target_size = io.size()
+        if target_size < version.size_bytes:
+            logger.error('Target {} is smaller than version {} ({} < {} bytes).'.format(
+                target,
+                version_uid,
+                target_size,
+                version.size_bytes,
+                ))
+
+        notify(self.process_name, 'Preparing verification of {} against version {}'.format(target, version_uid))
+        expected = {}  # block_id: (checksum, size)
+        zero_checksums = {}  # size: checksum of a sparse block
+        differing_block_ids = []
+        read_jobs = 0
+        for block in blocks:
+            checksum = block.checksum
+            if not block.uid:
+                if block.size not in zero_checksums:
+                    zero_checksums[block.size] = self.hash_function(b'\0' * block.size).hexdigest()
+                checksum = zero_checksums[block.size]
+            if block.id * self.block_size >= target_size:
+                differing_block_ids.append(block.id)  # beyond the end of the target
+                continue
+            expected[block.id] = (checksum, block.size)
+            io.read(block.id)  # async queue, the io's readers hash in parallel
+            read_jobs += 1
+
+        bytes_read = 0
+        t1 = time.time()
+        t_last_run = 0
+        for i in range(read_jobs):
+            block_id, data, data_checksum, metadata = io.get()
+            checksum, size = expected.pop(block_id)
+            bytes_read += len(data)
+            if len(data) > size:
+                # the target is larger than the version
+                data_checksum = self.hash_function(data[:size]).hexdigest()
+            if data_checksum != checksum:
+                logger.debug('Block {} differs (is: {} should-be: {}).'.format(block_id, data_checksum, checksum))
+                differing_block_ids.append(block_id)
+
+            if time.time() - t_last_run >= 1:
+                t_last_run = time.time()
+                dt = t_last_run - t1
+                _status = status(
+                    'Verifying {} against {} ({})'.format(target, version.name, version_uid),
+                    io.queue_status()['rq_filled']*100,
+                    0,
+                    (i + 1) / read_jobs * 100,
+                    bytes_read / dt,
+                    round(read_jobs / (i+1) * dt - dt),
+                    )
+                notify(self.process_name, _status)
+                logger.debug(_status)
+        io.close()
+
+        # merge adjacent blocks into byte ranges
+        block_ranges = []  # [first_block_id, last_block_id + 1]
+        for block_id in sorted(differing_block_ids):
+            if block_ranges and block_ranges[-1][1] == block_id:
+                block_ranges[-1][1] = block_id + 1
+            else:
+                block_ranges.append([block_id, block_id + 1])
+        ranges = [(
+            start * self.block_size,
+            min(end * self.block_size, version.size_bytes) - start * self.block_size,
+            ) for start, end in block_ranges]
+
+        if ranges:
+            logger.error('Target {} differs from version {} in {} blocks ({} ranges).'.format(
+                target,
+                version_uid,
+                len(differing_block_ids),
+                len(ranges),
+                ))
+        else:
+            logger.info('Target {} matches version {}.'.format(target, version_uid))
+        notify(self.process_name)
+        return ranges
+
+
+    def restore(self, version_uid, target, sparse=False, force=False, continue_from=0, ranges=None, pack=False, resume=False):
+        """ Restore a version to target.
+        target may also be a list of targets. Then each block is read and
+        decrypted once and written to all targets.
+        If ranges are given, they must be tuples of (offset, length). Then
+        only the blocks covering these ranges are read and only these bytes
+        are written, either to the same offsets in the target or, if pack is
+        True, one after another from the start of the target.
+        An interrupted restore is continued when it is started again with
+        the same arguments and resume=True, if its targets still exist with
+        the same sizes. Unless ranges are given, a sample of the restored
+        blocks is compared with the targets, too. Beyond that, the targets are
+        trusted not to have been changed in between.
+        """
         # See if the version is locked, i.e. currently in backup
         if not self.locking.lock(version_uid):
             raise LockError('Version {} is locked.'.format(version_uid))
@@ -294,41 +740,114 @@ class Backy():
             }
 
         version = self.meta_backend.get_version(version_uid)  # raise if version does not exist
+        if ranges:
+            segments = blocks_from_ranges(ranges, self.block_size, version.size_bytes, pack)
+            target_size = sum([r[1] for r in ranges]) if pack else version.size_bytes
+        else:
+            segments = None
+            target_size = version.size_bytes
+
+        def _writes(block, data):
+            """ Returns a list of (data, offset) to be written for a block.
+            offset None means the block's own position.
+            """
+            if segments is None:
+                return [(data, None)]
+            return [(data[block_offset:block_offset+length], target_offset)
+                    for block_offset, length, target_offset in segments[block.id]]
+
+        targets = [target] if isinstance(target, str) else list(target)
+        checkpoint = self._checkpoint('restore', '{} {} {} {}'.format(version_uid, ' '.join(targets), ranges, pack), version.size)
+        state, _ = checkpoint.load()
+        ios = [self.get_io_by_source(_target) for _target in targets]
+        if state is not None and not resume:
+            logger.warning('Found an interrupted restore of version {}. Restoring from the start, use --resume to continue it instead.'.format(version_uid))
+            checkpoint.remove()
+            checkpoint = self._checkpoint('restore', '{} {} {} {}'.format(version_uid, ' '.join(targets), ranges, pack), version.size)
+            state = None
+        elif state is not None:
+            # The targets may have been removed or reused since.
+            if [_io.target_size(_target) for _io, _target in zip(ios, targets)] != state.get('target_sizes'):
+                raise ValueError('Cannot continue the interrupted restore of version {}, its targets are missing or have changed their size.'.format(version_uid))
+            if not ranges:
+                changed_targets = self._check_restored(version_uid, targets, state['continue_from'])
+                if changed_targets:
+                    raise ValueError('Cannot continue the interrupted restore of version {}, {} has been changed.'.format(version_uid, ', '.join(changed_targets)))
+            continue_from = max(continue_from, state['continue_from'])
+            force = True  # the targets have been created by the interrupted restore
+            logger.info('Continuing interrupted restore of version {} from block id {}.'.format(version_uid, continue_from))
+        elif resume:
+            logger.warning('No interrupted restore of version {} found, restoring from the start.'.format(version_uid))
+
         if continue_from:
             notify(self.process_name, 'Restoring Version {} from block id'.format(version_uid, continue_from))
         else:
             notify(self.process_name, 'Restoring Version {}'.format(version_uid))
-        blocks = self.meta_backend.get_blocks_by_version(version_uid)
-        num_blocks = blocks.count()
+        num_blocks = self.meta_backend.get_num_blocks_by_version(version_uid)
+        blocks = self.meta_backend.get_blocks_by_version_deref(version_uid)
 
-        io = self.get_io_by_source(target)
-        io.open_w(target, version.size_bytes, force)
+        for _io, _target in zip(ios, targets):
+            _io.open_w(_target, target_size, force)
+        target_sizes = [_io.target_size(_target) for _io, _target in zip(ios, targets)]
+        target = ', '.join(targets)  # for status messages
 
         read_jobs = 0
         _log_every_jobs = num_blocks // 200 + 1  # about every half percent
         _log_jobs_counter = 0
         t1 = time.time()
         t_last_run = 0
-        num_blocks = blocks.count()
         min_sequential_block_id = MinSequential(continue_from)  # for finding the minimum block-ID until which we have restored ALL blocks
-        for i, block in enumerate(blocks.yield_per(1000)):
+
+        _callback_lock = threading.Lock()
+        def _write(block, data):
+            """ Writes a block's data to all targets. A block counts as
+            restored when all of its writes are done.
+            """
+            writes = _writes(block, data)
+            pending_writes = [len(writes) * len(ios)]
+            def callback(local_length):
+                def f():
+                    with _callback_lock:
+                        stats['bytes_written'] += local_length
+                        stats['bytes_throughput'] += local_length
+                        pending_writes[0] -= 1
+                        if pending_writes[0] == 0:
+                            min_sequential_block_id.put(block.id)
+                            checkpoint.set_done(block.id)
+                            stats['blocks_written'] += 1
+                            stats['blocks_throughput'] += 1
+                return f
+            for _data, _offset in writes:
+                for io in ios:
+                    io.write(block, _data, callback(len(_data)), _offset)
+
+        def _save_checkpoint():
+            watermark = min_sequential_block_id.get()
+            checkpoint.save({
+                'continue_from': continue_from if watermark is None else watermark + 1,
+                'target_sizes': target_sizes,
+                })
+        _save_checkpoint()
+
+        for i, block in enumerate(blocks):
             if block.id < continue_from:
                 continue
             _log_jobs_counter -= 1
-            if block.uid:
-                self.data_backend.read(block.deref())  # adds a read job
+            if checkpoint.is_done(block.id):
+                # restored by the interrupted restore
+                min_sequential_block_id.skip(block.id)
+            elif segments is not None and block.id not in segments:
+                # not within the requested ranges
+                min_sequential_block_id.skip(block.id)
+            elif block.uid:
+                self.data_backend.read(block)  # adds a read job
                 read_jobs += 1
             elif not sparse:
-                io.write(block, b'\0'*block.size)
-                stats['blocks_written'] += 1
-                stats['bytes_written'] += block.size
-                stats['blocks_throughput'] += 1
-                stats['bytes_throughput'] += block.size
+                _write(block, b'\0'*block.size)
                 logger.debug('Restored sparse block {} successfully ({} bytes).'.format(
                     block.id,
                     block.size,
                     ))
-                min_sequential_block_id.skip(block.id)
             else:
                 stats['blocks_sparse'] += 1
                 stats['bytes_sparse'] += block.size
@@ -341,9 +860,9 @@ class Backy():
                 t_last_run = time.time()
                 t2 = time.time()
                 dt = t2-t1
-                logger.debug(io.thread_status() + " " + self.data_backend.thread_status())
+                logger.debug(" ".join([io.thread_status() for io in ios]) + " " + self.data_backend.thread_status())
 
-                io_queue_status = io.queue_status()
+                io_queue_status = max([io.queue_status() for io in ios], key=lambda s: s['wq_filled'])
                 db_queue_status = self.data_backend.queue_status()
                 _status = status(
                     'Restore phase 1/2 (sparse) to {}'.format(target),
@@ -358,6 +877,9 @@ class Backy():
                     _log_jobs_counter = _log_every_jobs
                     logger.info(_status)
 
+            if checkpoint.due():
+                _save_checkpoint()
+
         stats = {
                 'bytes_read': 0,
                 'blocks_read': 0,
@@ -383,8 +905,8 @@ class Backy():
                     else:
                         break
             except Exception as e:
-                # TODO (restore): write information for continue
                 logger.error("Exception during reading from the data backend: {}".format(str(e)))
+                _save_checkpoint()
                 #raise  # Enable for debugging
                 sys.exit(6)
             assert len(data) == block.size
@@ -392,15 +914,7 @@ class Backy():
             stats['bytes_read'] += block.size
 
             data_checksum = self.hash_function(data).hexdigest()
-            def callback(local_block_id):
-                def f():
-                    min_sequential_block_id.put(local_block_id)
-                    stats['blocks_written'] += 1
-                    stats['bytes_written'] += block.size
-                    stats['blocks_throughput'] += 1
-                    stats['bytes_throughput'] += block.size
-                return f
-            io.write(block, data, callback(block.id))
+            _write(block, data)
 
             if data_checksum != block.checksum:
                 logger.error('Checksum mismatch during restore for block '
@@ -422,9 +936,9 @@ class Backy():
                 t_last_run = time.time()
                 t2 = time.time()
                 dt = t2-t1
-                logger.debug(io.thread_status() + " " + self.data_backend.thread_status())
+                logger.debug(" ".join([io.thread_status() for io in ios]) + " " + self.data_backend.thread_status())
 
-                io_queue_status = io.queue_status()
+                io_queue_status = max([io.queue_status() for io in ios], key=lambda s: s['wq_filled'])
                 db_queue_status = self.data_backend.queue_status()
                 _status = status(
                     'Restore phase 2/2 (data) to {}'.format(target),
@@ -440,9 +954,14 @@ class Backy():
                     _log_jobs_counter = _log_every_jobs
                     logger.info(_status)
 
+            if checkpoint.due():
+                _save_checkpoint()
+
 
         self.locking.unlock(version_uid)
-        io.close()
+        for io in ios:
+            io.close()  # wait for all writers
+        checkpoint.remove()
 
 
     def protect(self, version_uid):
@@ -479,13 +998,98 @@ class Backy():
         self.locking.unlock(version_uid)
 
 
-    def get_sla_breaches(self, name, scheduler, interval, keep, sla):
+    def clone(self, version_uid, name, snapshot_name='', tags=None, expire=None):
+        """ Creates a new version with the same blocks as version_uid without
+        reading or writing any data. Returns the new version's uid.
+        """
+        if not self.locking.lock(version_uid):
+            raise LockError('Version {} is locked.'.format(version_uid))
+        try:
+            new_version_uid = self.meta_backend.copy_version(version_uid, name, snapshot_name)
+        finally:
+            self.locking.unlock(version_uid)
+        for tag in tags or []:
+            self.meta_backend.add_tag(new_version_uid, tag)
+        if expire:
+            self.meta_backend.expire_version(new_version_uid, expire)
+        logger.info('Cloned version {} to {}.'.format(version_uid, new_version_uid))
+        return new_version_uid
+
+
+    def get_prune_candidates(self, keeps, name=None, force=False, disallow_rm_when_younger_than_days=0):
+        """ Returns a list of (version, reason) of versions which are expired
+        or not retained by any scheduler. keeps is a dict scheduler: keep.
+        A version tagged with a scheduler is retained by it when it is one of
+        the keep newest valid versions of its name with this tag or newer
+        than these. Protected versions are never candidates.
+        """
+        now = datetime.datetime.utcnow()
+        versions = self.ls(name=name)
+        retained = set()
+        for scheduler, keep in keeps.items():
+            by_name = {}
+            for version in versions:
+                if scheduler in [t.name for t in version.tags]:
+                    by_name.setdefault(version.name, []).append(version)
+            for _versions in by_name.values():
+                _versions.sort(key=lambda v: v.date)
+                _valid = [v for v in _versions if v.valid]
+                if keep == 0:
+                    continue
+                elif len(_valid) < keep:
+                    retained.update(v.uid for v in _versions)
+                else:
+                    retained.update(v.uid for v in _versions if v.date >= _valid[-keep].date)
+
+        candidates = []
+        for version in versions:
+            if version.protected:
+                continue
+            if not force and disallow_rm_when_younger_than_days > (now - version.date).days:
+                continue
+            if version.expire and version.expire < now:
+                candidates.append((version, 'expired'))
+            elif version.uid not in retained and set(keeps).intersection(t.name for t in version.tags):
+                candidates.append((version, 'retention'))
+        return candidates
+
+
+    def prune(self, version_uids):
+        """ Removes many versions in batches. Locked versions are skipped.
+        Returns the list of removed version uids.
+        """
+        locked = []
+        for version_uid in version_uids:
+            if self.locking.lock(version_uid):
+                locked.append(version_uid)
+            else:
+                logger.warning('Version {} is locked, skipping.'.format(version_uid))
+        try:
+            num_blocks = self.meta_backend.rm_versions(locked)
+            logger.info('Removed {} backup versions with {} blocks.'.format(len(locked), num_blocks))
+        finally:
+            for version_uid in locked:
+                self.locking.unlock(version_uid)
+        return locked
+
+
+    def _versions_for_name_and_scheduler(self, name, scheduler, versions=None):
+        """ Returns the valid versions of name tagged with scheduler, sorted by
+        date. versions may be the already loaded valid versions of name, which
+        saves a query when many schedulers are checked.
+        """
+        if versions is None:
+            return self.ls(name=name, tag=scheduler, valid=True)
+        return [v for v in versions if v.valid and v.name == name and scheduler in [t.name for t in v.tags]]
+
+
+    def get_sla_breaches(self, name, scheduler, interval, keep, sla, versions=None):
         """
         Get SLA breaches for version name and tag_name (scheduler)
         """
         # version's name must match and also the scheduler's name must be in tags.
         # They're already sorted by date so the newest is at the end of the list.
-        _last_versions_for_name_and_scheduler = [v for v in self.ls() if v.valid and v.name == name and scheduler in [t.name for t in v.tags]]
+        _last_versions_for_name_and_scheduler = self._versions_for_name_and_scheduler(name, scheduler, versions)
         sla_breaches = []  # name: list of breaches
 
         # Check SLA for number of versions to keep for this scheduler
@@ -543,13 +1147,13 @@ class Backy():
         return sla_breaches
 
 
-    def get_due_backups(self, name, scheduler, interval, keep, sla):
+    def get_due_backups(self, name, scheduler, interval, keep, sla, versions=None):
         """
         Returns True if a backup is due for a given scheduler
         """
         if keep == 0:
             return False
-        _last_versions_for_name_and_scheduler = [v for v in self.ls() if v.valid and v.name == name and scheduler in [t.name for t in v.tags]]
+        _last_versions_for_name_and_scheduler = self._versions_for_name_and_scheduler(name, scheduler, versions)
         # Check if now is the time to create a backup for this name and scheduler.
         if not _last_versions_for_name_and_scheduler:  # no backups exist, so require one
             logger.debug('DUE: Last backup for {} not found, so it is due.'.format(name, ))
@@ -582,16 +1186,11 @@ class Backy():
         - give the tag 'b_weekly' if the last b_weekly tagged version for this name is > 6 days ago
         - give the tag 'b_monthly' if the last b_monthly tagged version for this name is > 1 month ago
         """
-        all_versions = self.meta_backend.get_versions()
-        versions = [{'date': v.date.date(), 'tags': [t.name for t in v.tags]} for v in all_versions if v.name == version_name]
+        versions = [{'date': v.date.date(), 'tags': [t.name for t in v.tags]} for v in self.ls(name=version_name)]
 
-        b_daily = None
-        b_weekly = None
-        b_monthly = None
-        for version in versions:
-            b_daily = [v for v in versions if 'b_daily' in v['tags']]
-            b_weekly = [v for v in versions if 'b_weekly' in v['tags']]
-            b_monthly = [v for v in versions if 'b_monthly' in v['tags']]
+        b_daily = [v for v in versions if 'b_daily' in v['tags']]
+        b_weekly = [v for v in versions if 'b_weekly' in v['tags']]
+        b_monthly = [v for v in versions if 'b_monthly' in v['tags']]
         b_daily_last = max([v['date'] for v in b_daily]) if b_daily else None
         b_weekly_last = max([v['date'] for v in b_weekly]) if b_weekly else None
         b_monthly_last = max([v['date'] for v in b_monthly]) if b_monthly else None
@@ -620,6 +1219,8 @@ class Backy():
         the target.
         If continue_version is given, this version will be continued, i.e.
         existing blocks will not be read again.
+        An interrupted backup of the same name, snapshot name and source is
+        continued automatically from its checkpoint.
         """
         stats = {
                 'version_size_bytes': 0,
@@ -668,6 +1269,50 @@ class Backy():
             if not old_version.valid:
                 raise RuntimeError('You cannot base on an invalid version.')
 
+        # Find an interrupted backup of this source
+        checkpoint = self._checkpoint('backup', '{} {} {}'.format(name, snapshot_name, source), size)
+        resumed = False
+        if not continue_version:
+            state, records = checkpoint.load()
+            if state is not None:
+                try:
+                    _v = self.meta_backend.get_version(state['version_uid'])
+                except KeyError:
+                    _v = None
+                if _v is None or _v.valid or _v.size_bytes != source_size:
+                    logger.info('Ignoring checkpoint of version {} as the version has changed.'.format(state['version_uid']))
+                    checkpoint.remove()
+                    checkpoint = self._checkpoint('backup', '{} {} {}'.format(name, snapshot_name, source), size)
+                else:
+                    # Record the blobs which have been written but not committed
+                    _existing_block_ids = set(self.meta_backend.get_block_ids_by_version(_v.uid))
+                    _recovered = 0
+                    for record in records:
+                        if record['id'] in _existing_block_ids:
+                            continue
+                        self.meta_backend.set_block(record['id'],
+                            _v.uid,
+                            record['uid'],
+                            record['checksum'],
+                            record['size'],
+                            valid=1,
+                            enc_envkey=binascii.unhexlify(record['enc_envkey']) if record['enc_envkey'] else None,
+                            enc_version=record['enc_version'],
+                            enc_nonce=binascii.unhexlify(record['enc_nonce']) if record['enc_nonce'] else None,
+                            _commit=False,
+                            )
+                        if record.get('blob_size') is not None:
+                            self.meta_backend.set_blob(record['uid'], record['blob_size'], record['blob_etag'], _commit=False)
+                        _existing_block_ids.add(record['id'])
+                        _recovered += 1
+                    self.meta_backend._commit()
+                    continue_version = _v.uid
+                    resumed = True
+                    logger.info('Continuing interrupted backup version {} ({} uncommitted blocks recovered).'.format(
+                        continue_version,
+                        _recovered,
+                        ))
+
         existing_block_ids = set()
         if continue_version:
             version_uid = continue_version
@@ -676,15 +1321,20 @@ class Backy():
                 raise ValueError('Version to continue backup from has a different size than the source. Cannot continue.')
             if _v.valid:
                 raise ValueError('You cannot continue a valid version.')
+            if not self.locking.lock(version_uid):
+                raise LockError('Version {} is locked.'.format(version_uid))
             # reduce read_blocks and sparse_blocks by existing blocks
             existing_block_ids = set(self.meta_backend.get_block_ids_by_version(version_uid))
             read_blocks = read_blocks - existing_block_ids
             sparse_blocks = sparse_blocks - existing_block_ids
+            for block_id in existing_block_ids:
+                checkpoint.set_done(block_id)
         else:
             # Create new version
             version_uid = self.meta_backend.set_version(name, snapshot_name, size, source_size, 0)  # initially marked invalid
             if not self.locking.lock(version_uid):
                 raise LockError('Version {} is locked.'.format(version_uid))
+        checkpoint.save({'version_uid': version_uid, 'watermark': None})
 
         # Sanity check:
         # Check some blocks outside of hints if they are the same in the
@@ -706,7 +1356,10 @@ class Backy():
             print(version_uid)
 
         tags = []
-        if tag is not None:
+        if resumed:
+            # tags and expiration have been set by the interrupted backup
+            tags = [t.name for t in _v.tags]
+        elif tag is not None:
             if isinstance(tag, list):
                 tags = tag
             else:
@@ -714,16 +1367,17 @@ class Backy():
         else:
             if not continue_version:
                 tags = self._generate_auto_tags(name)
-        for tag in tags:
-            self.meta_backend.add_tag(version_uid, tag)
+        if not resumed:
+            for tag in tags:
+                self.meta_backend.add_tag(version_uid, tag)
 
-        if expire:
+        if expire and not resumed:
             self.meta_backend.expire_version(version_uid, expire)
 
         # Find blocks to base on
         if from_version:
             # Make sure we're based on a valid version.
-            old_blocks = iter(self.meta_backend.get_blocks_by_version(from_version).yield_per(1000))
+            old_blocks = self.meta_backend.get_blocks_by_version_deref(from_version)
         else:
             old_blocks = iter([])
 
@@ -814,7 +1468,8 @@ class Backy():
                 if _log_jobs_counter <= 0:
                     _log_jobs_counter = _log_every_jobs
                     logger.info(_status)
-
+        if from_version:
+            old_blocks.close()  # there are more old blocks if the source shrunk
 
         # now use the readers and write
         _log_every_jobs = size // 200 + 1  # about every half percent
@@ -823,6 +1478,53 @@ class Backy():
         t_last_run = 0
 
         _written_blocks_queue = queue.Queue()  # contains ONLY blocks that have been written to the data backend.
+        min_sequential_block_id = MinSequential()  # for finding the minimum block-ID until which we have stored ALL blocks
+        for block_id in existing_block_ids:
+            min_sequential_block_id.skip(block_id)
+
+        def _set_blocks():
+            """ Set the blocks from the _written_blocks_queue. They are
+            journaled in the checkpoint until they are committed.
+            """
+            while True:
+                try:
+                    q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce, q_blob_size, q_blob_etag = _written_blocks_queue.get(block=False)
+                except queue.Empty:
+                    break
+                else:
+                    self.meta_backend.set_block(q_block_id,
+                        q_version_uid,
+                        q_block_uid,
+                        q_data_checksum,
+                        q_block_size,
+                        valid=1,
+                        enc_envkey=q_enc_envkey,
+                        enc_version=q_enc_version,
+                        enc_nonce=q_enc_nonce,
+                        _commit=False,
+                        )
+                    if q_blob_size is not None:
+                        self.meta_backend.set_blob(q_block_uid, q_blob_size, q_blob_etag, _commit=False)
+                    checkpoint.journal({
+                        'id': q_block_id,
+                        'uid': q_block_uid,
+                        'checksum': q_data_checksum,
+                        'size': q_block_size,
+                        'enc_envkey': binascii.hexlify(q_enc_envkey).decode('ascii') if q_enc_envkey else None,
+                        'enc_version': q_enc_version,
+                        'enc_nonce': binascii.hexlify(q_enc_nonce).decode('ascii') if q_enc_nonce else None,
+                        'blob_size': q_blob_size,
+                        'blob_etag': q_blob_etag,
+                        })
+                    min_sequential_block_id.put(q_block_id)
+                    checkpoint.set_done(q_block_id)
+
+        def _save_checkpoint():
+            self.meta_backend._commit()
+            checkpoint.save({
+                'version_uid': version_uid,
+                'watermark': min_sequential_block_id.get(),
+                })
 
         # consume the read jobs
         for i in range(size):
@@ -843,7 +1545,7 @@ class Backy():
                 if data == b'\0' * block_size:
                     block_uid = None
                     data_checksum = None
-                    _written_blocks_queue.put((block_id, version_uid, block_uid, data_checksum, block_size, None, 0, None))
+                    _written_blocks_queue.put((block_id, version_uid, block_uid, data_checksum, block_size, None, 0, None, None, None))
                 elif existing_block and existing_block.size == block_size:
                     block_uid = existing_block.uid
                     _written_blocks_queue.put((block_id,
@@ -856,13 +1558,15 @@ class Backy():
                         existing_block.enc_version,
                         #existing_block.enc_nonce.encode('ascii')))
                         binascii.unhexlify(existing_block.enc_nonce) if existing_block.enc_nonce else None,
+                        None,
+                        None,
                         ))
                 else:
                     # This is the whole reason for _written_blocks_queue. We must first write the block to
                     # the backup data store before we write it to the database. Otherwise we can't support
                     # backup continuation reliably.
                     def callback(local_block_id, local_version_uid, local_data_checksum, local_block_size):
-                        def f(_block_uid, enc_envkey, enc_version, enc_nonce):
+                        def f(_block_uid, enc_envkey, enc_version, enc_nonce, blob_size, blob_etag):
                             _written_blocks_queue.put((
                                 local_block_id,
                                 local_version_uid,
@@ -871,7 +1575,9 @@ class Backy():
                                 local_block_size,
                                 enc_envkey,
                                 enc_version,
-                                enc_nonce
+                                enc_nonce,
+                                blob_size,
+                                blob_etag,
                                 ))
                         return f
                     block_uid = self.data_backend.save(data, callback=callback(block_id, version_uid, data_checksum, block_size))  # this will re-raise an exception from a worker thread
@@ -891,6 +1597,7 @@ class Backy():
                             ))
                         # remove version
                         self.meta_backend.rm_version(version_uid)
+                        checkpoint.remove()
                         sys.exit(5)
                     stats['blocks_checked'] += 1
                     stats['bytes_checked'] += block_size
@@ -916,7 +1623,9 @@ class Backy():
                         block_size,
                         enc_envkey,
                         enc_version,
-                        enc_nonce
+                        enc_nonce,
+                        None,
+                        None,
                         ))
                     if metadata['block_uid'] is None:
                         stats['blocks_sparse'] += 1
@@ -926,23 +1635,7 @@ class Backy():
                         stats['bytes_found_dedup'] += block_size
 
             # Set the blocks from the _written_blocks_queue
-            while True:
-                try:
-                    q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce = _written_blocks_queue.get(block=False)
-                except queue.Empty:
-                    break
-                else:
-                    self.meta_backend.set_block(q_block_id,
-                        q_version_uid,
-                        q_block_uid,
-                        q_data_checksum,
-                        q_block_size,
-                        valid=1,
-                        enc_envkey=q_enc_envkey,
-                        enc_version=q_enc_version,
-                        enc_nonce=q_enc_nonce,
-                        _commit=True,
-                        )
+            _set_blocks()
 
             # log and process output
             if time.time() - t_last_run >= 1:
@@ -960,12 +1653,16 @@ class Backy():
                     (i + 1) / size * 100,
                     stats['bytes_throughput'] / dt,
                     round(size / (i+1) * dt - dt),
+                    'Last ID: {}'.format(min_sequential_block_id.get()),
                     )
                 notify(self.process_name, _status)
                 if _log_jobs_counter <= 0:
                     _log_jobs_counter = _log_every_jobs
                     logger.info(_status)
 
+            if checkpoint.due():
+                _save_checkpoint()
+
         # check if there are any exceptions left
         if self.data_backend.last_exception:
             logger.error("Exception during saving to the data backend: {}".format(str(self.data_backend.last_exception)))
@@ -974,22 +1671,7 @@ class Backy():
             self.data_backend.close()  # wait for all writers
 
         # Set the rest of the blocks from the _written_blocks_queue
-        while True:
-            try:
-                q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce = _written_blocks_queue.get(block=False)
-            except queue.Empty:
-                break
-            else:
-                self.meta_backend.set_block(q_block_id,
-                    q_version_uid,
-                    q_block_uid,
-                    q_data_checksum,
-                    q_block_size,
-                    valid=1,
-                    enc_envkey=q_enc_envkey,
-                    enc_version=q_enc_version,
-                    enc_nonce=q_enc_nonce,
-                    _commit=True)
+        _set_blocks()
 
         self.meta_backend.set_stats(
             version_uid=version_uid,
@@ -1009,9 +1691,11 @@ class Backy():
 
         if self.data_backend.last_exception:
             logger.info('New invalid version: {} (Tags: [{}])'.format(version_uid, ','.join(tags)))
+            _save_checkpoint()  # a rerun will continue this version
         else:
             self.meta_backend.set_version_valid(version_uid)
             logger.info('New version: {} (Tags: [{}])'.format(version_uid, ','.join(tags)))
+            checkpoint.remove()
 
         self.meta_backend._commit()
         self.locking.unlock(version_uid)
@@ -1022,10 +1706,176 @@ class Backy():
         return version_uid
 
 
-    def fuse(self, mount):
+    def get_block_reader(self):
+        """ Returns a BlockReader with a blob cache as configured in
+        [DEFAULTS]. It takes over the data backend's reads. """
+        config_DEFAULTS = self.config(section='DEFAULTS')
+        cache = BlobCache(
+            parse_size(config_DEFAULTS.get('block_cache_size', '512M')),
+            parse_size(config_DEFAULTS.get('block_cache_disk_size', '0')),
+            config_DEFAULTS.get('cachedir', '/tmp'),
+            )
+        return BlockReader(self.data_backend, cache)
+
+
+    def commit_blocks(self, changes):
+        """ Creates a new version for each version uid in changes, a dict
+        version_uid: iterable of (block id, data) ordered by block id. The
+        other blocks of the new version reference the blobs of the old
+        version, so only the changed blocks are hashed, deduplicated and
+        written. Waits for the data backend's writers, i.e. closes it.
+        Returns a dict old version_uid: new version_uid.
+        """
+        _written_blocks_queue = queue.Queue()  # contains ONLY blocks that have been written to the data backend.
+
+        def _set_blocks():
+            while True:
+                try:
+                    q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce, q_blob_size, q_blob_etag = _written_blocks_queue.get(block=False)
+                except queue.Empty:
+                    break
+                else:
+                    self.meta_backend.set_block(q_block_id,
+                        q_version_uid,
+                        q_block_uid,
+                        q_data_checksum,
+                        q_block_size,
+                        valid=1,
+                        enc_envkey=q_enc_envkey,
+                        enc_version=q_enc_version,
+                        enc_nonce=q_enc_nonce,
+                        _commit=False,
+                        )
+                    if q_blob_size is not None:
+                        self.meta_backend.set_blob(q_block_uid, q_blob_size, q_blob_etag, _commit=False)
+
+        new_version_uids = {}
+        valid_version_uids = []
+        for version_uid, blocks in changes.items():
+            version = self.meta_backend.get_version(version_uid)
+            version_size_bytes = version.size_bytes
+            new_version_uid = self.meta_backend.set_version(version.name, '', version.size, version_size_bytes, 0)  # initially marked invalid
+            new_version_uids[version_uid] = new_version_uid
+            if version.valid:
+                valid_version_uids.append(new_version_uid)
+            old_blocks = VersionBlocks.load(self.meta_backend, version_uid)
+            changed_blocks = iter(blocks)
+            changed_block = next(changed_blocks, None)
+            written = deduplicated = 0
+            for block_id in range(len(old_blocks)):
+                block_size = min(self.block_size, version_size_bytes - block_id * self.block_size)  # the last block may be shorter
+                if changed_block is None or changed_block[0] != block_id:
+                    # unchanged
+                    try:
+                        block = old_blocks.get(block_id)
+                    except KeyError:
+                        continue  # missing in the old version too
+                    if block is None:
+                        _written_blocks_queue.put((block_id, new_version_uid, None, None, block_size, None, 0, None, None, None))
+                    else:
+                        _written_blocks_queue.put((
+                            block_id,
+                            new_version_uid,
+                            block.uid,
+                            block.checksum,
+                            block.size,
+                            binascii.unhexlify(block.enc_envkey) if block.enc_envkey else None,
+                            block.enc_version,
+                            binascii.unhexlify(block.enc_nonce) if block.enc_nonce else None,
+                            None,
+                            None,
+                            ))
+                    _set_blocks()
+                    continue
+
+                data = changed_block[1][:block_size]
+                changed_block = next(changed_blocks, None)
+                if data == b'\0' * block_size:
+                    _written_blocks_queue.put((block_id, new_version_uid, None, None, block_size, None, 0, None, None, None))
+                    _set_blocks()
+                    continue
+                data_checksum = self.hash_function(data).hexdigest()
+                existing_block = None
+                if self.dedup:
+                    existing_block = self.meta_backend.get_block_by_checksum(data_checksum, self.preferred_encryption_version)
+                if existing_block and existing_block.size == block_size:
+                    _written_blocks_queue.put((block_id,
+                        new_version_uid,
+                        existing_block.uid,
+                        data_checksum,
+                        block_size,
+                        binascii.unhexlify(existing_block.enc_envkey) if existing_block.enc_envkey else None,
+                        existing_block.enc_version,
+                        binascii.unhexlify(existing_block.enc_nonce) if existing_block.enc_nonce else None,
+                        None,
+                        None,
+                        ))
+                    deduplicated += 1
+                else:
+                    def callback(local_block_id, local_version_uid, local_data_checksum, local_block_size):
+                        def f(_block_uid, enc_envkey, enc_version, enc_nonce, blob_size, blob_etag):
+                            _written_blocks_queue.put((
+                                local_block_id,
+                                local_version_uid,
+                                _block_uid,
+                                local_data_checksum,
+                                local_block_size,
+                                enc_envkey,
+                                enc_version,
+                                enc_nonce,
+                                blob_size,
+                                blob_etag,
+                                ))
+                        return f
+                    self.data_backend.save(data, callback=callback(block_id, new_version_uid, data_checksum, block_size))  # this will re-raise an exception from a worker thread
+                    written += 1
+                _set_blocks()
+            logger.info('Committed changes of version {} as new version {} ({} blocks written, {} deduplicated).'.format(
+                version_uid, new_version_uid, written, deduplicated))
+
+        self.data_backend.close()  # wait for all writers
+        if self.data_backend.last_exception:
+            raise self.data_backend.last_exception
+        _set_blocks()
+        self.meta_backend._commit()
+        for new_version_uid in valid_version_uids:
+            self.meta_backend.set_version_valid(new_version_uid)
+        return new_version_uids
+
+
+    def fuse(self, mount, commit=False):
         from backy2.fuse import get_fuse
         cachedir = self.config(section='DEFAULTS').get('cachedir', '/tmp')
-        get_fuse(self, mount, cachedir)
+        get_fuse(self, mount, cachedir, commit)
+
+
+    def nbd(self, version_uids, address='127.0.0.1', port=10809, unix_socket=None, writable=False, commit=False):
+        """ Serves the versions via NBD until interrupted. With commit, the
+        changes to each written version are saved as a new version then. """
+        from backy2.nbd import NbdServer
+        for version_uid in version_uids:
+            # See if the version is locked, i.e. currently in backup
+            if not self.locking.lock(version_uid):
+                raise LockError('Version {} is locked.'.format(version_uid))
+            self.locking.unlock(version_uid)  # no need to keep it locked
+        cachedir = self.config(section='DEFAULTS').get('cachedir', '/tmp')
+        server = NbdServer(self, version_uids, self.get_block_reader(), cachedir, writable or commit)
+        server.listen(address, port, unix_socket)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            logger.info('Stopping the NBD server.')
+        finally:
+            server.shutdown()
+            if unix_socket:
+                os.unlink(unix_socket)
+        server.close()
+        if commit:
+            changes = server.changes()
+            if changes:
+                self.commit_blocks(changes)
+            else:
+                logger.info('No changes to commit.')
 
 
     def rekey(self, oldkey):
@@ -1043,7 +1893,7 @@ class Backy():
         _n_wrongversion = 0
         i = 0
         blocks = self.meta_backend.get_blocks()
-        num_blocks = blocks.count()
+        num_blocks = len(blocks)
         t1 = time.time()
         for block in blocks:
             if block.enc_version == cc.VERSION:
@@ -1067,7 +1917,7 @@ class Backy():
                     i / (t2-t1),
                     (t2-t1) / i/num_blocks,
                     ))
-        self.meta_backend.session.commit()  # ONLY at the very end. One transaction for them all so that interruptions don't matter.
+        self.meta_backend._commit()  # ONLY at the very end. One transaction for them all so that interruptions don't matter.
 
         logger.info('Rekeying successful: {} rekeyed, {} sparse/ignored, {} unable to rekey (wrong encryption version).)'.format(
             _n_rekeyed,
@@ -1092,7 +1942,7 @@ class Backy():
         new_version_uid = self.meta_backend.set_version(version.name, version.snapshot_name, version.size, version.size_bytes, 0)  # initially marked invalid
         self.meta_backend.expire_version(new_version_uid, version.expire)
         blocks = self.meta_backend.get_blocks_by_version_deref(version.uid)
-        num_blocks = self.meta_backend.get_blocks_by_version(version.uid).count()
+        num_blocks = self.meta_backend.get_num_blocks_by_version(version.uid)
 
         for i, block in enumerate(blocks):
             if block.uid and block.enc_version != encryption_version:
@@ -1109,6 +1959,8 @@ class Backy():
                         binascii.unhexlify(_b.enc_envkey) if _b.enc_envkey else None,
                         encryption_version,
                         binascii.unhexlify(_b.enc_nonce) if _b.enc_nonce else None,
+                        None,
+                        None,
                         ))
                 else:
                     # data block
@@ -1119,7 +1971,7 @@ class Backy():
                         self.meta_backend.set_blocks_invalid(block.uid, block.checksum)
                     else:
                         def callback(local_block_id, local_version_uid, local_data_checksum, local_block_size):
-                            def f(_block_uid, enc_envkey, enc_version, enc_nonce):
+                            def f(_block_uid, enc_envkey, enc_version, enc_nonce, blob_size, blob_etag):
                                 _written_blocks_queue.put((
                                     local_block_id,
                                     local_version_uid,
@@ -1128,7 +1980,9 @@ class Backy():
                                     local_block_size,
                                     enc_envkey,
                                     enc_version,
-                                    enc_nonce
+                                    enc_nonce,
+                                    blob_size,
+                                    blob_etag,
                                     ))
                             return f
                         self.data_backend.save(data, callback=callback(block.id, new_version_uid, block.checksum, block.size))  # this will re-raise an exception from a worker thread
@@ -1143,12 +1997,14 @@ class Backy():
                     binascii.unhexlify(block.enc_envkey) if block.enc_envkey else None,
                     block.enc_version,
                     binascii.unhexlify(block.enc_nonce) if block.enc_nonce else None,
+                    None,
+                    None,
                     ))
 
             # Set the blocks from the _written_blocks_queue
             while True:
                 try:
-                    q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce = _written_blocks_queue.get(block=False)
+                    q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce, q_blob_size, q_blob_etag = _written_blocks_queue.get(block=False)
                 except queue.Empty:
                     break
                 else:
@@ -1163,6 +2019,8 @@ class Backy():
                         enc_nonce=q_enc_nonce,
                         _commit=True,
                         )
+                    if q_blob_size is not None:
+                        self.meta_backend.set_blob(q_block_uid, q_blob_size, q_blob_etag, _commit=True)
 
             if i%100 == 0:
                 logger.info('Migration to encryption version {} for version {} to new version {}, {}/{} blocks done.'.format(
@@ -1178,7 +2036,7 @@ class Backy():
         # Set the remaining blocks from the _written_blocks_queue
         while True:
             try:
-                q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce = _written_blocks_queue.get(block=False)
+                q_block_id, q_version_uid, q_block_uid, q_data_checksum, q_block_size, q_enc_envkey, q_enc_version, q_enc_nonce, q_blob_size, q_blob_etag = _written_blocks_queue.get(block=False)
             except queue.Empty:
                 break
             else:
@@ -1193,6 +2051,8 @@ class Backy():
                     enc_nonce=q_enc_nonce,
                     _commit=True,
                     )
+                if q_blob_size is not None:
+                    self.meta_backend.set_blob(q_block_uid, q_blob_size, q_blob_etag, _commit=True)
         # migrate tags
         for tag in version.tags:
             self.meta_backend.add_tag(new_version_uid, tag.name)
@@ -1278,8 +2138,8 @@ class Backy():
         self.data_backend.close()
 
 
-    def export(self, version_uid, f):
-        self.meta_backend.export(version_uid, f)
+    def export(self, version_uid, f, as_csv=False):
+        self.meta_backend.export(version_uid, f, as_csv)
         return f
 
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from array import array
+from bisect import bisect_right
+from itertools import chain, islice, repeat
+import sys
+import zlib
+
+FORMAT_VERSION = 1
+
+
+def _runs(blob_ids):
+    """ Run-length encodes blob ids into (length, first, step) runs.
+    Blocks written in order reference consecutive blob ids (step 1), sparse
+    blocks and unchanged areas the same blob id (step 0).
+    """
+    runs = array('q')
+    length = first = step = 0
+    last = None
+    for blob_id in blob_ids:
+        if length == 0:
+            length, first = 1, blob_id
+        elif length == 1:
+            length, step = 2, blob_id - first
+        elif blob_id - last == step:
+            length += 1
+        else:
+            runs.extend((length, first, step))
+            length, first, step = 1, blob_id, 0
+        last = blob_id
+    if length:
+        runs.extend((length, first, step))
+    return runs
+
+
+class BlockMap():
+    """ The blob ids of all blocks of a version, indexed by block id. This
+    only holds the runs, so loading it doesn't depend on the number of
+    blocks. """
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.starts = array('q')  # block id of each run's first block
+        start = 0
+        for i in range(0, len(runs), 3):
+            self.starts.append(start)
+            start += runs[i]
+        self.length = start
+
+
+    def __len__(self):
+        return self.length
+
+
+    def _iter_from(self, start):
+        if start >= self.length:
+            return iter(())
+        r = bisect_right(self.starts, start) - 1
+        return islice(chain.from_iterable(self._runs(r)), start - self.starts[r], None)
+
+
+    def _runs(self, r):
+        _runs = iter(self.runs[r*3:])
+        for length, first, step in zip(_runs, _runs, _runs):
+            if step == 0:
+                yield repeat(first, length)
+            else:
+                yield range(first, first + length * step, step)
+
+
+    def __iter__(self):
+        return self._iter_from(0)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, stride = key.indices(self.length)
+            if stride != 1:
+                raise ValueError('Only contiguous slices are supported.')
+            return list(islice(self._iter_from(start), max(stop - start, 0)))
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('block id out of range')
+        r = bisect_right(self.starts, key) - 1
+        length, first, step = self.runs[r*3:r*3+3]
+        return first + (key - self.starts[r]) * step
+
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+
+def pack(blob_ids):
+    """ Packs the blob ids of all blocks of a version (ordered by block id)
+    into compressed bytes. """
+    runs = _runs(blob_ids)
+    if sys.byteorder == 'big':
+        runs.byteswap()
+    return bytes([FORMAT_VERSION]) + zlib.compress(runs.tobytes())
+
+
+def unpack(data):
+    """ Returns the BlockMap of packed bytes. """
+    if data[0] != FORMAT_VERSION:
+        raise ValueError('Unknown block map format {}.'.format(data[0]))
+    runs = array('q')
+    runs.frombytes(zlib.decompress(data[1:]))
+    if sys.byteorder == 'big':
+        runs.byteswap()
+    return BlockMap(runs)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+""" Random access to the blocks of versions, e.g. for backy2 fuse. """
+
+from array import array
+from backy2.data_backends import ReadError
+from backy2.logging import logger
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+from threading import Event, Lock, Thread
+import os
+import queue
+import tempfile
+
+SPARSE = -1
+MISSING = -2
+
+
+class VersionBlocks():
+    """ The blocks of a version, loaded once. Each distinct blob is held
+    once, the blocks only index into them. """
+
+    def __init__(self, version_uid, size, blocks):
+        self.version_uid = version_uid
+        self.blocks = []  # one DereferencedBlock per blob
+        self.index = array('l', [MISSING]) * size  # block id: index in self.blocks
+        _blob_index = {}  # blob uid: index in self.blocks
+        for block in blocks:
+            if not block.uid:  # sparse ('' because of old defective inputs)
+                self.index[block.id] = SPARSE
+                continue
+            i = _blob_index.get(block.uid)
+            if i is None:
+                i = _blob_index[block.uid] = len(self.blocks)
+                self.blocks.append(block)
+            self.index[block.id] = i
+
+
+    @classmethod
+    def load(cls, meta_backend, version_uid):
+        version = meta_backend.get_version(version_uid)
+        return cls(version.uid, version.size, meta_backend.get_blocks_by_version_deref(version_uid))
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def get(self, block_id):
+        """ Returns the block with the given id or None if it's sparse.
+        Raises KeyError if the version doesn't have it. """
+        i = self.index[block_id]
+        if i == SPARSE:
+            return None
+        if i == MISSING:
+            raise KeyError('Block {} of version {} is missing.'.format(block_id, self.version_uid))
+        return self.blocks[i]
+
+
+class BlobCache():
+    """ Keeps the data of the most recently read blobs by uid within
+    max_size bytes. With disk_size, up to disk_size bytes of blobs are also
+    kept as stored (i.e. encrypted) in a temporary directory in cachedir,
+    so that they don't have to be read from the data backend again after
+    they've been dropped from memory.
+
+    This isn't thread safe, BlockReader locks it (except for write_stored).
+    """
+
+    def __init__(self, max_size, disk_size=0, cachedir='/tmp'):
+        self.max_size = max_size
+        self.size = 0
+        self._blobs = OrderedDict()  # uid: data
+        self.disk_size = disk_size
+        self.disk_used = 0
+        self._stored = OrderedDict()  # uid: size of the file
+        self._dir = tempfile.TemporaryDirectory(prefix='backy2cache', dir=cachedir) if disk_size else None
+
+
+    def get(self, uid):
+        """ Returns the data of the blob or None """
+        data = self._blobs.get(uid)
+        if data is not None:
+            self._blobs.move_to_end(uid)
+        return data
+
+
+    def put(self, uid, data):
+        if len(data) > self.max_size or uid in self._blobs:
+            return
+        self._blobs[uid] = data
+        self.size += len(data)
+        while self.size > self.max_size:
+            self.size -= len(self._blobs.popitem(last=False)[1])
+
+
+    def _path(self, uid):
+        return os.path.join(self._dir.name, uid)
+
+
+    def get_stored_path(self, uid):
+        """ Returns the path of the stored blob on disk or None. The file
+        may be removed by put_stored before it's read. """
+        if uid not in self._stored:
+            return None
+        self._stored.move_to_end(uid)
+        return self._path(uid)
+
+
+    def write_stored(self, blob):
+        """ Writes a blob to a new file for put_stored and returns its path,
+        or None if it's too large to be kept. This needs no lock, so that
+        writing doesn't block the other users of the cache. """
+        if self._dir is None or len(blob) > self.disk_size:
+            return None
+        fd, path = tempfile.mkstemp(prefix='.', dir=self._dir.name)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        return path
+
+
+    def put_stored(self, uid, path):
+        """ Keeps the file written by write_stored as the stored blob """
+        if uid in self._stored:
+            os.remove(path)
+            return
+        size = os.path.getsize(path)
+        os.replace(path, self._path(uid))
+        self._stored[uid] = size
+        self.disk_used += size
+        while self.disk_used > self.disk_size:
+            _uid, size = self._stored.popitem(last=False)
+            os.remove(self._path(_uid))
+            self.disk_used -= size
+
+
+    def close(self):
+        if self._dir is not None:
+            self._dir.cleanup()
+
+
+class BlockReader():
+    """ Reads blocks through the data backend's reader threads, so that
+    reads of different blobs run in parallel. Concurrent reads of the same
+    blob wait for the same fetch. The read blobs are decrypted by several
+    receiver threads (one per CPU by default) and kept in the BlobCache,
+    which is shared by all readers, e.g. all files of a fuse mount.
+
+    This is the only consumer of the data backend's reads until it's closed.
+    """
+
+    READ_TIMEOUT = 60  # seconds
+
+    def __init__(self, data_backend, cache, receivers=None):
+        self.data_backend = data_backend
+        self.cache = cache
+        self._lock = Lock()
+        self._fetches = {}  # blob uid: Future of blobs being read
+        self._stop = Event()
+        self._receiver_threads = []
+        for i in range(receivers or os.cpu_count() or 1):
+            _receiver_thread = Thread(target=self._receiver, daemon=True)
+            _receiver_thread.start()
+            self._receiver_threads.append(_receiver_thread)
+
+
+    def _receiver(self):
+        while not self._stop.is_set():
+            try:
+                # decrypted by _received, so that the cache on disk stays encrypted
+                block, offset, length, blob = self.data_backend.read_get(timeout=1, decrypt=False)
+            except queue.Empty:
+                continue
+            except (FileNotFoundError, ReadError) as e:
+                self._failed(e, e.args[1])
+            except Exception as e:
+                self._failed(e)
+            else:
+                if self.cache.disk_size:
+                    path = self.cache.write_stored(blob)
+                    if path is not None:
+                        with self._lock:
+                            self.cache.put_stored(block.uid, path)
+                self._received(block, blob)
+
+
+    def _read_stored(self, block, path):
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:  # just removed from the cache
+            self.data_backend.read(block)
+        else:
+            self._received(block, blob)
+
+
+    def _received(self, block, blob):
+        try:
+            data = self.data_backend.decrypt(block, blob)
+        except Exception as e:
+            self._failed(e, block)
+        else:
+            self._done(block.uid, data)
+
+
+    def _done(self, uid, data):
+        with self._lock:
+            self.cache.put(uid, data)
+            fetch = self._fetches.pop(uid, None)
+        if fetch is not None:
+            fetch.set_result(data)
+
+
+    def _failed(self, exception, block=None):
+        """ Fails the fetch of block. Without a block, it's unknown which
+        fetch failed, so all of them fail. """
+        with self._lock:
+            if block is not None:
+                fetches = [self._fetches.pop(block.uid)] if block.uid in self._fetches else []
+            else:
+                fetches = list(self._fetches.values())
+                self._fetches.clear()
+        logger.error('Reading blob failed: {}'.format(exception))
+        for fetch in fetches:
+            fetch.set_exception(exception)
+
+
+    def fetch(self, block):
+        """ Returns a Future of the block's data. Starts reading it unless
+        it's cached or already being read. """
+        with self._lock:
+            data = self.cache.get(block.uid)
+            if data is not None:
+                fetch = Future()
+                fetch.set_result(data)
+                return fetch
+            fetch = self._fetches.get(block.uid)
+            if fetch is not None:
+                return fetch
+            fetch = self._fetches[block.uid] = Future()
+            stored_path = self.cache.get_stored_path(block.uid)
+        if stored_path is not None:
+            self._read_stored(block, stored_path)
+        else:
+            self.data_backend.read(block)
+        return fetch
+
+
+    def read(self, block):
+        """ Returns the block's data. Raises the fetch's exception or
+        TimeoutError if it isn't read within READ_TIMEOUT seconds. """
+        fetch = self.fetch(block)
+        try:
+            return fetch.result(timeout=self.READ_TIMEOUT)
+        except TimeoutError:
+            with self._lock:
+                if self._fetches.get(block.uid) is fetch:
+                    del self._fetches[block.uid]  # the next read retries
+            logger.error('Reading blob {} timed out.'.format(block.uid))
+            raise
+
+
+    def close(self):
+        self._stop.set()
+        for _receiver_thread in self._receiver_threads:
+            _receiver_thread.join()
+        self.cache.close()
+
+
+class TemporaryBlockStore:
+    def __init__(self, cachedir):
+        self._lock = Lock()
+        self.tempfile = tempfile.TemporaryFile(prefix='backy2cow', suffix='.img', dir=cachedir)
+        self.db = {}  # key is block_id, value is (offset, length)
+        self.offset = 0  # next write offset
+
+
+    def has_block(self, block_id):
+        return block_id in self.db
+
+
+    def write_block(self, block_id, data):
+        with self._lock:
+            self.tempfile.seek(self.offset)
+            self.tempfile.write(data)
+            self.db[block_id] = (self.offset, len(data))
+            self.offset += len(data)
+
+
+    def patch_block(self, block_id, data, offset):
+        tempfile_block_offset, tempfile_block_length = self.db[block_id]  # raise if it's not in there b/c that's a programming error.
+        assert offset + len(data) <= tempfile_block_length  # don't write beyond block boundaries
+        with self._lock:
+            self.tempfile.seek(tempfile_block_offset + offset)
+            self.tempfile.write(data)
+        return len(data)
+
+
+    def read_block(self, block_id):
+        tempfile_block_offset, tempfile_block_length = self.db[block_id]  # raise if it's not in there b/c that's a programming error.
+        with self._lock:
+            self.tempfile.seek(tempfile_block_offset)
+            return self.tempfile.read(tempfile_block_length)
+
+
+    def blocks(self):
+        """ Yields (block_id, data) of all written blocks ordered by block_id """
+        for block_id in sorted(self.db):
+            yield block_id, self.read_block(block_id)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from backy2.logging import logger
+import base64
+import hashlib
+import json
+import os
+import time
+import zlib
+
+
+class Checkpoint():
+    """ Persists the progress of a backup or restore so that a plain rerun
+    can continue where an interrupted job stopped.
+
+    A checkpoint consists of a small header file (json) with the job's state,
+    the watermark (all block ids up to here are done) and a compressed bitmap
+    of done block ids, plus an append-only journal of blobs which have been
+    written to the data backend but are not yet committed to the meta backend.
+    """
+
+    def __init__(self, path, operation, key, size, interval=10):
+        """ operation is 'backup' or 'restore', key identifies the job
+        (e.g. version name, snapshot name and source) and size is the number
+        of blocks.
+        """
+        self.operation = operation
+        self.key = key
+        self.interval = interval
+        self.filename = os.path.join(path, 'backy_{}_{}.checkpoint'.format(
+            operation,
+            hashlib.sha1(key.encode('utf-8')).hexdigest(),
+            ))
+        self.journal_filename = self.filename + '.journal'
+        self.done = bytearray((size + 7) // 8)
+        self._journal = None
+        self._t_last_save = time.time()
+
+
+    def set_done(self, block_id):
+        self.done[block_id >> 3] |= 1 << (block_id & 7)
+
+
+    def is_done(self, block_id):
+        return bool(self.done[block_id >> 3] & (1 << (block_id & 7)))
+
+
+    def load(self):
+        """ Loads an existing checkpoint for this job. Returns the state dict
+        that has been saved and the list of journal records or (None, [])
+        if there is no usable checkpoint.
+        """
+        try:
+            with open(self.filename, 'r') as f:
+                header = json.load(f)
+            done = bytearray(zlib.decompress(base64.b64decode(header.pop('done'))))
+        except FileNotFoundError:
+            self.remove()  # a journal without header is useless
+            return None, []
+        except (ValueError, KeyError, zlib.error) as e:
+            logger.warning('Ignoring damaged checkpoint {}: {}'.format(self.filename, str(e)))
+            self.remove()
+            return None, []
+        if header.get('operation') != self.operation or header.get('key') != self.key \
+                or len(done) != len(self.done):
+            logger.warning('Ignoring checkpoint {} as it belongs to a different job.'.format(self.filename))
+            self.remove()
+            return None, []
+        self.done = done
+
+        records = []
+        try:
+            with open(self.journal_filename, 'r') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break  # torn last line from a crash
+        except FileNotFoundError:
+            pass
+        return header['state'], records
+
+
+    def journal(self, record):
+        """ Appends a record (dict) to the journal. """
+        if self._journal is None:
+            self._journal = open(self.journal_filename, 'a')
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+
+
+    def due(self):
+        """ Returns True if the checkpoint should be saved again. """
+        return time.time() - self._t_last_save >= self.interval
+
+
+    def save(self, state):
+        """ Atomically writes the header and empties the journal, i.e. the
+        caller must have committed all journaled records.
+        """
+        header = {
+            'operation': self.operation,
+            'key': self.key,
+            'date': time.time(),
+            'state': state,
+            'done': base64.b64encode(zlib.compress(bytes(self.done))).decode('ascii'),
+            }
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+        if self._journal is not None:
+            self._journal.truncate(0)
+        elif os.path.exists(self.journal_filename):
+            open(self.journal_filename, 'w').close()
+        self._t_last_save = time.time()
+
+
+    def remove(self):
+        """ Removes the checkpoint, i.e. the job is done. """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        for filename in (self.filename, self.journal_filename):
+            try:
+                os.unlink(filename)
+            except FileNotFoundError:
+                pass
@@ -58,15 +58,17 @@ class CryptBase:
     def decrypt(self, blob, envelope_key=b''):
         return blob
 
+    def verify(self, blob, envelope_key=b''):
+        """ Returns True if the blob is authentic, False if not and None if
+        this version can't tell without decrypting (no authentication).
+        """
+        return None
+
 
 class NoCrypt(CryptBase):
     pass
 
 
-# module wide lock because zstandard CANNOT be used from
-# multiple threads simultaniously.
-crypt_v1_zstandard_lock = Lock()
-
 class CryptV1(CryptBase):
     """ Initialize with a password and encrypt data. This lib also compresses
     data before it encrypts it.
@@ -87,15 +89,18 @@ class CryptV1(CryptBase):
         self.compression_level = compression_level
         self.cctx = zstandard.ZstdCompressor(level=compression_level)  # zstandard.MAX_COMPRESSION_LEVEL
         self.dctx = zstandard.ZstdDecompressor()
+        # The contexts CANNOT be used from multiple threads simultaniously.
+        # Threads which shouldn't wait for each other use their own instances.
+        self._zstandard_lock = Lock()
 
 
     def _compress(self, data):
-        with crypt_v1_zstandard_lock:
+        with self._zstandard_lock:
             return self.cctx.compress(data)
 
 
     def _decompress(self, compressed):
-        with crypt_v1_zstandard_lock:
+        with self._zstandard_lock:
             return self.dctx.decompress(compressed)
 
 
@@ -155,3 +160,18 @@ class CryptV1(CryptBase):
         data = self._decompress(data)
         return data
 
+
+    def verify(self, blob, envelope_key):
+        # The GCM tag authenticates the whole ciphertext, so there's no need
+        # to decompress the data.
+        if len(blob) <= 32:
+            return False
+        digest, nonce, encrypted_data = self._unpack(blob)
+        try:
+            data_key = self.unwrap_key(envelope_key)
+            decryptor = AES.new(data_key, AES.MODE_GCM, nonce=nonce)
+            decryptor.decrypt_and_verify(encrypted_data, digest)
+        except ValueError:
+            return False
+        return True
+
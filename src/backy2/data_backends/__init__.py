@@ -4,6 +4,7 @@
 import shortuuid
 import hashlib
 import binascii
+import threading
 from backy2.crypt import get_crypt
 
 STATUS_NOTHING = 0
@@ -12,6 +13,13 @@ STATUS_WRITING = 2
 STATUS_THROTTLING = 3
 STATUS_QUEUE = 4
 
+
+class ReadError(Exception):
+    """ Reading a blob failed. Like the FileNotFoundError for missing blobs,
+    args are (message, block). """
+    pass
+
+
 class DataBackend():
     """ Holds BLOBs, never overwrites
     """
@@ -22,13 +30,17 @@ class DataBackend():
             self.cc_latest = get_crypt()(key=encryption_key)
         else:
             self.cc_latest = get_crypt(version=encryption_version)(key=encryption_key)
-        self.cc = {}
+        self._local = threading.local()
 
 
     def _cc_by_version(self, version):
-        if version not in self.cc:
-            self.cc[version] = get_crypt(version=version)(key=self.encryption_key)
-        return self.cc[version]
+        # Each thread has its own crypts, so that threads decrypting at the
+        # same time don't wait for each other's zstandard contexts.
+        if not hasattr(self._local, 'cc'):
+            self._local.cc = {}
+        if version not in self._local.cc:
+            self._local.cc[version] = get_crypt(version=version)(key=self.encryption_key)
+        return self._local.cc[version]
 
 
     def _uid(self):
@@ -85,31 +97,57 @@ class DataBackend():
             return data
 
 
-    def read_get(self, timeout=30):
+    def read_get(self, timeout=30, decrypt=True):
         """ 
         Returns (block, offset, length, data) from the reader threads.
+        With decrypt=False, data is the blob as stored (see decrypt and verify).
+        A failed read is reported once by the read_get which receives it:
+        FileNotFoundError for missing blobs, ReadError otherwise. Both have
+        the block in args[1].
         """
-        if self.last_exception:
-            raise self.last_exception
         block, blob = self._read_data_queue.get(timeout=timeout)
+        if isinstance(blob, Exception):
+            self._read_data_queue.task_done()
+            if isinstance(blob, FileNotFoundError):
+                raise FileNotFoundError('UID {} not found.'.format(block.uid), block) from blob
+            raise ReadError('Reading UID {} failed: {}'.format(block.uid, blob), block) from blob
+
+        if decrypt:
+            data = self.decrypt(block, blob)
+        else:
+            data = blob
 
-        # Important: It's important to call this from the main thread because
+        offset = 0
+        length = len(data)
+        self._read_data_queue.task_done()
+        return block, offset, length, data
+
+
+    def _envelope_key(self, block):
+        if block.enc_envkey:
+            return binascii.unhexlify(block.enc_envkey)
+        return b''
+
+
+    def decrypt(self, block, blob):
+        """ Decrypts and decompresses a stored blob. This can be called from
+        any thread, each thread uses its own crypt (see _cc_by_version). """
         # zstandard IS NOT THREAD SAFE as stated at https://pypi.org/project/zstandard/:
         # """ Unless specified otherwise, assume that no two methods of
         # ZstdCompressor instances can be called from multiple Python threads
         # simultaneously. In other words, assume instances are not thread safe
         # unless stated otherwise."""
         cc = self._cc_by_version(block.enc_version)
-        if block.enc_envkey:
-            envelope_key = binascii.unhexlify(block.enc_envkey)
-        else:
-            envelope_key = b''
-        data = cc.decrypt(blob, envelope_key)
+        return cc.decrypt(blob, self._envelope_key(block))
 
-        offset = 0
-        length = len(data)
-        self._read_data_queue.task_done()
-        return block, offset, length, data
+
+    def verify(self, block, blob):
+        """ Checks a stored blob's authentication tag without decompressing
+        it. Returns True or False, or None for unencrypted blobs which can
+        only be checked by their checksum.
+        """
+        cc = self._cc_by_version(block.enc_version)
+        return cc.verify(blob, self._envelope_key(block))
 
 
     def read_sync(self, block):
@@ -147,6 +185,14 @@ class DataBackend():
         raise NotImplementedError()
 
 
+    def stat_many(self, uids):
+        """ Returns a dict uid: (size, etag) of the stored blobs for all
+        given uids which exist in the data backend, without reading their
+        data. size and etag are None if the backend doesn't provide them.
+        """
+        raise NotImplementedError()
+
+
     def queue_status(self):
         return {
             'rq_filled': self._read_data_queue.qsize() / self._read_data_queue.maxsize,  # 0..1
@@ -104,7 +104,7 @@ class DataBackend(_DataBackend):
             else:
                 t2 = time.time()
                 if callback:
-                    callback(uid, enc_envkey, enc_version, enc_nonce)
+                    callback(uid, enc_envkey, enc_version, enc_nonce, len(data), None)
                 self._write_queue.task_done()
                 #logger.debug('Writer {} wrote data async. uid {} in {:.2f}s (Queue size is {})'.format(id_, uid, t2-t1, self._write_queue.qsize()))
 
@@ -121,9 +121,10 @@ class DataBackend(_DataBackend):
                 self.reader_thread_status[id_] = STATUS_READING
                 data = self.read_raw(block)
                 self.reader_thread_status[id_] = STATUS_NOTHING
-                #except FileNotFoundError:
             except Exception as e:
-                self.last_exception = e
+                self.reader_thread_status[id_] = STATUS_NOTHING
+                self._read_data_queue.put((block, e))  # raised by read_get
+                self._read_queue.task_done()
             else:
                 self._read_data_queue.put((block, data))
                 t2 = time.time()
@@ -191,3 +192,22 @@ class DataBackend(_DataBackend):
                 uid = filename.split('.')[0]
                 matches.append(uid)
         return matches
+
+
+    def stat_many(self, uids):
+        # scan only the directories which contain the requested uids
+        paths = {}
+        for uid in uids:
+            paths.setdefault(self._path(uid), set()).add(uid)
+        found = {}
+        for path, _uids in paths.items():
+            try:
+                entries = os.scandir(os.path.join(self.path, path))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    uid = entry.name[:-len(self.SUFFIX)]
+                    if entry.name.endswith(self.SUFFIX) and uid in _uids:
+                        found[uid] = (entry.stat().st_size, None)
+        return found
@@ -13,9 +13,11 @@ from botocore.handlers import set_list_objects_encoding_type_url
 
 from minio import Minio
 from minio.error import (ResponseError, BucketAlreadyOwnedByYou,
-                         BucketAlreadyExists)
+                         BucketAlreadyExists, NoSuchKey)
 
+from concurrent.futures import ThreadPoolExecutor
 import io
+import itertools
 import os
 import queue
 import random
@@ -30,6 +32,10 @@ class DataBackend(_DataBackend):
 
     WRITE_QUEUE_LENGTH = 20
     READ_QUEUE_LENGTH = 20
+    STAT_LIST_KEYS = 1000
+    # A listing request is priced like about a dozen HEAD requests, so it
+    # has to find at least as many of the wanted blobs to be worth it.
+    STAT_LIST_MIN_HITS = 12
 
     last_exception = None
 
@@ -54,6 +60,7 @@ class DataBackend(_DataBackend):
 
         simultaneous_writes = config.getint('simultaneous_writes', 1)
         simultaneous_reads = config.getint('simultaneous_reads', 1)
+        self.simultaneous_reads = simultaneous_reads
         bandwidth_read = config.getint('bandwidth_read', 0)
         bandwidth_write = config.getint('bandwidth_write', 0)
 
@@ -117,7 +124,7 @@ class DataBackend(_DataBackend):
 
             try:
                 self.writer_thread_status[id_] = STATUS_WRITING
-                client.put_object(self.bucket_name, uid, io.BytesIO(data), len(data))
+                etag = client.put_object(self.bucket_name, uid, io.BytesIO(data), len(data))
                 #client.upload_fileobj(io.BytesIO(data), Key=uid, Bucket=self._bucket_name)
                 self.writer_thread_status[id_] = STATUS_NOTHING
                 #if random.random() > 0.9:
@@ -126,7 +133,7 @@ class DataBackend(_DataBackend):
                 self.last_exception = e
             else:
                 if callback:
-                    callback(uid, enc_envkey, enc_version, enc_nonce)
+                    callback(uid, enc_envkey, enc_version, enc_nonce, len(data), etag.strip('"'))
                 self._write_queue.task_done()
 
 
@@ -135,7 +142,7 @@ class DataBackend(_DataBackend):
         client = None
         while True:
             block = self._read_queue.get()  # contains block
-            if block is None or self.last_exception:
+            if block is None:
                 logger.debug("Reader {} finishing.".format(id_))
                 break
             if client is None:
@@ -145,9 +152,10 @@ class DataBackend(_DataBackend):
                 self.reader_thread_status[id_] = STATUS_READING
                 data = self.read_raw(block, client)
                 self.reader_thread_status[id_] = STATUS_NOTHING
-                #except FileNotFoundError:
             except Exception as e:
-                self.last_exception = e
+                self.reader_thread_status[id_] = STATUS_NOTHING
+                self._read_data_queue.put((block, e))  # raised by read_get
+                self._read_queue.task_done()
             else:
                 self._read_data_queue.put((block, data))
                 t2 = time.time()
@@ -184,3 +192,44 @@ class DataBackend(_DataBackend):
     def get_all_blob_uids(self, prefix=None):
         objects = self.client.list_objects(self.bucket_name, prefix)
         return [o.object_name for o in objects]
+
+
+    def stat_many(self, uids):
+        # See the s3 data backend: list from uid to uid while the listing
+        # finds enough of the uids, stat the rest with a request per uid.
+        uids = sorted(set(uids))
+        found = {}
+        i = 0
+        while i < len(uids):
+            objects = list(itertools.islice(self.client.list_objects_v2(
+                self.bucket_name,
+                recursive=True,
+                start_after=uids[i][:-1],  # sorts right before uids[i]
+                ), self.STAT_LIST_KEYS))
+            listed = {o.object_name: (o.size, o.etag.strip('"')) for o in objects}
+            last_key = objects[-1].object_name if len(objects) == self.STAT_LIST_KEYS else None
+            hits = 0
+            while i < len(uids) and (last_key is None or uids[i] <= last_key):
+                if uids[i] in listed:
+                    found[uids[i]] = listed[uids[i]]
+                    hits += 1
+                i += 1
+            if hits < self.STAT_LIST_MIN_HITS:
+                break
+        found.update(self._stat_each(uids[i:]))
+        return found
+
+
+    def _stat_each(self, uids):
+        """ Returns a dict uid: (size, etag) for all given uids which exist,
+        with a stat request per uid and simultaneous_reads requests at a time.
+        """
+        def _stat(uid):
+            try:
+                o = self.client.stat_object(self.bucket_name, uid)
+            except NoSuchKey:
+                return uid, None
+            return uid, (o.size, o.etag.strip('"'))
+
+        with ThreadPoolExecutor(self.simultaneous_reads) as executor:
+            return {uid: stat for uid, stat in executor.map(_stat, uids) if stat is not None}
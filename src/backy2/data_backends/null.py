@@ -88,7 +88,7 @@ class DataBackend(_DataBackend):
                 t2 = time.time()
                 # assert r == len(data)
                 if callback:
-                    callback(uid, enc_envkey, enc_version, enc_nonce)
+                    callback(uid, enc_envkey, enc_version, enc_nonce, len(data), None)
                 self._write_queue.task_done()
                 #logger.debug('Writer {} wrote data async. uid {} in {:.2f}s (Queue size is {})'.format(id_, uid, t2-t1, self._write_queue.qsize()))
                 #if random.random() > 0.9:
@@ -99,7 +99,7 @@ class DataBackend(_DataBackend):
         """ A threaded background reader """
         while True:
             block = self._read_queue.get()  # contains block
-            if block is None or self.last_exception:
+            if block is None:
                 logger.debug("Reader {} finishing.".format(id_))
                 break
             t1 = time.time()
@@ -108,7 +108,9 @@ class DataBackend(_DataBackend):
                 data = self.read_raw(block)
                 self.reader_thread_status[id_] = STATUS_THROTTLING
             except Exception as e:
-                self.last_exception = e
+                self.reader_thread_status[id_] = STATUS_NOTHING
+                self._read_data_queue.put((block, e))  # raised by read_get
+                self._read_queue.task_done()
             else:
                 time.sleep(self.read_throttling.consume(len(data)))
                 self.reader_thread_status[id_] = STATUS_NOTHING
@@ -170,3 +172,8 @@ class DataBackend(_DataBackend):
 
     def get_all_blob_uids(self, prefix=None):
         return []
+
+
+    def stat_many(self, uids):
+        # Every blob can be read from here, but nothing is known about it.
+        return {uid: (None, None) for uid in uids}
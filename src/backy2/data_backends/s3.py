@@ -9,6 +9,7 @@ import boto3
 from botocore.client import Config as BotoCoreClientConfig
 from botocore.exceptions import ClientError
 from botocore.handlers import set_list_objects_encoding_type_url
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 #import io
 import os
@@ -32,6 +33,10 @@ class DataBackend(_DataBackend):
 
     WRITE_QUEUE_LENGTH = 20
     READ_QUEUE_LENGTH = 20
+    STAT_LIST_KEYS = 1000
+    # A listing request is priced like about a dozen HEAD requests, so it
+    # has to find at least as many of the wanted blobs to be worth it.
+    STAT_LIST_MIN_HITS = 12
 
     last_exception = None
 
@@ -59,6 +64,7 @@ class DataBackend(_DataBackend):
 
         simultaneous_writes = config.getint('simultaneous_writes', 1)
         simultaneous_reads = config.getint('simultaneous_reads', 1)
+        self.simultaneous_reads = simultaneous_reads
         bandwidth_read = config.getint('bandwidth_read', 0)
         bandwidth_write = config.getint('bandwidth_write', 0)
 
@@ -161,7 +167,7 @@ class DataBackend(_DataBackend):
 
             try:
                 self.writer_thread_status[id_] = STATUS_WRITING
-                client.put_object(Body=data, Key=uid, Bucket=self._bucket_name)
+                response = client.put_object(Body=data, Key=uid, Bucket=self._bucket_name)
                 #client.upload_fileobj(io.BytesIO(data), Key=uid, Bucket=self._bucket_name)
                 self.writer_thread_status[id_] = STATUS_NOTHING
                 #if random.random() > 0.9:
@@ -170,7 +176,7 @@ class DataBackend(_DataBackend):
                 self.last_exception = e
             else:
                 if callback:
-                    callback(uid, enc_envkey, enc_version, enc_nonce)
+                    callback(uid, enc_envkey, enc_version, enc_nonce, len(data), response['ETag'].strip('"'))
                 self._write_queue.task_done()
 
 
@@ -179,7 +185,7 @@ class DataBackend(_DataBackend):
         bucket = None
         while True:
             block = self._read_queue.get()  # contains block
-            if block is None or self.last_exception:
+            if block is None:
                 logger.debug("Reader {} finishing.".format(id_))
                 break
             if bucket is None:
@@ -189,9 +195,10 @@ class DataBackend(_DataBackend):
                 self.reader_thread_status[id_] = STATUS_READING
                 data = self.read_raw(block, bucket)
                 self.reader_thread_status[id_] = STATUS_NOTHING
-                #except FileNotFoundError:
             except Exception as e:
-                self.last_exception = e
+                self.reader_thread_status[id_] = STATUS_NOTHING
+                self._read_data_queue.put((block, e))  # raised by read_get
+                self._read_queue.task_done()
             else:
                 self._read_data_queue.put((block, data))
                 t2 = time.time()
@@ -278,3 +285,52 @@ class DataBackend(_DataBackend):
 
         return [o.key for o in objects_iterable]
 
+
+    def stat_many(self, uids):
+        # A listing request returns up to 1000 objects with their size and
+        # etag. Starting each listing at the next wanted uid skips the parts
+        # of the bucket in between, so this is cheaper than a HEAD request per
+        # blob as long as the uids are dense in the bucket. When a listing
+        # finds only a few of them, the rest is fetched by HEAD requests.
+        uids = sorted(set(uids))
+        found = {}
+        client = self._get_client()
+        i = 0
+        while i < len(uids):
+            response = client.list_objects_v2(
+                Bucket=self._bucket_name,
+                StartAfter=uids[i][:-1],  # sorts right before uids[i]
+                MaxKeys=self.STAT_LIST_KEYS,
+                )
+            contents = response.get('Contents', [])
+            listed = {o['Key']: (o['Size'], o['ETag'].strip('"')) for o in contents}
+            last_key = contents[-1]['Key'] if response.get('IsTruncated') else None
+            hits = 0
+            while i < len(uids) and (last_key is None or uids[i] <= last_key):
+                if uids[i] in listed:
+                    found[uids[i]] = listed[uids[i]]
+                    hits += 1
+                i += 1
+            if hits < self.STAT_LIST_MIN_HITS:
+                break
+        found.update(self._head_many(uids[i:]))
+        return found
+
+
+    def _head_many(self, uids):
+        """ Returns a dict uid: (size, etag) for all given uids which exist,
+        with a HEAD request per uid and simultaneous_reads requests at a time.
+        """
+        client = self._get_client()  # boto3 clients are thread safe
+
+        def _head(uid):
+            try:
+                response = client.head_object(Bucket=self._bucket_name, Key=uid)
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchKey' or e.response['Error']['Code'] == '404':
+                    return uid, None
+                raise
+            return uid, (response['ContentLength'], response['ETag'].strip('"'))
+
+        with ThreadPoolExecutor(self.simultaneous_reads) as executor:
+            return {uid: stat for uid, stat in executor.map(_head, uids) if stat is not None}
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+""" Reads and writes the metadata of a version as created by backy2 export.
+
+The binary format starts with MAGIC and a format version byte, followed by
+a zstandard stream of records. Each record is its length (uint32) followed
+by its type and fields, all little endian:
+
+    V  the version as json
+    B  a block: id, date (us since the epoch), size, valid, enc_version and
+       then uid, checksum, enc_envkey and enc_nonce as binary strings, each
+       prefixed with its length (0xffff for None)
+    E  the number of blocks, so that truncated dumps are detected
+
+The CSV formats of earlier versions can still be read.
+"""
+
+from backy2.meta_backends import DereferencedBlock
+import binascii
+import csv
+import datetime
+import io
+import json
+import struct
+
+MAGIC = b'backy2 binary metadata dump\n'
+FORMAT_VERSION = 1
+
+CSV_VERSION = '2.12'
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+CHUNK_SIZE = 1024 * 1024
+
+_length = struct.Struct('<I')
+_block = struct.Struct('<cqqQBB')
+_field_length = struct.Struct('<H')
+_end = struct.Struct('<cq')
+
+_NONE = 0xffff
+
+
+def _ts(dt):
+    if dt is None:
+        return None
+    if not isinstance(dt, datetime.datetime):
+        dt = datetime.datetime.combine(dt, datetime.time())
+    return (dt - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _dt(ts):
+    if ts is None:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=ts)
+
+
+def _field(value):
+    if value is None:
+        return _field_length.pack(_NONE)
+    return _field_length.pack(len(value)) + value
+
+
+def _unhexlify(value):
+    return binascii.unhexlify(value) if value else None
+
+
+def _hexlify(value):
+    return binascii.hexlify(value).decode('ascii') if value is not None else None
+
+
+def write(f, version, blocks):
+    """ Writes the binary dump of a version and its dereferenced blocks to
+    the binary file f. """
+    import zstandard  # see crypt.py
+    compressor = zstandard.ZstdCompressor().compressobj()
+    f.write(MAGIC + bytes([FORMAT_VERSION]))
+    buf = bytearray()
+
+    def record(data):
+        buf.extend(_length.pack(len(data)))
+        buf.extend(data)
+
+    record(b'V' + json.dumps({
+        'uid': version.uid,
+        'date': _ts(version.date),
+        'name': version.name,
+        'snapshot_name': version.snapshot_name,
+        'size': version.size,
+        'size_bytes': version.size_bytes,
+        'valid': version.valid,
+        'protected': version.protected,
+        'expire': _ts(version.expire),
+        }).encode('utf-8'))
+    num_blocks = 0
+    for block in blocks:
+        record(_block.pack(b'B', block.id, _ts(block.date), block.size, block.valid, block.enc_version) +
+            _field(block.uid.encode('ascii') if block.uid is not None else None) +
+            _field(_unhexlify(block.checksum)) +
+            _field(_unhexlify(block.enc_envkey)) +
+            _field(_unhexlify(block.enc_nonce)))
+        num_blocks += 1
+        if len(buf) >= CHUNK_SIZE:
+            f.write(compressor.compress(bytes(buf)))
+            buf.clear()
+    record(_end.pack(b'E', num_blocks))
+    f.write(compressor.compress(bytes(buf)))
+    f.write(compressor.flush())
+
+
+def _records(f):
+    import zstandard  # see crypt.py
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    buf = bytearray()
+    offset = 0
+    while True:
+        data = f.read(CHUNK_SIZE)
+        if not data:
+            break
+        del buf[:offset]
+        offset = 0
+        buf.extend(decompressor.decompress(data))
+        while offset + _length.size <= len(buf):
+            length, = _length.unpack_from(buf, offset)
+            if offset + _length.size + length > len(buf):
+                break
+            yield bytes(buf[offset + _length.size:offset + _length.size + length])
+            offset += _length.size + length
+    if offset != len(buf):
+        raise ValueError('Incomplete metadata dump.')
+
+
+def _read_blocks(version_uid, records):
+    num_blocks = 0
+    for data in records:
+        if data[:1] == b'E':
+            if _end.unpack(data)[1] != num_blocks:
+                raise ValueError('Incomplete metadata dump.')
+            return
+        if data[:1] != b'B':
+            raise ValueError('Unknown record in metadata dump.')
+        _, id, date, size, valid, enc_version = _block.unpack_from(data)
+        offset = _block.size
+        fields = []
+        for i in range(4):
+            length, = _field_length.unpack_from(data, offset)
+            offset += _field_length.size
+            if length == _NONE:
+                fields.append(None)
+            else:
+                fields.append(data[offset:offset + length])
+                offset += length
+        uid, checksum, enc_envkey, enc_nonce = fields
+        yield DereferencedBlock(
+            uid.decode('ascii') if uid is not None else None,
+            version_uid,
+            id,
+            _dt(date),
+            _hexlify(checksum),
+            size,
+            valid,
+            _hexlify(enc_envkey),
+            enc_version,
+            _hexlify(enc_nonce),
+            )
+        num_blocks += 1
+    raise ValueError('Incomplete metadata dump.')
+
+
+def read(f):
+    """ Reads a binary dump from the binary file f. Returns the version as
+    dict and an iterator of its dereferenced blocks, which raises
+    ValueError when the dump is incomplete. """
+    header = f.read(len(MAGIC) + 1)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError('Wrong import format.')
+    if header[len(MAGIC):] != bytes([FORMAT_VERSION]):
+        raise ValueError('Unknown metadata dump format {}.'.format(header[len(MAGIC):]))
+    records = _records(f)
+    data = next(records, b'')
+    if data[:1] != b'V':
+        raise ValueError('Incomplete metadata dump.')
+    version = json.loads(data[1:].decode('utf-8'))
+    version['date'] = _dt(version['date'])
+    version['expire'] = _dt(version['expire'])
+    return version, _read_blocks(version['uid'], records)
+
+
+def write_csv(f, version, blocks):
+    """ Writes the metadata of a version in the CSV format to the text file f. """
+    _csv = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    _csv.writerow(['backy2 Version {} metadata dump'.format(CSV_VERSION)])
+    _csv.writerow([
+        version.uid,
+        version.date.strftime('%Y-%m-%d %H:%M:%S'),
+        version.name,
+        version.snapshot_name,
+        version.size,
+        version.size_bytes,
+        version.valid,
+        version.protected,
+        version.expire.strftime('%Y-%m-%d') if version.expire else '',
+        ])
+    for block in blocks:
+        _csv.writerow([
+            block.uid,
+            block.version_uid,
+            block.id,
+            block.date.strftime('%Y-%m-%d %H:%M:%S'),
+            block.checksum,
+            block.size,
+            block.valid,
+            block.enc_version,
+            block.enc_envkey,
+            block.enc_nonce,
+            ])
+
+
+def read_csv(f):
+    """ Reads the CSV format of any backy2 version from the text file f.
+    Returns the same as read. """
+    _csv = csv.reader(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    signature = next(_csv, [''])
+    # the number of version fields of each format
+    formats = {
+        'backy2 Version 2.1 metadata dump': 6,
+        'backy2 Version 2.2 metadata dump': 8,
+        'backy2 Version 2.10 metadata dump': 9,
+        'backy2 Version 2.12 metadata dump': 9,
+        }
+    if signature[0] not in formats:
+        raise ValueError('Wrong import format.')
+    row = next(_csv)
+    if formats[signature[0]] == 6:
+        # no snapshot_name, protected and expire
+        row = row[:3] + [''] + row[3:] + [0, '']
+    elif formats[signature[0]] == 8:
+        row = row + ['']  # no expire
+    uid, date, name, snapshot_name, size, size_bytes, valid, protected, expire = row
+    version = {
+        'uid': uid,
+        'date': datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
+        'name': name,
+        'snapshot_name': snapshot_name,
+        'size': int(size),
+        'size_bytes': int(size_bytes),
+        'valid': int(valid),
+        'protected': int(protected),
+        'expire': datetime.datetime.strptime(expire, '%Y-%m-%d') if expire else None,
+        }
+    return version, _read_csv_blocks(_csv)
+
+
+def _read_csv_blocks(_csv):
+    for row in _csv:
+        if len(row) == 7:
+            row = row + [0, '', '']  # unencrypted
+        uid, version_uid, id, date, checksum, size, valid, enc_version, enc_envkey, enc_nonce = row
+        yield DereferencedBlock(
+            uid or None,
+            version_uid,
+            int(id),
+            datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
+            checksum or None,
+            int(size),
+            int(valid),
+            enc_envkey or None,
+            int(enc_version),
+            enc_nonce if enc_nonce not in ('', '\\x') else None,  # csv None is \x
+            )
+
+
+def load(f):
+    """ Reads a dump in any format from f, which may be a text file (only
+    CSV) or a binary file. Returns the same as read. """
+    if isinstance(f, io.TextIOBase):
+        return read_csv(f)
+    if not hasattr(f, 'peek'):
+        f = io.BufferedReader(f)
+    if f.peek(len(MAGIC))[:len(MAGIC)] == MAGIC:
+        return read(f)
+    return read_csv(io.TextIOWrapper(f))
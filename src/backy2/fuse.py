@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 import logging
 
+from backy2.blockreader import TemporaryBlockStore, VersionBlocks
+from backy2.logging import logger
 from collections import defaultdict
-from errno import ENOENT; ENOATTR = 93
-from functools import lru_cache
+from errno import EIO, ENOENT; ENOATTR = 93
 try:
     from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 except ModuleNotFoundError:
@@ -14,7 +15,6 @@ from threading import Lock
 import io
 import os
 import re
-import tempfile
 import time
 
 r_by_version_uid = r'\/by_version_uid\/([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})/data'
@@ -120,107 +120,167 @@ class Tree:
         self.create(path, self.dir(date=date), True)
 
 
-
-class TemporaryBlockStore:
-    def __init__(self, cachedir):
-        self._lock = Lock()
-        self.tempfile = tempfile.TemporaryFile(prefix='backy2cow', suffix='.img', dir=cachedir)
-        self.db = {}  # key is block_id, value is (offset, length)
-        self.offset = 0  # next write offset
-
-
-    def has_block(self, block_id):
-        return block_id in self.db
-
-
-    def write_block(self, block_id, data):
-        with self._lock:
-            self.tempfile.seek(self.offset)
-            self.tempfile.write(data)
-            self.db[block_id] = (self.offset, len(data))
-            self.offset += len(data)
-
-
-    def patch_block(self, block_id, data, offset):
-        tempfile_block_offset, tempfile_block_length = self.db[block_id]  # raise if it's not in there b/c that's a programming error.
-        assert offset + len(data) <= tempfile_block_length  # don't write beyond block boundaries
-        with self._lock:
-            self.tempfile.seek(tempfile_block_offset + offset)
-            self.tempfile.write(data)
-        return len(data)
+    def remove(self, path):
+        name = path.split('/')[-1]
+        parent_path = os.path.realpath(os.path.join(path, '..'))
+        del self.get_path(parent_path)['children'][name]
 
 
-    def read_block(self, block_id):
-        tempfile_block_offset, tempfile_block_length = self.db[block_id]  # raise if it's not in there b/c that's a programming error.
-        with self._lock:
-            self.tempfile.seek(tempfile_block_offset)
-            return self.tempfile.read(tempfile_block_length)
+    def copy(self):
+        """ Returns a copy whose directories can be changed without changing
+        this tree. Files are shared. """
+        def _copy(node):
+            if 'children' not in node:
+                return node
+            return dict(node, children={name: _copy(child) for name, child in node['children'].items()})
+        tree = Tree()
+        tree.tree = _copy(self.tree)
+        tree.data = self.data
+        return tree
 
 
 
 class BackyFuse(LoggingMixIn, Operations):
+    TREE_MAX_AGE = 10  # seconds until the tree is compared to the meta backend again
+    READAHEAD_BLOCKS = 8  # blocks to prefetch after sequential reads
+
     def __init__(self, backy, cachedir):
         self.backy = backy
 
         self.fd = 0
-        self.tree = self._tree()
-        self.fd_versions = {}  # version data per filehandle kept in RAM
-        self.fd_blocks = {}  # block data per filehandle kept in RAM
-        self._lock = Lock()
+        self.fd_versions = {}  # version uid per filehandle
+        self.fd_blocks = {}  # VersionBlocks per filehandle kept in RAM
+        self.fd_last_block = {}  # last block id read per filehandle
+        self._version_blocks = {}  # VersionBlocks per opened version uid
+        self._lock = Lock()  # the meta backend isn't thread safe
+        self._cow_lock = Lock()
+        self.block_reader = backy.get_block_reader()
+        self._sparse_block = bytes(self.backy.block_size)  # shared by all sparse reads
         self._temporary_block_store = {}
         self.cachedir = cachedir
 
+        self.tree = Tree()
+        self.tree.mkdir('/by_version_uid')
+        self.tree.mkdir('/by_name')
+        self._tree_versions = {}  # version uid: _version_state of the version in the tree
+        self._update_tree()
+
 
     def _tree(self):
-        tree = Tree()
-        tree.mkdir('/by_version_uid')
-        tree.mkdir('/by_name')
-
-        for version in self.backy.meta_backend.get_versions():
-            version_uid_path = os.path.join('/', 'by_version_uid', version.uid)
-            tree.mkdir(version_uid_path, date=version.date)
-
-            # add files to the version_uid_path:
-            _data_path = os.path.join(version_uid_path, 'data')
-            tree.create(_data_path, tree.file(size=version.size_bytes, date=version.date))
-            _name_path = os.path.join(version_uid_path, 'name')
-            tree.create(_name_path, tree.file(size=len(version.name), date=version.date), data=version.name.encode('utf-8'))
-            _expire_path = os.path.join(version_uid_path, 'expire')
-            _expire_data = version.expire.isoformat() if version.expire else ''
-            tree.create(_expire_path, tree.file(size=len(_expire_data), date=version.date), data=_expire_data.encode('utf-8'))
-            _snapshot_name_path = os.path.join(version_uid_path, 'snapshot_name')
-            tree.create(_snapshot_name_path, tree.file(size=len(version.snapshot_name), date=version.date), data=version.snapshot_name.encode('utf-8'))
-            if version.valid:
-                _valid_path = os.path.join(version_uid_path, 'valid')
-                tree.create(_valid_path, tree.file(size=5, date=version.date), data=b'valid')
-            else:
-                _invalid_path = os.path.join(version_uid_path, 'invalid')
-                tree.create(_invalid_path, tree.file(size=7, date=version.date), data=b'invalid')
-            if version.protected:
-                _protected_path = os.path.join(version_uid_path, 'protected')
-                tree.create(_protected_path, tree.file(size=9, date=version.date), data=b'protected')
-            _tags_path = os.path.join(version_uid_path, 'tags')
-            _tags_data = ",".join([t.name for t in version.tags])
-            tree.create(_tags_path, tree.file(size=len(_tags_data), date=version.date), data=_tags_data)
-
-            name_path = os.path.join('/', 'by_name', version.name)
+        """ Returns the tree. If it's older than TREE_MAX_AGE, it's updated
+        first unless the meta backend is busy, so this never waits. The
+        returned tree is never changed, so it can be walked without a lock.
+        """
+        if time.time() - self._tree_time > self.TREE_MAX_AGE and self._lock.acquire(blocking=False):
             try:
-                tree.mkdir(name_path)
-            except FileExistsError:
-                pass
-            version_uid_path2 = os.path.join('/', 'by_name', version.name, version.uid)
-            symlink_target = os.path.join('..', '..', 'by_version_uid', version.uid)
-            tree.create(version_uid_path2, tree.symlink(date=version.date), data=symlink_target)
+                self._update_tree()
+            finally:
+                self._lock.release()
+        return self.tree
+
+
+    def _version_state(self, version):
+        return (version.name, version.snapshot_name, version.size_bytes, version.date,
+            version.expire, version.valid, version.protected, tuple(t.name for t in version.tags))
+
+
+    def _update_tree(self):
+        """ Updates the tree to the versions in the meta backend. Only
+        versions which have been added, removed or changed are touched, in a
+        copy of the tree which then replaces the tree. Must be called with
+        self._lock held. """
+        self.backy.meta_backend.refresh()  # see changes of other processes
+        versions = dict((version.uid, version) for version in self.backy.ls())
+        removed = set(uid for uid, state in self._tree_versions.items()
+            if uid not in versions or self._version_state(versions[uid]) != state)
+        added = [version for uid, version in versions.items()
+            if uid not in self._tree_versions or uid in removed]
+        if removed or added:
+            tree = self.tree.copy()
+            for uid in removed:
+                self._remove_version(tree, uid)
+            for version in added:
+                self._add_version(tree, version)
+            self.tree = tree
+        self._tree_time = time.time()
+
+
+    def _add_version(self, tree, version):
+        version_uid_path = os.path.join('/', 'by_version_uid', version.uid)
+        tree.mkdir(version_uid_path, date=version.date)
+
+        # add files to the version_uid_path:
+        _data_path = os.path.join(version_uid_path, 'data')
+        tree.create(_data_path, tree.file(size=version.size_bytes, date=version.date))
+        _name_path = os.path.join(version_uid_path, 'name')
+        tree.create(_name_path, tree.file(size=len(version.name), date=version.date), data=version.name.encode('utf-8'))
+        _expire_path = os.path.join(version_uid_path, 'expire')
+        _expire_data = version.expire.isoformat() if version.expire else ''
+        tree.create(_expire_path, tree.file(size=len(_expire_data), date=version.date), data=_expire_data.encode('utf-8'))
+        _snapshot_name_path = os.path.join(version_uid_path, 'snapshot_name')
+        tree.create(_snapshot_name_path, tree.file(size=len(version.snapshot_name), date=version.date), data=version.snapshot_name.encode('utf-8'))
+        if version.valid:
+            _valid_path = os.path.join(version_uid_path, 'valid')
+            tree.create(_valid_path, tree.file(size=5, date=version.date), data=b'valid')
+        else:
+            _invalid_path = os.path.join(version_uid_path, 'invalid')
+            tree.create(_invalid_path, tree.file(size=7, date=version.date), data=b'invalid')
+        if version.protected:
+            _protected_path = os.path.join(version_uid_path, 'protected')
+            tree.create(_protected_path, tree.file(size=9, date=version.date), data=b'protected')
+        _tags_path = os.path.join(version_uid_path, 'tags')
+        _tags_data = ",".join([t.name for t in version.tags])
+        tree.create(_tags_path, tree.file(size=len(_tags_data), date=version.date), data=_tags_data.encode('utf-8'))
+
+        name_path = os.path.join('/', 'by_name', version.name)
+        try:
+            tree.mkdir(name_path)
+        except FileExistsError:
+            pass
+        version_uid_path2 = os.path.join('/', 'by_name', version.name, version.uid)
+        symlink_target = os.path.join('..', '..', 'by_version_uid', version.uid)
+        tree.create(version_uid_path2, tree.symlink(date=version.date), data=symlink_target)
+        self._tree_versions[version.uid] = self._version_state(version)
 
-        return tree
+
+    def _remove_version(self, tree, uid):
+        name = self._tree_versions.pop(uid)[0]
+        tree.remove(os.path.join('/', 'by_version_uid', uid))
+        name_path = os.path.join('/', 'by_name', name)
+        tree.remove(os.path.join(name_path, uid))
+        if not tree.get_path(name_path)['children']:
+            tree.remove(name_path)
 
 
-    @lru_cache(maxsize=128)  # 128*4MB = 512MB RAM / block buffer
     def _read(self, fh, block_id):
-        block = self.fd_blocks[fh].filter_by(id=block_id).one()
-        if block.uid is None or block.uid == '':  # sparse block ('' because of old defective inputs, in a perfect world this is always None)
-            return b'\x00' * self.backy.block_size
-        return self.backy.data_backend.read_sync(block)
+        try:
+            block = self.fd_blocks[fh].get(block_id)
+        except KeyError as e:
+            logger.error(e.args[0])
+            raise FuseOSError(EIO)
+        if block is None:  # sparse block
+            return self._sparse_block
+        try:
+            return self.block_reader.read(block)
+        except Exception:  # logged by the block reader
+            raise FuseOSError(EIO)
+
+
+    def _readahead(self, fh, first_block_id, last_block_id):
+        """ Prefetches the next READAHEAD_BLOCKS blocks if the file handle
+        is read sequentially. """
+        previous_block_id = self.fd_last_block.get(fh)
+        self.fd_last_block[fh] = last_block_id
+        if previous_block_id is None or not previous_block_id <= first_block_id <= previous_block_id + 1:
+            return
+        version_blocks = self.fd_blocks[fh]
+        for block_id in range(last_block_id + 1, min(last_block_id + 1 + self.READAHEAD_BLOCKS, len(version_blocks))):
+            try:
+                block = version_blocks.get(block_id)
+            except KeyError:
+                continue
+            if block is not None:
+                self.block_reader.fetch(block)
 
 
     def getattr(self, path, fh=None):
@@ -232,20 +292,29 @@ class BackyFuse(LoggingMixIn, Operations):
 
 
     def open(self, path, flags):
-        self.fd += 1
-        #print("Opened", path, self.fd)
-        match = re.match(r_by_version_uid, path)
-        if match:
-            uid = match.group(1)
-            self.fd_versions[self.fd] = self.backy.meta_backend.get_version(uid)
-            self.fd_blocks[self.fd] = self.backy.meta_backend.get_blocks_by_version(uid)
-        return self.fd
+        with self._lock:
+            self.fd += 1
+            fd = self.fd
+            #print("Opened", path, fd)
+            match = re.match(r_by_version_uid, path)
+            if match:
+                uid = match.group(1)
+                if uid not in self._version_blocks:
+                    self._version_blocks[uid] = VersionBlocks.load(self.backy.meta_backend, uid)
+                self.fd_blocks[fd] = self._version_blocks[uid]
+                self.fd_versions[fd] = uid
+        return fd
 
 
     def release(self, path, fh):
         #print("Released", path, fh)
-        if fh in self.fd_versions:
-            del(self.fd_versions[fh])
+        with self._lock:
+            if fh in self.fd_versions:
+                uid = self.fd_versions.pop(fh)
+                del(self.fd_blocks[fh])
+                self.fd_last_block.pop(fh, None)
+                if uid not in self.fd_versions.values():
+                    del(self._version_blocks[uid])
 
 
     def read(self, path, size, offset, fh):
@@ -253,17 +322,17 @@ class BackyFuse(LoggingMixIn, Operations):
         if fh in self.fd_versions:
             tbs = self.get_tempoprary_block_store(path)
             _block_list = block_list(offset, size, self.backy.block_size)
-            _data = b''
+            self._readahead(fh, _block_list[0][0], _block_list[-1][0])
+            _data = []
             for block_id, offset, length in _block_list:
-                if block_id >= self.fd_versions[fh].size:
+                if block_id >= len(self.fd_blocks[fh]):
                     continue  # reading beyond end of file. cp does this. Return b'' for such blocks.
                 if tbs.has_block(block_id):
-                    _data += tbs.read_block(block_id)[offset:offset+length]
+                    _data.append(tbs.read_block(block_id)[offset:offset+length])
                 else:
-                    with self._lock:  # Or lru_cache will be useless until the given block has arrived
-                        _data += self._read(fh, block_id)[offset:offset+length]
+                    _data.append(memoryview(self._read(fh, block_id))[offset:offset+length])
             #assert len(_data) == size  # 'cat' reads more bytes. Seems to be normal.
-            return _data
+            return b''.join(_data)
         else:
             try:
                 p = self._tree().get_path(path)
@@ -277,7 +346,6 @@ class BackyFuse(LoggingMixIn, Operations):
 
 
     def readdir(self, path, fh):
-        p = self._tree().get_path(path)
         paths = ['.', '..'] + list(self._tree().get_path(path)['children'].keys())
         return paths
 
@@ -287,6 +355,25 @@ class BackyFuse(LoggingMixIn, Operations):
         return p['data']
 
 
+    def destroy(self, path):
+        self.block_reader.close()
+
+
+    def commit(self):
+        """ Saves the changes of each written data file as a new version.
+        Returns a dict version_uid: new version_uid. """
+        changes = {}
+        for path, tbs in self._temporary_block_store.items():
+            if not tbs.db:
+                continue  # only read
+            uid = re.match(r_by_version_uid, path).group(1)
+            changes[uid] = tbs.blocks()
+        if not changes:
+            logger.info('No changes to commit.')
+            return {}
+        return self.backy.commit_blocks(changes)
+
+
     def statfs(self, path):
         return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
 
@@ -310,8 +397,8 @@ class BackyFuse(LoggingMixIn, Operations):
         # create copy-on-write blocks in self.tempfile
         _block_list = block_list(offset, len(data), self.backy.block_size)
         for block_id, block_offset, length in _block_list:
-            if not tbs.has_block(block_id):
-                with self._lock:  # Or lru_cache will be useless until the given block has arrived
+            with self._cow_lock:  # or concurrent writes to a new block would overwrite each other
+                if not tbs.has_block(block_id):
                     tbs.write_block(block_id, self._read(fh, block_id))
             # patch them at offset, length
             #print("patch block_id {} (global offset {}), block offset {}, length {}".format(
@@ -328,7 +415,10 @@ class BackyFuse(LoggingMixIn, Operations):
 
 
 
-def get_fuse(backy, mount, cachedir='/tmp'):
+def get_fuse(backy, mount, cachedir='/tmp', commit=False):
     #logging.basicConfig(level=logging.DEBUG)
-    fuse = FUSE(BackyFuse(backy, cachedir), mount, foreground=True, allow_other=True)
+    backy_fuse = BackyFuse(backy, cachedir)
+    fuse = FUSE(backy_fuse, mount, foreground=True, allow_other=True)
+    if commit:
+        backy_fuse.commit()
 
@@ -22,19 +22,28 @@ class IO():
         raise NotImplementedError()
 
 
+    def target_size(self, io_name):
+        """ Return the size in bytes of the restore target io_name or None
+        if it doesn't exist. The io doesn't need to be opened for this.
+        """
+        raise NotImplementedError()
+
+
     def read(self, block, sync=False):
         """ Add a read job for a Block """
         raise NotImplementedError()
 
 
-    def get(self):
+    def get(self, block=True):
         """ Get the result of a read job, however this is not specific
-        to which job. It just gets one. """
+        to which job. It just gets one. If block is False, raises
+        queue.Empty when no result is available. """
         raise NotImplementedError()
 
 
-    def write(self, block, data):
-        """ Writes data to the given block
+    def write(self, block, data, callback=None, offset=None):
+        """ Writes data to the given block. If offset is given, data is
+        written to this byte offset instead of the block's position.
         """
         raise NotImplementedError()
 
@@ -107,6 +107,17 @@ class IO(_IO):
         return source_size
 
 
+    def target_size(self, io_name):
+        _s = re.match('^file://(.+)$', io_name)
+        if not _s:
+            raise RuntimeError('Not a valid io name: {} . Need a file path, e.g. file:///somepath/file'.format(io_name))
+        try:
+            with open(_s.groups()[0], 'rb') as f:
+                return f.seek(0, 2)  # also works for devices
+        except FileNotFoundError:
+            return None
+
+
     def _writer(self, id_):
         """ self._write_queue contains a list of (Block, data) to be written.
         """
@@ -117,9 +128,10 @@ class IO(_IO):
                     logger.debug("IO writer {} finishing.".format(id_))
                     self._write_queue.task_done()
                     break
-                block, data, callback = entry
+                block, data, callback, offset = entry
 
-                offset = block.id * self.block_size
+                if offset is None:
+                    offset = block.id * self.block_size
 
                 self.writer_thread_status[id_] = STATUS_SEEKING
                 _write_file.seek(offset)
@@ -182,15 +194,15 @@ class IO(_IO):
             return data
 
 
-    def get(self):
-        d = self._outqueue.get()
+    def get(self, block=True):
+        d = self._outqueue.get(block=block)
         self._outqueue.task_done()
         return d
 
 
-    def write(self, block, data, callback=None):
+    def write(self, block, data, callback=None, offset=None):
         """ Adds a write job"""
-        self._write_queue.put((block, data, callback))
+        self._write_queue.put((block, data, callback, offset))
 
 
     def queue_status(self):
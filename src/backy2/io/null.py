@@ -90,6 +90,10 @@ class IO(_IO):
         return self._size
 
 
+    def target_size(self, io_name):
+        return None  # nothing is kept
+
+
     def _writer(self, id_):
         """ self._write_queue contains a list of (Block, data) to be written.
         """
@@ -98,7 +102,7 @@ class IO(_IO):
             if entry is None:
                 logger.debug("IO writer {} finishing.".format(id_))
                 break
-            block, data, callback = entry
+            block, data, callback, offset = entry
 
             self.writer_thread_status[id_] = STATUS_WRITING
             # write nothing
@@ -151,14 +155,14 @@ class IO(_IO):
             return data
 
 
-    def get(self):
-        d = self._outqueue.get()
+    def get(self, block=True):
+        d = self._outqueue.get(block=block)
         self._outqueue.task_done()
         return d
 
 
-    def write(self, block, data, callback=None):
-        self._write_queue.put((block, data, callback))
+    def write(self, block, data, callback=None, offset=None):
+        self._write_queue.put((block, data, callback, offset))
 
 
     def queue_status(self):
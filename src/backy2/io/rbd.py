@@ -133,6 +133,19 @@ class IO(_IO):
         return size
 
 
+    def target_size(self, io_name):
+        img_name = re.match('^rbd://([^/]+)/([^@]+)$', io_name)
+        if not img_name:
+            raise RuntimeError('Not a valid io name: {} . Need pool/imagename'.format(io_name))
+        pool_name, image_name = img_name.groups()
+        try:
+            ioctx = self.cluster.open_ioctx(pool_name)
+            with rbd.Image(ioctx, image_name, read_only=True) as image:
+                return image.size()
+        except (rados.ObjectNotFound, rbd.ImageNotFound):
+            return None
+
+
     def _writer(self, id_):
         """ self._write_queue contains a list of (Block, data) to be written.
         """
@@ -141,9 +154,10 @@ class IO(_IO):
             if entry is None:
                 logger.debug("IO writer {} finishing.".format(id_))
                 break
-            block, data, callback = entry
+            block, data, callback, offset = entry
 
-            offset = block.id * self.block_size
+            if offset is None:
+                offset = block.id * self.block_size
             self.writer_thread_status[id_] = STATUS_WRITING
             written = self._write_rbd.write(data, offset, rados.LIBRADOS_OP_FLAG_FADVISE_DONTNEED)
             assert written == len(data)
@@ -196,16 +210,16 @@ class IO(_IO):
             return data
 
 
-    def get(self):
-        d = self._outqueue.get()
+    def get(self, block=True):
+        d = self._outqueue.get(block=block)
         self._outqueue.task_done()
         return d
 
 
-    def write(self, block, data, callback=None):
+    def write(self, block, data, callback=None, offset=None):
         if not self._write_rbd:
             raise RuntimeError('RBD image not open / available.')
-        self._write_queue.put((block, data, callback))
+        self._write_queue.put((block, data, callback, offset))
 
 
     def queue_status(self):
@@ -10,6 +10,13 @@ else:
 import sys
 
 
+class LockError(Exception):
+    def __init__(self, value):
+        self.value = value
+    def __str__(self):
+        return repr(self.value)
+
+
 class Locking:
     """ implements name-based locking """
     lock_dir = None
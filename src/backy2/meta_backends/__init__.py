@@ -1,6 +1,42 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+class DereferencedBlock():
+    """ A block detached from the meta backend, so that it can be passed
+    around between threads. These are created for every block of a version
+    on restores and scrubs, so they only have slots.
+    """
+    __slots__ = ('uid', 'version_uid', 'id', 'date', 'checksum', 'size', 'valid', 'enc_envkey', 'enc_version', 'enc_nonce')
+
+    def __init__(self, uid, version_uid, id, date, checksum, size, valid, enc_envkey, enc_version, enc_nonce):
+        self.uid = uid
+        self.version_uid = version_uid
+        self.id = id
+        self.date = date
+        self.checksum = checksum
+        self.size = size
+        self.valid = valid
+        self.enc_envkey = enc_envkey
+        self.enc_version = enc_version
+        self.enc_nonce = enc_nonce
+
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+    def __eq__(self, other):
+        return isinstance(other, DereferencedBlock) and self._values() == other._values()
+
+
+    def __hash__(self):
+        return hash(self._values())
+
+
+    def __repr__(self):
+        return 'Block({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
 class MetaBackend():
     """ Holds meta data """
 
@@ -15,6 +51,13 @@ class MetaBackend():
         raise NotImplementedError()
 
 
+    def copy_version(self, from_version_uid, version_name, snapshot_name=''):
+        """ Copies a version with all its blocks to a new version with the
+        given name and snapshot_name. Returns the new version's uid.
+        """
+        raise NotImplementedError()
+
+
     def set_stats(self, version_uid, version_name, version_size_bytes,
             version_size_blocks, bytes_read, blocks_read, bytes_written,
             blocks_written, bytes_found_dedup, blocks_found_dedup,
@@ -54,8 +97,10 @@ class MetaBackend():
         raise NotImplementedError()
 
 
-    def get_versions(self):
-        """ Returns a list of all versions """
+    def get_versions(self, name=None, snapshot_name=None, tag=None, expired=False, valid=None):
+        """ Returns a list of all versions sorted by name and date with their
+        tags loaded. Only versions matching all given filters are returned.
+        """
         raise NotImplementedError()
 
 
@@ -101,11 +146,72 @@ class MetaBackend():
         raise NotImplementedError()
 
 
+    def get_num_blocks_by_version(self, version_uid):
+        """ Returns the number of blocks of a version. It's incomplete if
+        this is less than its size. """
+        raise NotImplementedError()
+
+
+    def get_block_map(self, version_uid):
+        """ Returns the blob ids of all blocks of a version as array indexed
+        by block id. Blocks with the same blob id have the same content.
+        """
+        raise NotImplementedError()
+
+
+    def get_scrub_candidates(self, older_than, exclude_version_uids=()):
+        """ Yields one block per blob which has not been scrubbed since
+        older_than (datetime), except blobs which are only referenced by
+        excluded versions.
+        """
+        raise NotImplementedError()
+
+
+    def set_blob_scrubbed(self, uid, valid, _commit=True):
+        """ Records the result and time of a blob's scrub """
+        raise NotImplementedError()
+
+
+    def set_blob(self, uid, size, etag, _commit=True):
+        """ Records a blob's stored size and etag (None if the data backend
+        doesn't provide one) as reported by the data backend.
+        """
+        raise NotImplementedError()
+
+
+    def get_blobs(self, uids):
+        """ Returns a dict uid: (size, etag) for the given blob uids which
+        have been recorded.
+        """
+        raise NotImplementedError()
+
+
+    def get_versions_scrub_state(self, version_uids):
+        """ Returns a dict version_uid: (invalid_blobs, unscrubbed_blobs)
+        from the recorded blob scrubs.
+        """
+        raise NotImplementedError()
+
+
+    def get_version_sketches(self, version_uids):
+        """ Returns a dict version_uid: KMVSketch of the blobs of the given
+        versions for approximate space analytics.
+        """
+        raise NotImplementedError()
+
+
     def rm_version(self, version_uid):
         """ Remove a version from the meta data store """
         raise NotImplementedError()
 
 
+    def rm_versions(self, version_uids):
+        """ Remove many versions from the meta data store in batches.
+        Returns the number of removed blocks.
+        """
+        raise NotImplementedError()
+
+
     def get_delete_candidates(self, dt=3600):
         raise NotImplementedError()
 
@@ -115,14 +221,25 @@ class MetaBackend():
         raise NotImplementedError()
 
 
-    def export(self, f):
+    def export(self, version_uid, f, as_csv=False):
+        """ Writes the metadata of a version to the binary file f (see
+        backy2.dump) or, with as_csv, in the old CSV format to the text file f.
+        """
         raise NotImplementedError()
 
 
     def import_(self, f):
+        """ Imports a version from a binary or text file f written by export
+        in any format. Nothing is imported if that fails. """
         raise NotImplementedError()
 
 
+    def refresh(self):
+        """ Makes the changes of other processes visible, e.g. before a long
+        running process lists the versions again. """
+        pass
+
+
     def close(self):
         pass
 
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from array import array
+from backy2 import blockmap
+from backy2.locking import LockError
+from backy2.logging import logger
+from backy2.meta_backends import memory
+from backy2.meta_backends.memory import Stats, _ts
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+
+
+class MetaBackend(memory.MetaBackend):
+    """ Stores meta data in local files without a database server.
+
+    Everything but the blocks is kept in memory and each change is appended
+    to a log (meta.log), which is replayed when opening and compacted when
+    it has grown to several times its live records. The blocks of each
+    version are appended to their own block map file as (id, blob id)
+    pairs, which is packed with backy2.blockmap when the version is
+    complete. Many processes can read the meta backend at the same time,
+    while one process at a time can change it. A process which changes it
+    must have loaded the latest state (see refresh).
+    """
+
+    LOG_NAME = 'meta.log'
+    COMPACT_MIN_RECORDS = 10000
+    LOCK_TIMEOUT = 10  # seconds
+
+    def __init__(self, config):
+        memory.MetaBackend.__init__(self, config)
+        self.path = config.get('path')
+
+
+    def _log_path(self):
+        return os.path.join(self.path, self.LOG_NAME)
+
+
+    def _map_path(self, version_uid, packed=False):
+        return os.path.join(self.path, 'maps', version_uid + ('.packed' if packed else ''))
+
+
+    def open(self):
+        if not os.path.exists(self._log_path()):
+            logger.error('Invalid meta backend path ({}). Please run initdb first.'.format(self.path))
+            sys.exit(1)  # same as the sql meta backend
+        # The lock is shared while loading and taken exclusively by the first
+        # change, which keeps it until close (see _lock_exclusive). Readers
+        # don't keep it, so that they don't hold up a backup. Nobody waits
+        # for a writer, as a backup may hold the lock for hours.
+        self._lock_file = open(os.path.join(self.path, 'lock'), 'w')
+        self._exclusive = False
+        if not self._flock(fcntl.LOCK_SH):
+            self._lock_file.close()
+            raise LockError('The meta backend {} is being changed by another backy2 process.'.format(self.path))
+
+        self._init_state()
+        self._pending_log = []
+        self._pending_maps = {}  # version_uid: array of (id, blob id) pairs
+
+        num_records = self._load()
+        if num_records > max(self.COMPACT_MIN_RECORDS, 2 * self._num_live_records()) and self._flock(fcntl.LOCK_EX):
+            self._compact()
+        self._log_stat = self._stat_log()
+        self._log = open(self._log_path(), 'a')
+        self._flock(fcntl.LOCK_UN)
+        return self
+
+
+    def refresh(self):
+        """ Reloads the meta backend if another process has changed it since
+        it was loaded. Keeps the loaded state while it is being changed. """
+        if self._exclusive or self._stat_log() == self._log_stat:
+            return
+        if not self._flock(fcntl.LOCK_SH):
+            return
+        try:
+            self._init_state()
+            self._load()
+            self._log_stat = self._stat_log()
+            self._log.close()
+            self._log = open(self._log_path(), 'a')  # compacting replaces the log
+        finally:
+            self._flock(fcntl.LOCK_UN)
+
+
+    def _flock(self, operation):
+        """ Returns False instead of waiting if the lock is held by another
+        process. Converting a lock releases it first, so after a failed
+        conversion the lock isn't held at all. """
+        try:
+            fcntl.flock(self._lock_file, operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+
+    def _stat_log(self):
+        stat = os.stat(self._log_path())
+        return (stat.st_ino, stat.st_size)  # compacting replaces the log
+
+
+    def _lock_exclusive(self):
+        """ Takes the lock exclusively before the first change. Waits up to
+        LOCK_TIMEOUT seconds for processes which are loading the meta backend.
+        Fails while another process is changing it or when it has been
+        changed since it was loaded. """
+        if self._exclusive:
+            return
+        t1 = time.time()
+        while not self._flock(fcntl.LOCK_EX):
+            if time.time() - t1 > self.LOCK_TIMEOUT:
+                raise LockError('The meta backend {} is being changed by another backy2 process.'.format(self.path))
+            time.sleep(.1)
+        if self._stat_log() != self._log_stat:
+            self._flock(fcntl.LOCK_UN)
+            raise LockError('The meta backend {} has been changed by another backy2 process.'.format(self.path))
+        self._exclusive = True
+
+
+    def initdb(self):
+        os.makedirs(os.path.join(self.path, 'maps'), exist_ok=True)
+        # like the sql meta backend, this will raise when it's initialized
+        with open(self._log_path(), 'x'):
+            pass
+
+
+    def _load(self):
+        """ Replays the log. A record which has only been partly written
+        is cut off. Returns the number of records (each blob uid of a
+        record about many blobs counts). """
+        num_records = 0
+        with open(self._log_path(), 'rb+') as f:
+            offset = 0
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Incomplete record')
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('Cutting off an incomplete record at the end of {}.'.format(self._log_path()))
+                    f.truncate(offset)
+                    break
+                self._apply(record)
+                num_records += len(record[1]) if record[0] in ('rb', 'd', 'rd') else 1
+                offset += len(line)
+        return num_records
+
+
+    def _num_live_records(self):
+        return len(self._versions) + len(self._blobs) + len(self._scrubs) + \
+            sum(len(times) for times in self._deleted.values()) + len(self._stats)
+
+
+    def _live_records(self):
+        for version in self._versions.values():
+            yield self._version_record(version)
+        for blob in self._blobs.values():
+            yield self._blob_record(blob)
+        for uid, (last_scrubbed, valid) in self._scrubs.items():
+            yield ['s', uid, last_scrubbed, valid]
+        for uid, times in self._deleted.items():
+            for _time in times:
+                yield ['d', [uid], _time]
+        for stats in self._stats:
+            yield ['st', dict((name, getattr(stats, name)) for name in Stats.FIELDS if name != 'date'), _ts(stats.date)]
+
+
+    def _compact(self):
+        """ Rewrites the log with only the live records """
+        t1 = time.time()
+        tmp_path = self._log_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in self._live_records():
+                f.write(json.dumps(record))
+                f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._log_path())
+        self._fsync_dir(self.path)
+        # block maps of versions whose removal has been logged
+        for name in os.listdir(os.path.join(self.path, 'maps')):
+            if name.split('.')[0] not in self._versions:
+                os.remove(os.path.join(self.path, 'maps', name))
+        logger.debug('Compacted meta backend log in {:.2f}s'.format(time.time() - t1))
+
+
+    def _fsync_dir(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+    def _write(self, record):
+        """ Applies a change and queues it for the log """
+        self._lock_exclusive()
+        self._apply(record)
+        self._pending_log.append(json.dumps(record))
+
+
+
+    def _flush(self):
+        """ Writes the queued changes, the log first so that block maps
+        never reference unknown blobs. """
+        if self._pending_log:
+            self._log.write('\n'.join(self._pending_log))
+            self._log.write('\n')
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._pending_log = []
+        for version_uid, pairs in self._pending_maps.items():
+            if sys.byteorder == 'big':
+                pairs.byteswap()
+            with open(self._map_path(version_uid), 'ab') as f:
+                f.write(pairs.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self._pending_maps = {}
+
+
+    def _commit(self):
+        self._flush()
+
+
+    def _load_map(self, version_uid):
+        """ Returns the blob ids of a version's blocks indexed by block id.
+        Missing blocks of incomplete versions are -1. The pairs which
+        haven't been flushed yet are merged in, so reads don't fsync. """
+        try:
+            with open(self._map_path(version_uid, packed=True), 'rb') as f:
+                return blockmap.unpack(f.read())
+        except FileNotFoundError:
+            pass
+        pairs = array('q')
+        try:
+            with open(self._map_path(version_uid), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        pairs.frombytes(data[:len(data) // 16 * 16])  # a pair may be incomplete after a crash
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        pairs.extend(self._pending_maps.get(version_uid, ()))  # these are newer
+        blob_ids = array('q')
+        _iter = iter(pairs)
+        for id, blob_id in zip(_iter, _iter):
+            if blob_id not in self._blobs:
+                continue  # its blob hasn't been logged
+            if id >= len(blob_ids):
+                blob_ids.extend([-1] * (id + 1 - len(blob_ids)))
+            blob_ids[id] = blob_id
+        return blob_ids
+
+
+    def _pack_map(self, version_uid):
+        """ Packs the block map of a complete version """
+        if os.path.exists(self._map_path(version_uid, packed=True)):
+            return
+        self._flush()  # the log and the pairs are written before the packed map
+        blob_ids = self._load_map(version_uid)
+        if len(blob_ids) != self._versions[version_uid].size or -1 in blob_ids:
+            return  # incomplete
+        self._write_file(self._map_path(version_uid, packed=True), blockmap.pack(blob_ids))
+        os.remove(self._map_path(version_uid))
+        logger.debug('Packed block map of version {}'.format(version_uid))
+
+
+    def _unpack_map(self, version_uid):
+        """ Turns a packed block map back into pairs, so that blocks can be
+        appended """
+        packed_path = self._map_path(version_uid, packed=True)
+        if not os.path.exists(packed_path):
+            return
+        blob_ids = self._load_map(version_uid)
+        pairs = array('q')
+        for id, blob_id in enumerate(blob_ids):
+            pairs.extend((id, blob_id))
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        self._write_file(self._map_path(version_uid), pairs.tobytes())
+        os.remove(packed_path)
+
+
+    def _write_file(self, path, data):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._fsync_dir(os.path.dirname(path))
+
+
+    def _add_block(self, version_uid, id, blob_id):
+        self._lock_exclusive()
+        if version_uid not in self._pending_maps:
+            self._unpack_map(version_uid)  # blocks are added to a complete version
+            self._pending_maps[version_uid] = array('q')
+        self._pending_maps[version_uid].extend((id, blob_id))
+        return None  # the replaced blob id would need the whole map
+
+
+    def _copy_map(self, from_version_uid, version_uid):
+        self._lock_exclusive()
+        self._flush()
+        for packed in (False, True):
+            if os.path.exists(self._map_path(from_version_uid, packed)):
+                shutil.copyfile(self._map_path(from_version_uid, packed), self._map_path(version_uid, packed))
+
+
+    def _remove_map(self, version_uid):
+        self._lock_exclusive()
+        for packed in (False, True):
+            if os.path.exists(self._map_path(version_uid, packed)):
+                os.remove(self._map_path(version_uid, packed))
+
+
+    def get_num_blocks_by_version(self, version_uid):
+        block_map = self._load_map(version_uid)
+        if isinstance(block_map, blockmap.BlockMap):
+            return len(block_map)
+        return len(block_map) - block_map.count(-1)
+
+
+    def close(self):
+        self._flush()
+        self._log.close()
+        self._lock_file.close()  # releases the lock
@@ -0,0 +1,820 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+from array import array
+from backy2 import dump
+from backy2.logging import logger
+from backy2.meta_backends import DereferencedBlock, MetaBackend as _MetaBackend
+from backy2.sketch import KMVSketch
+from collections import Counter
+import datetime
+import time
+import uuid
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _ts(dt):
+    """ Dates are logged as microseconds since the epoch """
+    if dt is None:
+        return None
+    if not isinstance(dt, datetime.datetime):
+        dt = datetime.datetime.combine(dt, datetime.time())
+    return (dt - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _dt(ts):
+    if ts is None:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=ts)
+
+
+def inttime():
+    return int(time.time())
+
+
+class Version():
+    """ A version as returned by get_version(s) """
+
+    def __init__(self, uid, date, expire, name, snapshot_name, size, size_bytes, valid, protected, tags):
+        self.uid = uid
+        self.date = date
+        self.expire = expire
+        self.name = name
+        self.snapshot_name = snapshot_name
+        self.size = size
+        self.size_bytes = size_bytes
+        self.valid = valid
+        self.protected = protected
+        self.tags = tags
+
+
+    def __repr__(self):
+       return "<Version(uid='%s', name='%s', snapshot_name='%s', date='%s')>" % (
+                            self.uid, self.name, self.snapshot_name, self.date)
+
+
+class Tag():
+
+    def __init__(self, version_uid, name):
+        self.version_uid = version_uid
+        self.name = name
+
+
+    def __repr__(self):
+       return "<Tag(version_uid='%s', name='%s')>" % (
+                            self.version_uid, self.name)
+
+
+class Stats():
+
+    FIELDS = ('date', 'version_uid', 'version_name', 'version_size_bytes',
+        'version_size_blocks', 'bytes_read', 'blocks_read', 'bytes_written',
+        'blocks_written', 'bytes_found_dedup', 'blocks_found_dedup',
+        'bytes_sparse', 'blocks_sparse', 'duration_seconds')
+    metadata = None  # listed by backy2 stats
+
+    def __init__(self, **kwargs):
+        for name in self.FIELDS:
+            setattr(self, name, kwargs[name])
+
+
+class Blob():
+    """ A blob in the data backend with everything which is the same for all
+    blocks referencing it. Sparse blocks reference a blob with uid None of
+    their size. """
+    __slots__ = ('id', 'uid', 'date', 'checksum', 'size', 'valid', 'enc_version', 'enc_envkey', 'enc_nonce', 'stored_size', 'etag')
+
+    def __init__(self, id, uid, date, checksum, size, valid, enc_version, enc_envkey, enc_nonce, stored_size, etag):
+        self.id = id
+        self.uid = uid
+        self.date = date
+        self.checksum = checksum
+        self.size = size
+        self.valid = valid
+        self.enc_version = enc_version
+        self.enc_envkey = enc_envkey
+        self.enc_nonce = enc_nonce
+        self.stored_size = stored_size
+        self.etag = etag
+
+
+    def __repr__(self):
+       return "<Blob(id='%s', uid='%s', stored_size='%s', etag='%s')>" % (
+                            self.id, self.uid, self.stored_size, self.etag)
+
+
+_databases = {}  # name: state of closed meta backends
+
+
+class MetaBackend(_MetaBackend):
+    """ A MetaBackend for performance testing. It keeps all meta data in
+    dicts and arrays in memory, so everything is lost when the process ends.
+    DO NOT USE IN PRODUCTION.
+    A closed meta backend keeps its data until initdb is called, so it can be
+    opened again by name within the same process.
+    """
+
+    def __init__(self, config):
+        _MetaBackend.__init__(self)
+        self.name = config.get('name', 'backy2')
+
+
+    def _init_state(self):
+        self._versions = {}  # uid: Version
+        self._blobs = {}  # id: Blob
+        self._blob_ids = {}  # uid (or (None, size) for sparse blobs): blob id
+        self._checksums = {}  # checksum: blob id or tuple of blob ids
+        self._scrubs = {}  # blob uid: (last_scrubbed, valid)
+        self._deleted = {}  # blob uid: list of times
+        self._stats = []
+        self._maps = {}  # version_uid: array of blob ids indexed by block id
+        self._next_blob_id = 1
+        self._blob_versions = None  # see _get_blob_versions
+
+
+    def open(self):
+        self._init_state()
+        self.__dict__.update(_databases.get(self.name, {}))
+        return self
+
+
+    def initdb(self):
+        _databases.pop(self.name, None)
+
+
+    def _write(self, record):
+        """ Applies a change """
+        self._apply(record)
+
+
+    def _apply(self, record):
+        """ Applies a change record [op, args...]. The ops are b (blob),
+        v (version), rv (remove version), rb (remove blobs), s (scrub),
+        d (deleted blobs), rd (remove deleted blobs) and st (stats). """
+        op = record[0]
+        # most records are blobs
+        if op == 'b':
+            blob = self._blobs.get(record[1])
+            if blob is None:
+                blob = Blob(*record[1:])
+                blob.date = _dt(blob.date)
+                self._blobs[blob.id] = blob
+                self._blob_ids[blob.uid if blob.uid is not None else (None, blob.size)] = blob.id
+                if blob.checksum:
+                    self._add_checksum(blob.checksum, blob.id)
+                self._next_blob_id = max(self._next_blob_id, blob.id + 1)
+            else:
+                blob.valid, blob.enc_envkey, blob.stored_size, blob.etag = record[6], record[8], record[10], record[11]
+        elif op == 'v':
+            uid, date, expire, name, snapshot_name, size, size_bytes, valid, protected, tags = record[1:]
+            version = self._versions.get(uid)
+            if version is None:
+                version = self._versions[uid] = Version(uid, _dt(date), None, name, snapshot_name, size, size_bytes, valid, protected, [])
+            version.expire = _dt(expire)
+            version.name = name
+            version.snapshot_name = snapshot_name
+            version.valid = valid
+            version.protected = protected
+            version.tags = [Tag(uid, tag) for tag in tags]
+        elif op == 'rv':
+            del self._versions[record[1]]
+        elif op == 'rb':
+            for uid in record[1]:
+                self._scrubs.pop(uid, None)
+                self._deleted.pop(uid, None)
+                blob_id = self._blob_ids.pop(uid, None)
+                if blob_id is not None:
+                    blob = self._blobs.pop(blob_id)
+                    if blob.checksum:
+                        self._remove_checksum(blob.checksum, blob_id)
+        elif op == 's':
+            self._scrubs[record[1]] = (record[2], record[3])
+        elif op == 'd':
+            for uid in record[1]:
+                self._deleted.setdefault(uid, []).append(record[2])
+        elif op == 'rd':
+            uids, before = record[1:]
+            for uid in uids:
+                times = [_time for _time in self._deleted.get(uid, ()) if _time >= before]
+                if times:
+                    self._deleted[uid] = times
+                else:
+                    self._deleted.pop(uid, None)
+        elif op == 'st':
+            self._stats.append(Stats(date=_dt(record[2]), **record[1]))
+        else:
+            raise ValueError('Unknown record {}.'.format(op))
+
+
+    def _add_checksum(self, checksum, blob_id):
+        # The dedup index. Mostly there's one blob per checksum, so keep
+        # the id without a container.
+        blob_ids = self._checksums.get(checksum)
+        if blob_ids is None:
+            self._checksums[checksum] = blob_id
+        elif isinstance(blob_ids, tuple):
+            self._checksums[checksum] = blob_ids + (blob_id, )
+        else:
+            self._checksums[checksum] = (blob_ids, blob_id)
+
+
+    def _remove_checksum(self, checksum, blob_id):
+        blob_ids = self._checksums.pop(checksum)
+        if isinstance(blob_ids, tuple):
+            blob_ids = tuple(_blob_id for _blob_id in blob_ids if _blob_id != blob_id)
+            self._checksums[checksum] = blob_ids[0] if len(blob_ids) == 1 else blob_ids
+
+
+    def _version_record(self, version):
+        return ['v', version.uid, _ts(version.date), _ts(version.expire), version.name,
+            version.snapshot_name, version.size, version.size_bytes, version.valid,
+            version.protected, [tag.name for tag in version.tags]]
+
+
+    def _blob_record(self, blob):
+        return ['b', blob.id, blob.uid, _ts(blob.date), blob.checksum, blob.size, blob.valid,
+            blob.enc_version, blob.enc_envkey, blob.enc_nonce, blob.stored_size, blob.etag]
+
+
+    def _write_version(self, version, _commit=True):
+        self._write(self._version_record(version))
+        if _commit:
+            self._commit()
+
+
+    def _commit(self):
+        pass
+
+
+    def _uid(self):
+        return str(uuid.uuid1())
+
+
+    def _load_map(self, version_uid):
+        """ Returns the blob ids of a version's blocks indexed by block id.
+        Missing blocks of incomplete versions are -1. """
+        return self._maps.get(version_uid, array('q'))
+
+
+    def _add_block(self, version_uid, id, blob_id):
+        """ Sets a block. Returns the blob id it referenced before (-1 for
+        none) or None if that's unknown. """
+        blob_ids = self._maps.setdefault(version_uid, array('q'))
+        if id == len(blob_ids):
+            blob_ids.append(blob_id)
+            return -1
+        if id > len(blob_ids):
+            blob_ids.extend([-1] * (id - len(blob_ids)))
+            blob_ids.append(blob_id)
+            return -1
+        old_blob_id = blob_ids[id]
+        blob_ids[id] = blob_id
+        return old_blob_id
+
+
+    def _copy_map(self, from_version_uid, version_uid):
+        self._maps[version_uid] = array('q', self._load_map(from_version_uid))
+
+
+    def _remove_map(self, version_uid):
+        self._maps.pop(version_uid, None)
+
+
+    def _pack_map(self, version_uid):
+        """ Called when a version is complete """
+        pass
+
+
+
+    def _get_blob_versions(self):
+        """ Returns the reverse index of the block maps, blob id: Counter
+        version_uid: number of the version's blocks referencing the blob.
+        It's built from all block maps when it's needed first and then kept
+        up to date by the changes. """
+        if self._blob_versions is None:
+            blob_versions = {}
+            for version_uid in self._versions:
+                for blob_id, k in Counter(self._load_map(version_uid)).items():
+                    if blob_id != -1:
+                        blob_versions.setdefault(blob_id, Counter())[version_uid] = k
+            self._blob_versions = blob_versions
+        return self._blob_versions
+
+
+    def _index_blocks(self, version_uid, counts):
+        """ Adds counts (Counter blob id: number of blocks, negative to
+        remove them) of version_uid to the reverse index if it's built. """
+        if self._blob_versions is None:
+            return
+        for blob_id, k in counts.items():
+            if blob_id == -1:
+                continue
+            versions = self._blob_versions.setdefault(blob_id, Counter())
+            versions[version_uid] += k
+            if versions[version_uid] <= 0:
+                del versions[version_uid]
+                if not versions:
+                    del self._blob_versions[blob_id]
+
+
+    def set_version(self, version_name, snapshot_name, size, size_bytes, valid, protected=0):
+        uid = self._uid()
+        version = Version(
+            uid=uid,
+            date=datetime.datetime.utcnow(),
+            expire=None,
+            name=version_name,
+            snapshot_name=snapshot_name,
+            size=size,
+            size_bytes=size_bytes,
+            valid=valid,
+            protected=protected,
+            tags=[],
+            )
+        self._write_version(version)
+        return uid
+
+
+    def copy_version(self, from_version_uid, version_name, snapshot_name=''):
+        """ Copy version to a new uid and name, snapshot_name.
+        """
+        old_version = self.get_version(from_version_uid)
+        new_version_uid = self.set_version(version_name, snapshot_name, old_version.size, old_version.size_bytes, 0)
+        logger.info('Copying version...')
+        self._copy_map(from_version_uid, new_version_uid)
+        if self._blob_versions is not None:
+            self._index_blocks(new_version_uid, Counter(self._load_map(new_version_uid)))
+        new_version = self.get_version(new_version_uid)
+        new_version.valid = old_version.valid
+        self._write_version(new_version)
+        logger.info('Done copying version...')
+        return new_version_uid
+
+
+    def du(self, version_uid):
+        blob_versions = self._get_blob_versions()
+        own = Counter(self._load_map(version_uid))
+        own.pop(-1, None)
+        null_space = 0
+        rows = []
+        for blob_id, k in own.items():
+            blob = self._blobs[blob_id]
+            if blob.uid is None:
+                null_space += blob.size * k
+            else:
+                rows.append((blob.size, k, sum(blob_versions[blob_id].values())))
+        ret = self._space(rows)
+        ret['null_space'] = null_space
+        ret['backy_space'] = round(ret['backy_space'])
+        return ret
+
+
+    def _space(self, rows):
+        """ Calculates the disk usage counters of a version from rows of
+        (blob size, blocks in this version, blocks in all versions) for each
+        of the version's blobs.
+        """
+        real_space = 0
+        dedup_own = 0
+        dedup_others = 0
+        nodedup = 0
+        backy_space = 0
+        space_freed = 0
+        for size, own_shared, shared in rows:
+            real_space += size * own_shared
+            if shared - own_shared:
+                dedup_others += size * own_shared
+            elif own_shared > 1:
+                dedup_own += size * (own_shared - 1)  # 1 is real, the others are dedup'd
+            else:
+                nodedup += size
+            backy_space += size / shared  # partial size
+            if shared == own_shared:  # only in this version
+                space_freed += size
+        return {
+            'real_space': real_space,
+            'null_space': 0,
+            'dedup_own': dedup_own,
+            'dedup_others': dedup_others,
+            'nodedup': nodedup,
+            'backy_space': backy_space,
+            'space_freed': space_freed,
+        }
+
+
+    def get_version_sketches(self, version_uids):
+        """ Returns a dict version_uid: KMVSketch of the given versions """
+        sketches = {}
+        for version_uid in version_uids:
+            blobs = (self._blobs[blob_id] for blob_id in set(self._load_map(version_uid)) if blob_id != -1)
+            sketches[version_uid] = KMVSketch.from_blobs((blob.uid, blob.size) for blob in blobs if blob.uid is not None)
+        return sketches
+
+
+    def set_stats(self, version_uid, version_name, version_size_bytes,
+            version_size_blocks, bytes_read, blocks_read, bytes_written,
+            blocks_written, bytes_found_dedup, blocks_found_dedup,
+            bytes_sparse, blocks_sparse, duration_seconds):
+        self._write(['st', {
+            'version_uid': version_uid,
+            'version_name': version_name,
+            'version_size_bytes': version_size_bytes,
+            'version_size_blocks': version_size_blocks,
+            'bytes_read': bytes_read,
+            'blocks_read': blocks_read,
+            'bytes_written': bytes_written,
+            'blocks_written': blocks_written,
+            'bytes_found_dedup': bytes_found_dedup,
+            'blocks_found_dedup': blocks_found_dedup,
+            'bytes_sparse': bytes_sparse,
+            'blocks_sparse': blocks_sparse,
+            'duration_seconds': int(duration_seconds),
+            }, _ts(datetime.datetime.utcnow())])
+        self._commit()
+
+
+    def get_stats(self, version_uid=None, limit=None):
+        """ gets the <limit> newest entries """
+        if version_uid:
+            if limit is not None and limit < 1:
+                return []
+            return [stats for stats in self._stats if stats.version_uid == version_uid]
+        else:
+            if limit == 0:
+                return []
+            stats = sorted(self._stats, key=lambda stats: stats.date)
+            if limit:
+                stats = stats[-limit:]
+            return stats
+
+
+    def set_version_invalid(self, uid):
+        version = self.get_version(uid)
+        version.valid = 0
+        self._write_version(version)
+        logger.info('Marked version invalid (UID {})'.format(
+            uid,
+            ))
+
+
+    def set_version_valid(self, uid):
+        version = self.get_version(uid)
+        version.valid = 1
+        self._write_version(version)
+        logger.debug('Marked version valid (UID {})'.format(
+            uid,
+            ))
+        self._pack_map(uid)
+
+
+    def get_block_map(self, version_uid):
+        """ Returns the blob ids of all blocks of a version as array indexed
+        by block id. Missing blocks of incomplete versions are -1. """
+        return self._load_map(version_uid)
+
+
+    def get_version(self, uid):
+        version = self._versions.get(uid)
+        if version is None:
+            raise KeyError('Version {} not found.'.format(uid))
+        return version
+
+
+    def protect_version(self, uid):
+        version = self.get_version(uid)
+        version.protected = 1
+        self._write_version(version)
+        logger.debug('Marked version protected (UID {})'.format(
+            uid,
+            ))
+
+
+    def unprotect_version(self, uid):
+        version = self.get_version(uid)
+        version.protected = 0
+        self._write_version(version)
+        logger.debug('Marked version unprotected (UID {})'.format(
+            uid,
+            ))
+
+
+    def get_versions(self, name=None, snapshot_name=None, tag=None, expired=False, valid=None):
+        """ Return versions, must be sorted by date ascending"""
+        versions = self._versions.values()
+        if name is not None:
+            versions = [v for v in versions if v.name == name]
+        if snapshot_name is not None:
+            versions = [v for v in versions if v.snapshot_name == snapshot_name]
+        if tag is not None:
+            versions = [v for v in versions if tag in (t.name for t in v.tags)]
+        if expired:
+            now = datetime.datetime.utcnow()
+            versions = [v for v in versions if v.expire is not None and v.expire < now]
+        if valid is not None:
+            versions = [v for v in versions if v.valid == (1 if valid else 0)]
+        return sorted(versions, key=lambda v: (v.name, v.date))
+
+
+    def add_tag(self, version_uid, name):
+        """ Add a tag to a version_uid, do nothing if the tag already exists.
+        """
+        version = self.get_version(version_uid)
+        if name not in [t.name for t in version.tags]:
+            version.tags.append(Tag(version_uid, name))
+            self._write_version(version, _commit=False)
+
+
+    def remove_tag(self, version_uid, name):
+        version = self.get_version(version_uid)
+        version.tags = [t for t in version.tags if t.name != name]
+        self._write_version(version)
+
+
+    def expire_version(self, version_uid, expire):
+        version = self.get_version(version_uid)
+        version.expire = _dt(_ts(expire))
+        self._write_version(version)
+        logger.debug('Set expire for version (UID {})'.format(
+            version_uid,
+            ))
+
+
+    def set_block(self, id, version_uid, block_uid, checksum, size, valid, enc_envkey=b'', enc_version=0, enc_nonce=None, _commit=True):
+        """ insert a block
+        """
+        self._insert_block(id, version_uid, block_uid, checksum, size, valid,
+            enc_envkey.hex() if enc_envkey else None, enc_version, enc_nonce.hex() if enc_nonce else None)
+        if _commit:
+            self._commit()
+
+
+    def _insert_block(self, id, version_uid, block_uid, checksum, size, valid, enc_envkey=None, enc_version=0, enc_nonce=None, date=None):
+        """ Inserts a block referencing its blob, which is created if it
+        doesn't exist yet. enc_envkey and enc_nonce are hex strings.
+        """
+        valid = 1 if valid else 0
+        blob_id = self._blob_ids.get(block_uid if block_uid is not None else (None, size))
+        if blob_id is None:
+            blob_id = self._next_blob_id
+            self._write(['b', blob_id, block_uid, _ts(date or datetime.datetime.utcnow()), checksum or None,
+                size, valid, enc_version, enc_envkey or None, enc_nonce or None, None, None])
+        elif not valid and block_uid is not None and self._blobs[blob_id].valid:
+            blob = self._blobs[blob_id]
+            blob.valid = 0
+            self._write(self._blob_record(blob))
+        old_blob_id = self._add_block(version_uid, id, blob_id)
+        if old_blob_id is None:
+            self._blob_versions = None  # rebuilt when it's needed
+        elif old_blob_id != blob_id:
+            self._index_blocks(version_uid, {blob_id: 1, old_blob_id: -1})
+
+
+    def set_block_enc_envkey(self, block, enc_envkey):
+        """ Sets the envelope key of a blob returned by get_blocks """
+        block.enc_envkey = enc_envkey.hex()
+        self._write(self._blob_record(block))
+        return block
+
+
+    def set_blocks_invalid(self, uid, checksum):
+        blob_id = self._blob_ids.get(uid)
+        if blob_id is None or self._blobs[blob_id].checksum != checksum:
+            affected_version_uids = []
+        else:
+            blob = self._blobs[blob_id]
+            affected_version_uids = list(self._get_blob_versions().get(blob_id, ()))
+            blob.valid = 0
+            self._write(self._blob_record(blob))
+            self._commit()
+        logger.info('Marked block invalid (UID {}, Checksum {}. Affected versions: {}'.format(
+            uid,
+            checksum,
+            ', '.join(affected_version_uids)
+            ))
+        for version_uid in affected_version_uids:
+            self.set_version_invalid(version_uid)
+        return affected_version_uids
+
+
+    def _deref(self, blob, version_uid, id):
+        return DereferencedBlock(blob.uid, version_uid, id, blob.date, blob.checksum, blob.size, blob.valid, blob.enc_envkey, blob.enc_version, blob.enc_nonce)
+
+
+    def get_block(self, uid):
+        blob_id = self._blob_ids.get(uid)
+        if blob_id is None:
+            return None
+        for version_uid in self._get_blob_versions().get(blob_id, ()):
+            return self._deref(self._blobs[blob_id], version_uid, list(self._load_map(version_uid)).index(blob_id))
+        return None
+
+
+    def get_block_by_checksum(self, checksum, encryption_version):
+        blob_ids = self._checksums.get(checksum)
+        if blob_ids is None:
+            return None
+        for blob_id in (blob_ids if isinstance(blob_ids, tuple) else (blob_ids, )):
+            blob = self._blobs[blob_id]
+            if blob.enc_version == encryption_version and blob.valid:
+                return blob
+        return None
+
+
+    def get_blocks_by_version(self, version_uid):
+        return list(self.get_blocks_by_version_deref(version_uid))
+
+
+    def get_num_blocks_by_version(self, version_uid):
+        block_map = self._load_map(version_uid)
+        return len(block_map) - block_map.count(-1)
+
+
+    def get_blocks_by_version_deref(self, version_uid):
+        blobs = self._blobs
+        for id, blob_id in enumerate(self._load_map(version_uid)):
+            if blob_id != -1:
+                yield self._deref(blobs[blob_id], version_uid, id)
+
+
+    def get_blocks(self):
+        """ Returns all blobs. Blocks share the key of their blob, so these
+        are what needs to be re-keyed. """
+        return sorted(self._blobs.values(), key=lambda blob: blob.id)
+
+
+    def get_scrub_candidates(self, older_than, exclude_version_uids=()):
+        """ Yields one dereferenced block per blob which has not been scrubbed
+        since older_than (datetime). Blobs which are only referenced by
+        excluded versions are not returned.
+        """
+        older_than = _ts(older_than)
+        blob_versions = self._get_blob_versions()
+        first_versions = {}  # version_uid: blob ids for which it's the first version
+        for blob_id, versions in blob_versions.items():
+            blob = self._blobs[blob_id]
+            if blob.uid is None:
+                continue
+            scrub = self._scrubs.get(blob.uid)
+            if scrub is not None and scrub[0] >= older_than:
+                continue
+            version_uids = [version_uid for version_uid in versions if version_uid not in exclude_version_uids]
+            if version_uids:
+                first_versions.setdefault(min(version_uids), set()).add(blob_id)
+        first_blocks = {}  # blob id: (version_uid, id) of a block referencing it
+        for version_uid, blob_ids in first_versions.items():
+            for id, blob_id in enumerate(self._load_map(version_uid)):
+                if blob_id in blob_ids and blob_id not in first_blocks:
+                    first_blocks[blob_id] = (version_uid, id)
+        for blob_id in sorted(first_blocks, key=lambda blob_id: self._blobs[blob_id].uid):
+            yield self._deref(self._blobs[blob_id], *first_blocks[blob_id])
+
+
+    def set_blob_scrubbed(self, uid, valid, _commit=True):
+        """ Records the result of a blob's scrub """
+        self._write(['s', uid, _ts(datetime.datetime.utcnow()), 1 if valid else 0])
+        if _commit:
+            self._commit()
+
+
+    def set_blob(self, uid, size, etag, _commit=True):
+        """ Records the stored size and etag of a blob which has been set
+        with set_block """
+        blob_id = self._blob_ids.get(uid)
+        if blob_id is not None:
+            blob = self._blobs[blob_id]
+            blob.stored_size, blob.etag = size, etag
+            self._write(self._blob_record(blob))
+        if _commit:
+            self._commit()
+
+
+    def get_blobs(self, uids):
+        """ Returns a dict uid: (size, etag) for the given blob uids which
+        have been recorded.
+        """
+        result = {}
+        for uid in uids:
+            blob_id = self._blob_ids.get(uid)
+            if blob_id is not None and self._blobs[blob_id].stored_size is not None:
+                blob = self._blobs[blob_id]
+                result[uid] = (blob.stored_size, blob.etag)
+        return result
+
+
+    def get_versions_scrub_state(self, version_uids):
+        """ Returns a dict version_uid: (invalid_blobs, unscrubbed_blobs)
+        from the recorded blob scrubs.
+        """
+        result = {}
+        for version_uid in version_uids:
+            invalid_blobs = unscrubbed_blobs = 0
+            for blob_id, k in Counter(self._load_map(version_uid)).items():
+                blob = self._blobs.get(blob_id)
+                if blob is None or blob.uid is None:
+                    continue
+                scrub = self._scrubs.get(blob.uid)
+                if scrub is None:
+                    unscrubbed_blobs += k
+                elif not scrub[1]:
+                    invalid_blobs += k
+            result[version_uid] = (invalid_blobs, unscrubbed_blobs)
+        return result
+
+
+    def get_block_ids_by_version(self, version_uid):
+        return [id for id, blob_id in enumerate(self._load_map(version_uid)) if blob_id != -1]
+
+
+    def rm_version(self, version_uid):
+        return self.rm_versions([version_uid])
+
+
+    def rm_versions(self, version_uids):
+        """ Removes versions. Their blobs are recorded as deleted blocks. """
+        num_blocks = 0
+        for version_uid in version_uids:
+            self.get_version(version_uid)  # raise if version not exists
+            own = Counter(self._load_map(version_uid))
+            own.pop(-1, None)
+            num_blocks += sum(own.values())
+            uids = sorted(self._blobs[blob_id].uid for blob_id in own if self._blobs[blob_id].uid is not None)
+            if uids:
+                self._write(['d', uids, inttime()])
+            self._write(['rv', version_uid])
+            self._commit()
+            self._remove_map(version_uid)
+            self._index_blocks(version_uid, Counter({blob_id: -k for blob_id, k in own.items()}))
+        return num_blocks
+
+
+    def cleanup_delete_candidates(self, dt=3600):
+        # Delete false positives:
+        logger.info("Deleting false positives...")
+        before = inttime() - dt
+        blob_versions = self._get_blob_versions()
+        uids = [uid for uid in self._deleted
+            if self._blob_ids.get(uid) in blob_versions and min(self._deleted[uid]) < before]
+        if uids:
+            self._write(['rd', uids, before])
+        logger.info("Deleting false positives: done. Now deleting blocks.")
+        self._commit()
+
+
+    def get_delete_candidates(self, dt=3600):
+        before = inttime() - dt
+        blob_versions = self._get_blob_versions()
+        return [uid for uid, times in self._deleted.items()
+            if self._blob_ids.get(uid) not in blob_versions and min(times) < before]
+
+
+    def del_delete_candidates(self, uids):
+        self._write(['rb', list(uids)])
+        self._commit()
+
+
+    def get_all_block_uids(self, prefix=None):
+        uids = (self._blobs[blob_id].uid for blob_id in self._get_blob_versions())
+        return [uid for uid in uids if uid is not None and (not prefix or uid.startswith(prefix))]
+
+
+    def export(self, version_uid, f, as_csv=False):
+        version = self.get_version(version_uid)
+        blocks = self.get_blocks_by_version_deref(version_uid)
+        if as_csv:
+            dump.write_csv(f, version, blocks)
+        else:
+            dump.write(f, version, blocks)
+
+
+    def import_(self, f):
+        version, blocks = dump.load(f)
+        version_uid = version['uid']
+        if version_uid in self._versions:
+            raise KeyError('Version {} already exists and cannot be imported.'.format(version_uid))
+        self._write_version(Version(tags=[], **version), _commit=False)
+        try:
+            for block in blocks:
+                self._insert_block(
+                    block.id,
+                    version_uid,
+                    block.uid,
+                    block.checksum,
+                    block.size,
+                    block.valid,
+                    block.enc_envkey,
+                    block.enc_version,
+                    block.enc_nonce,
+                    date=block.date,
+                )
+        except:
+            self.rm_version(version_uid)
+            raise
+        self._commit()
+        self._pack_map(version_uid)
+
+
+    def close(self):
+        _databases[self.name] = dict((name, getattr(self, name)) for name in (
+            '_versions', '_blobs', '_blob_ids', '_checksums', '_scrubs',
+            '_deleted', '_stats', '_maps', '_next_blob_id'))
@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
+from array import array
+from backy2 import blockmap, dump
 from backy2.logging import logger
-from backy2.meta_backends import MetaBackend as _MetaBackend
-from collections import namedtuple
-from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey
-from sqlalchemy import func, distinct, desc
+from backy2.meta_backends import DereferencedBlock, MetaBackend as _MetaBackend
+from backy2.sketch import KMVSketch
+from backy2.utils import chunks
+from itertools import islice
+from sqlalchemy import Column, String, Integer, BigInteger, Float, ForeignKey
+from sqlalchemy import func, distinct, desc, case, bindparam, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, query
 from sqlalchemy.sql import text
-from sqlalchemy.types import DateTime, Date
+from sqlalchemy.types import DateTime, Date, LargeBinary
 import binascii
-import csv
 import datetime
+import hashlib
 import os
 import sqlalchemy
 import sys
@@ -19,8 +23,6 @@ import time
 import uuid
 
 
-METADATA_VERSION = '2.12'
-
 DELETE_CANDIDATE_MAYBE = 0
 DELETE_CANDIDATE_SURE = 1
 DELETE_CANDIDATE_DELETED = 2
@@ -80,25 +82,84 @@ class Tag(Base):
                             self.version_uid, self.name)
 
 
-DereferencedBlock = namedtuple('Block', ['uid', 'version_uid', 'id', 'date', 'checksum', 'size', 'valid', 'enc_envkey', 'enc_version', 'enc_nonce'])
-class Block(Base):
-    __tablename__ = 'blocks'
-    uid = Column(String(32), nullable=True, index=True)
-    version_uid = Column(String(36), ForeignKey('versions.uid'), primary_key=True, nullable=False)
-    id = Column(Integer, primary_key=True, nullable=False)
-    date = Column("date", DateTime , default=func.now(), nullable=False)
-    checksum = Column(String(128), index=True, nullable=True)
+class HexBinary(sqlalchemy.types.TypeDecorator):
+    """ Stores hex strings (checksums, keys, nonces) as binary, which halves
+    their size in tables and indexes. Empty strings are stored as NULL.
+    """
+    impl = LargeBinary
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'mysql':
+            # mysql can't index BLOB columns
+            return dialect.type_descriptor(sqlalchemy.types.VARBINARY(self.impl.length))
+        return dialect.type_descriptor(self.impl)
+
+
+    def process_bind_param(self, value, dialect):
+        if not value:
+            return None
+        return binascii.unhexlify(value)
+
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return binascii.hexlify(value).decode('ascii')
+
+
+class Blob(Base):
+    """ A blob in the data backend with everything which is the same for all
+    blocks referencing it. Sparse blocks reference a blob with uid None of
+    their size. stored_size and etag are reported by the data backend when
+    the blob has been written, refcount is the number of blocks of accounted
+    versions (see VersionSpace) which reference it. """
+    __tablename__ = 'blobs'
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    uid = Column(String(32), nullable=True, index=True, unique=True)
+    date = Column("date", DateTime, nullable=False)
+    checksum = Column(HexBinary(64), index=True, nullable=True)
     size = Column(BigInteger, nullable=True)
     valid = Column(Integer, nullable=False)
     enc_version = Column(Integer, nullable=False, default=0)
-    enc_envkey = Column(String(80), nullable=True)
-    enc_nonce = Column(String(32), nullable=True)  # This is doubled here (it's also in blob[:16] for fast rekeying.
-    # hashsum of master key?
+    enc_envkey = Column(HexBinary(40), nullable=True)
+    enc_nonce = Column(HexBinary(16), nullable=True)  # This is doubled here (it's also in blob[:16] for fast rekeying.
+    stored_size = Column(BigInteger, nullable=True)
+    etag = Column(String(64), nullable=True)
+    refcount = Column(Integer, nullable=False, default=0, server_default='0')
+
+    def __repr__(self):
+       return "<Blob(id='%s', uid='%s', stored_size='%s', etag='%s', refcount='%s')>" % (
+                            self.id, self.uid, self.stored_size, self.etag, self.refcount)
+
+
+class BlockMap(Base):
+    """ The blocks of a version, each referencing its blob """
+    __tablename__ = 'blocks'
+    version_uid = Column(String(36), ForeignKey('versions.uid'), primary_key=True, nullable=False)
+    id = Column(Integer, primary_key=True, nullable=False)
+    blob_id = Column(BigInteger().with_variant(Integer, "sqlite"), ForeignKey('blobs.id'), index=True, nullable=False)
+
+
+class Block(Base):
+    """ A block of a version together with its blob's columns. This is
+    read-only, blocks are written through BlockMap and Blob. """
+    __table__ = sqlalchemy.join(BlockMap.__table__, Blob.__table__, BlockMap.__table__.c.blob_id == Blob.__table__.c.id)
+    version_uid = BlockMap.__table__.c.version_uid
+    id = BlockMap.__table__.c.id
+    blob_id = sqlalchemy.orm.column_property(BlockMap.__table__.c.blob_id, Blob.__table__.c.id)
+    uid = Blob.__table__.c.uid
+    date = Blob.__table__.c.date
+    checksum = Blob.__table__.c.checksum
+    size = Blob.__table__.c.size
+    valid = Blob.__table__.c.valid
+    enc_version = Blob.__table__.c.enc_version
+    enc_envkey = Blob.__table__.c.enc_envkey
+    enc_nonce = Blob.__table__.c.enc_nonce
 
 
     def deref(self):
-        """ Dereference this to a namedtuple so that we can pass it around
-        without any thread inconsistencies
+        """ Dereference this to a DereferencedBlock so that we can pass it
+        around without any thread inconsistencies
         """
         return DereferencedBlock(
             uid=self.uid,
@@ -123,6 +184,10 @@ def inttime():
     return int(time.time())
 
 
+def _blocks_partition_name(version_uid):
+    return 'blocks_{}'.format(hashlib.md5(version_uid.encode('utf-8')).hexdigest())
+
+
 class DeletedBlock(Base):
     __tablename__ = 'deleted_blocks'
     id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
@@ -137,15 +202,98 @@ class DeletedBlock(Base):
                             self.id, self.uid)
 
 
+class BlobScrub(Base):
+    """ When a blob has been scrubbed last and with which result """
+    __tablename__ = 'blob_scrubs'
+    uid = Column(String(32), primary_key=True, nullable=False)
+    last_scrubbed = Column(DateTime, nullable=False, index=True)
+    valid = Column(Integer, nullable=False)
+
+    def __repr__(self):
+       return "<BlobScrub(uid='%s', last_scrubbed='%s', valid='%s')>" % (
+                            self.uid, self.last_scrubbed, self.valid)
+
+
+class VersionSpace(Base):
+    """ The disk usage counters of a complete version. They are accounted
+    once and then updated when other versions which share blobs with this
+    version are accounted or removed. """
+    __tablename__ = 'version_space'
+    version_uid = Column(String(36), ForeignKey('versions.uid'), primary_key=True, nullable=False)
+    real_space = Column(BigInteger, nullable=False)
+    null_space = Column(BigInteger, nullable=False)
+    dedup_own = Column(BigInteger, nullable=False)
+    dedup_others = Column(BigInteger, nullable=False)
+    nodedup = Column(BigInteger, nullable=False)
+    backy_space = Column(Float, nullable=False)
+    space_freed = Column(BigInteger, nullable=False)
+    sketch = Column(LargeBinary, nullable=True)  # KMVSketch of the version's blobs
+
+    def __repr__(self):
+       return "<VersionSpace(version_uid='%s', real_space='%s')>" % (
+                            self.version_uid, self.real_space)
+
+
+class PackedBlockMap(Base):
+    """ The blob ids of all blocks of a complete version, packed with
+    backy2.blockmap. The blocks are kept too, this is for reading whole
+    versions without loading one row per block. """
+    __tablename__ = 'packed_block_maps'
+    version_uid = Column(String(36), ForeignKey('versions.uid'), primary_key=True, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    def __repr__(self):
+       return "<PackedBlockMap(version_uid='%s')>" % (self.version_uid)
+
+
+class _Stream:
+    """ Iterates the rows of a streamed result in chunks. buffer() fetches
+    all remaining rows and closes the result. """
+
+    def __init__(self, result, chunk_size=1000):
+        self.result = result
+        self.chunk_size = chunk_size
+        self.rows = []
+
+
+    def buffer(self):
+        if self.result is not None:
+            self.rows.extend(self.result.fetchall())
+            self.close()
+
+
+    def close(self):
+        if self.result is not None:
+            self.result.close()
+            self.result = None
+
+
+    def __iter__(self):
+        while True:
+            if not self.rows:
+                if self.result is None:
+                    return
+                self.rows = self.result.fetchmany(self.chunk_size)
+                if not self.rows:
+                    self.close()
+                    return
+            rows, self.rows = self.rows, []
+            yield from rows
+
+
 class MetaBackend(_MetaBackend):
     """ Stores meta data in an sql database """
 
     FLUSH_EVERY_N_BLOCKS = 1000
+    BLOB_ID_CACHE_SIZE = 100000
+    IMPORT_CHUNK_SIZE = 10000
 
     def __init__(self, config):
         _MetaBackend.__init__(self)
         # engine = sqlalchemy.create_engine(config.get('engine'), echo=True)
         self.engine = sqlalchemy.create_engine(config.get('engine'))
+        self.pack_block_maps = config.getboolean('pack_block_maps', False)
+        self.partition_blocks = config.getboolean('partition_blocks', False)
 
 
     def open(self):
@@ -160,10 +308,30 @@ class MetaBackend(_MetaBackend):
 
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
+        # Results streamed through server side cursors. A commit closes
+        # those, so they're fetched completely before the session commits.
+        self._streams = set()
+        event.listen(self.session, 'before_commit', self._buffer_streams)
         self._flush_block_counter = 0
+        self._blob_ids = {}  # uid (or (None, size) for sparse blobs): blob id
+        self._blocks_partitioned = self._is_blocks_partitioned()
         return self
 
 
+    def _buffer_streams(self, session):
+        for stream in self._streams:
+            stream.buffer()
+
+
+    def _is_blocks_partitioned(self):
+        if self.engine.dialect.name != 'postgresql':
+            return False
+        return self.engine.execute(text("""
+            SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = 'blocks' AND pg_table_is_visible(c.oid)
+            """)).first() is not None
+
+
     def migrate_db(self, engine):
         # migrate the db to the lastest version
         from alembic.config import Config
@@ -171,6 +339,7 @@ class MetaBackend(_MetaBackend):
         alembic_cfg = Config(os.path.join(os.path.dirname(os.path.realpath(__file__)), "sql_migrations", "alembic.ini"))
         with self.engine.begin() as connection:
             alembic_cfg.attributes['connection'] = connection
+            alembic_cfg.attributes['partition_blocks'] = self.partition_blocks
             #command.upgrade(alembic_cfg, "head", sql=True)
             command.upgrade(alembic_cfg, "head")
 
@@ -180,6 +349,20 @@ class MetaBackend(_MetaBackend):
         # Instead, it will raise when something can't be created.
         # TODO: explicitly check if the database is empty
         Base.metadata.create_all(self.engine, checkfirst=False)  # checkfirst False will raise when it finds an existing table
+        if self.partition_blocks and self.engine.dialect.name == 'postgresql':
+            # same layout as migration c4d8e2a7f913 creates
+            with self.engine.begin() as connection:
+                BlockMap.__table__.drop(connection)
+                connection.execute("""
+                    CREATE TABLE blocks (
+                        version_uid VARCHAR(36) NOT NULL REFERENCES versions (uid),
+                        id INTEGER NOT NULL,
+                        blob_id BIGINT NOT NULL REFERENCES blobs (id),
+                        PRIMARY KEY (version_uid, id)
+                    ) PARTITION BY LIST (version_uid)
+                    """)
+                connection.execute('CREATE TABLE blocks_default PARTITION OF blocks DEFAULT')
+                connection.execute('CREATE INDEX ix_blocks_blob_id ON blocks (blob_id)')
 
         from alembic.config import Config
         from alembic import command
@@ -194,10 +377,23 @@ class MetaBackend(_MetaBackend):
         return str(uuid.uuid1())
 
 
+    def _create_blocks_partition(self, version_uid):
+        """ Creates the partition holding the blocks of a version if the
+        blocks table is partitioned. """
+        if self._blocks_partitioned:
+            self.session.execute(text('CREATE TABLE IF NOT EXISTS "{}" PARTITION OF blocks FOR VALUES IN (:version_uid)'.format(
+                _blocks_partition_name(version_uid))), {'version_uid': version_uid})
+
+
     def _commit(self):
         self.session.commit()
 
 
+    def refresh(self):
+        # Ends the transaction and expires all loaded objects.
+        self._commit()
+
+
     def set_version(self, version_name, snapshot_name, size, size_bytes, valid, protected=0):
         uid = self._uid()
         version = Version(
@@ -211,101 +407,244 @@ class MetaBackend(_MetaBackend):
             protected=protected,
             )
         self.session.add(version)
+        self._create_blocks_partition(uid)
         self.session.commit()
         return uid
 
 
     def copy_version(self, from_version_uid, version_name, snapshot_name=''):
-        """ Copy version to a new uid and name, snapshot_name"""
+        """ Copy version to a new uid and name, snapshot_name. The blocks
+        are copied inside the database.
+        """
         old_version = self.get_version(from_version_uid)
-        new_version_uid = self.set_version(version_name, snapshot_name, old_version.size, old_version.size_bytes, old_version.valid)
-        old_blocks = self.get_blocks_by_version(from_version_uid)
+        new_version_uid = self.set_version(version_name, snapshot_name, old_version.size, old_version.size_bytes, 0)
         logger.info('Copying version...')
-        for i, block in enumerate(old_blocks.yield_per(1000)):
-            self.set_block(
-                    i,
-                    new_version_uid,
-                    block.uid,
-                    block.checksum,
-                    block.size,
-                    block.valid,
-                    _commit=False,
-                    )
-        self._commit()
+        self.session.execute(BlockMap.__table__.insert().from_select(
+            ['version_uid', 'id', 'blob_id'],
+            self.session.query(
+                sqlalchemy.literal(new_version_uid),
+                BlockMap.id,
+                BlockMap.blob_id,
+                ).filter(BlockMap.version_uid == from_version_uid),
+            ))
+        self.session.execute(PackedBlockMap.__table__.insert().from_select(
+            ['version_uid', 'data'],
+            self.session.query(
+                sqlalchemy.literal(new_version_uid),
+                PackedBlockMap.data,
+                ).filter(PackedBlockMap.version_uid == from_version_uid),
+            ))
+        self.session.query(Version).filter_by(uid=new_version_uid).update(
+            {Version.valid: old_version.valid}, synchronize_session=False)
+        self.session.commit()
+        self._account_version(new_version_uid)
         logger.info('Done copying version...')
         return new_version_uid
 
 
     def du(self, version_uid):
-        virtual_space = 0
-        real_space = 0
-        dedup_own = 0
-        dedup_others = 0
-        nodedup = 0
-        null_space = 0
-        backy_space = 0
-        space_freed = 0
+        self._account_versions()
+        space = self.session.query(VersionSpace).filter_by(version_uid=version_uid).first()
+        if space is None:
+            # incomplete versions are not accounted
+            return self._du(version_uid)
+        return {
+            'real_space': space.real_space,
+            'null_space': space.null_space,
+            'dedup_own': space.dedup_own,
+            'dedup_others': space.dedup_others,
+            'nodedup': space.nodedup,
+            'backy_space': round(space.backy_space),
+            'space_freed': space.space_freed,
+        }
+
 
+    def _du(self, version_uid):
         # find null blocks
-        blocks = self.session.query(Block).filter_by(version_uid=version_uid, uid=None).all()
-        for block in blocks:
-            virtual_space += block.size
-            null_space += block.size
+        null_space = self.session.query(func.coalesce(func.sum(Block.size), 0)).filter_by(version_uid=version_uid, uid=None).scalar()
 
         # find real blocks
         statement = text("""
-            select a.uid, a.size, count(a.uid) own_shared,
-                (select count(*) cnt from blocks where uid=a.uid) shared
+            select a.blob_id, b.size, count(*) own_shared,
+                (select count(*) cnt from blocks where blob_id=a.blob_id) shared
             from blocks a
+                join blobs b on b.id=a.blob_id
                 where a.version_uid=:version_uid
-                and a.uid is not NULL
-            group by a.uid, a.size
+                and b.uid is not NULL
+            group by a.blob_id, b.size
             """)
-
-        # Alternative, probably more compatible but not really faster.
-        #statement = text("""
-        #    select
-        #        a.uid, a.size, sum(case when a.version_uid=b.version_uid then 1 else 0 end) own_shared,
-        #        count(b.*) shared
-        #    from blocks a
-        #    left join blocks b on a.uid=b.uid
-        #        where a.version_uid=:version_uid
-        #    group by a.uid, a.size
-        #    """)
         result = self.session.execute(statement, params={'version_uid': version_uid})
-        for row in result:
+        ret = self._space((row.size, row.own_shared, row.shared) for row in result)
+        ret['null_space'] = int(null_space)
+        ret['backy_space'] = round(ret['backy_space'])
+        return ret
+
+
+    def _space(self, rows):
+        """ Calculates the disk usage counters of a version from rows of
+        (blob size, blocks in this version, blocks in all versions) for each
+        of the version's blobs.
+        """
+        real_space = 0
+        dedup_own = 0
+        dedup_others = 0
+        nodedup = 0
+        backy_space = 0
+        space_freed = 0
+        for size, own_shared, shared in rows:
             # calculations are based on part of real.
-            real_space += row.size * row.own_shared
+            real_space += size * own_shared
 
-            _block_count_in_own_version = row.own_shared
-            _block_count_in_all_versions = row.shared
+            _block_count_in_own_version = own_shared
+            _block_count_in_all_versions = shared
             _block_count_in_other_versions = _block_count_in_all_versions - _block_count_in_own_version
 
             # if the block is in other versions, only account it as dedup_others.
             # It doesn't matter how often it is used in other versions.
             if _block_count_in_other_versions:
-                dedup_others += row.size * _block_count_in_own_version
+                dedup_others += size * _block_count_in_own_version
             elif _block_count_in_own_version > 1:
-                dedup_own += row.size * (_block_count_in_own_version - 1)  # 1 is real, the others are dedup'd
+                dedup_own += size * (_block_count_in_own_version - 1)  # 1 is real, the others are dedup'd
             else:
-                nodedup += row.size
+                nodedup += size
 
-            backy_space += row.size / _block_count_in_all_versions  # partial size
+            backy_space += size / _block_count_in_all_versions  # partial size
 
             if _block_count_in_other_versions == 0:  # only in this version
-                space_freed += row.size
+                space_freed += size
 
-        ret = {
+        return {
             'real_space': real_space,
-            'null_space': null_space,
+            'null_space': 0,
             'dedup_own': dedup_own,
             'dedup_others': dedup_others,
             'nodedup': nodedup,
-            'backy_space': round(backy_space),
+            'backy_space': backy_space,
             'space_freed': space_freed,
         }
 
-        return ret
+
+    def _account_versions(self):
+        """ Accounts all complete versions which aren't accounted yet, e.g.
+        versions which haven't been marked valid or all versions after
+        upgrading the database. The counters of a version are only right
+        when all complete versions sharing its blobs are accounted, so this
+        must run before any counters are read.
+        """
+        version_uids = [version_uid for version_uid, in self.session.query(Version.uid).outerjoin(
+            VersionSpace, VersionSpace.version_uid == Version.uid).filter(
+            VersionSpace.version_uid.is_(None)).order_by(Version.date)]
+        accounted = sum(self._account_version(version_uid) for version_uid in version_uids)
+        if accounted:
+            logger.debug('Accounted {} versions.'.format(accounted))
+
+
+    def _account_version(self, version_uid, sign=1, _commit=True):
+        """ Adds (sign=1) a complete version to the blobs' reference counts
+        and the disk usage counters or removes it (sign=-1). Returns False if
+        there was nothing to do, i.e. the version is incomplete or already
+        accounted when adding it or isn't accounted when removing it.
+        """
+        accounted = self.session.query(VersionSpace.version_uid).filter_by(version_uid=version_uid).first() is not None
+        if accounted == (sign > 0):
+            return False
+        if sign > 0:
+            version = self.get_version(version_uid)
+            if self.session.query(func.count(BlockMap.id)).filter_by(version_uid=version_uid).scalar() != version.size:
+                return False
+
+        own = self.session.query(
+            BlockMap.blob_id.label('blob_id'),
+            Blob.uid.label('uid'),
+            Blob.size.label('size'),
+            func.count(BlockMap.id).label('k'),
+            ).join(Blob, Blob.id == BlockMap.blob_id).filter(
+                BlockMap.version_uid == version_uid,
+                Blob.uid.isnot(None),
+            ).group_by(BlockMap.blob_id, Blob.uid, Blob.size).subquery()
+
+        # Update the counters of all other accounted versions which share
+        # blobs with this version. t is the blob's reference count before,
+        # t2 after and o is the number of blocks of the other version.
+        others = self.session.query(
+            BlockMap.version_uid.label('version_uid'),
+            BlockMap.blob_id.label('blob_id'),
+            func.count(BlockMap.id).label('o'),
+            ).filter(
+                BlockMap.blob_id.in_(self.session.query(own.c.blob_id)),
+                BlockMap.version_uid != version_uid,
+            ).group_by(BlockMap.version_uid, BlockMap.blob_id).subquery()
+        t = Blob.refcount
+        t2 = Blob.refcount + sign * own.c.k
+        o = others.c.o
+        size = own.c.size
+        d_shared = case([(t2 > o, 1)], else_=0) - case([(t > o, 1)], else_=0)
+        deltas = self.session.query(
+            others.c.version_uid,
+            func.sum(size * o * d_shared),
+            func.sum(size * (o - 1) * -d_shared),
+            func.sum(case([(o == 1, size)], else_=0) * -d_shared),
+            func.sum(size * -d_shared),
+            func.sum(size * (1.0 / t2 - 1.0 / t)),
+            ).join(own, own.c.blob_id == others.c.blob_id).join(
+                Blob, Blob.id == others.c.blob_id).join(
+                VersionSpace, VersionSpace.version_uid == others.c.version_uid).group_by(
+                others.c.version_uid).all()
+        for other_version_uid, d_dedup_others, d_dedup_own, d_nodedup, d_space_freed, d_backy_space in deltas:
+            self.session.query(VersionSpace).filter_by(version_uid=other_version_uid).update({
+                VersionSpace.dedup_others: VersionSpace.dedup_others + int(d_dedup_others),
+                VersionSpace.dedup_own: VersionSpace.dedup_own + int(d_dedup_own),
+                VersionSpace.nodedup: VersionSpace.nodedup + int(d_nodedup),
+                VersionSpace.space_freed: VersionSpace.space_freed + int(d_space_freed),
+                VersionSpace.backy_space: VersionSpace.backy_space + float(d_backy_space),
+                }, synchronize_session=False)
+
+        own_rows = self.session.query(own.c.blob_id, own.c.uid, own.c.size, own.c.k).all()
+        for _own_rows in chunks(own_rows, 1000):
+            self.session.execute(
+                Blob.__table__.update().where(Blob.id == bindparam('_id')).values(
+                    refcount=Blob.refcount + bindparam('_delta')),
+                [{'_id': blob_id, '_delta': sign * k} for blob_id, uid, size, k in _own_rows],
+                )
+
+        if sign > 0:
+            refcounts = self.session.query(Blob.id, Blob.refcount).filter(
+                Blob.id.in_(self.session.query(own.c.blob_id)))
+            refcounts = dict(refcounts)
+            space = self._space((size, k, refcounts[blob_id]) for blob_id, uid, size, k in own_rows)
+            space['null_space'] = int(self.session.query(func.coalesce(func.sum(Block.size), 0)).filter_by(
+                version_uid=version_uid, uid=None).scalar())
+            space['sketch'] = KMVSketch.from_blobs((uid, size) for blob_id, uid, size, k in own_rows).to_bytes()
+            self.session.add(VersionSpace(version_uid=version_uid, **space))
+        else:
+            self.session.query(VersionSpace).filter_by(version_uid=version_uid).delete()
+        if _commit:
+            self.session.commit()
+        return True
+
+
+    def get_version_sketches(self, version_uids):
+        """ Returns a dict version_uid: KMVSketch of the given versions """
+        sketches = {}
+        for _version_uids in chunks(list(version_uids), 500):
+            rows = self.session.query(VersionSpace.version_uid, VersionSpace.sketch).filter(
+                VersionSpace.version_uid.in_(_version_uids))
+            for version_uid, sketch in rows:
+                if sketch is not None:
+                    sketches[version_uid] = KMVSketch.from_bytes(sketch)
+        for version_uid in version_uids:
+            if version_uid in sketches:
+                continue
+            blobs = self.session.query(Block.uid, Block.size).filter(
+                Block.version_uid == version_uid, Block.uid.isnot(None)).distinct()
+            sketch = KMVSketch.from_blobs(blobs)
+            # Only the sketch of an accounted version (e.g. accounted before
+            # sketches existed) is kept, this doesn't account versions.
+            self.session.query(VersionSpace).filter_by(version_uid=version_uid).update(
+                {VersionSpace.sketch: sketch.to_bytes()}, synchronize_session=False)
+            sketches[version_uid] = sketch
+        self.session.commit()
+        return sketches
 
 
     def set_stats(self, version_uid, version_name, version_size_bytes,
@@ -365,6 +704,42 @@ class MetaBackend(_MetaBackend):
         logger.debug('Marked version valid (UID {})'.format(
             uid,
             ))
+        self._account_version(uid)
+        if self.pack_block_maps:
+            self._pack_block_map(uid)
+
+
+    def _pack_block_map(self, version_uid):
+        """ Packs the block map of a complete version if not done yet """
+        if self.session.query(PackedBlockMap.version_uid).filter_by(version_uid=version_uid).first():
+            return
+        version = self.get_version(version_uid)
+        blob_ids = array('q')
+        for id, blob_id in self.session.query(BlockMap.id, BlockMap.blob_id).filter_by(
+                version_uid=version_uid).order_by(BlockMap.id).yield_per(10000):
+            if id != len(blob_ids):
+                return  # incomplete
+            blob_ids.append(blob_id)
+        if len(blob_ids) != version.size:
+            return
+        self.session.add(PackedBlockMap(version_uid=version_uid, data=blockmap.pack(blob_ids)))
+        self.session.commit()
+        logger.debug('Packed block map of version {}'.format(version_uid))
+
+
+    def get_block_map(self, version_uid):
+        """ Returns the blob ids of all blocks of a version as array indexed
+        by block id. Missing blocks of incomplete versions are -1. """
+        packed = self.session.query(PackedBlockMap.data).filter_by(version_uid=version_uid).first()
+        if packed is not None:
+            return blockmap.unpack(packed.data)
+        blob_ids = array('q')
+        for id, blob_id in self.session.query(BlockMap.id, BlockMap.blob_id).filter_by(
+                version_uid=version_uid).order_by(BlockMap.id).yield_per(10000):
+            while len(blob_ids) < id:
+                blob_ids.append(-1)  # missing block
+            blob_ids.append(blob_id)
+        return blob_ids
 
 
     def get_version(self, uid):
@@ -392,9 +767,20 @@ class MetaBackend(_MetaBackend):
             ))
 
 
-    def get_versions(self):
+    def get_versions(self, name=None, snapshot_name=None, tag=None, expired=False, valid=None):
         """ Return versions, must be sorted by date ascending"""
-        return self.session.query(Version).order_by(Version.name, Version.date).all()
+        versions = self.session.query(Version).options(sqlalchemy.orm.selectinload(Version.tags))
+        if name is not None:
+            versions = versions.filter(Version.name == name)
+        if snapshot_name is not None:
+            versions = versions.filter(Version.snapshot_name == snapshot_name)
+        if tag is not None:
+            versions = versions.filter(Version.tags.any(Tag.name == tag))
+        if expired:
+            versions = versions.filter(Version.expire < datetime.datetime.utcnow())
+        if valid is not None:
+            versions = versions.filter(Version.valid == (1 if valid else 0))
+        return versions.order_by(Version.name, Version.date).all()
 
 
     def add_tag(self, version_uid, name):
@@ -427,36 +813,118 @@ class MetaBackend(_MetaBackend):
     def set_block(self, id, version_uid, block_uid, checksum, size, valid, enc_envkey=b'', enc_version=0, enc_nonce=None, _commit=True):
         """ insert a block
         """
-        valid = 1 if valid else 0
         if enc_envkey:
             enc_envkey = binascii.hexlify(enc_envkey).decode('ascii')
         if enc_nonce:
             enc_nonce = binascii.hexlify(enc_nonce).decode('ascii')
-        block = Block(
-            id=id,
-            version_uid=version_uid,
-            date=datetime.datetime.utcnow(),  # as func.now creates timezone stamps...
-            uid=block_uid,
-            checksum=checksum,
-            size=size,
-            valid=valid,
-            enc_envkey=enc_envkey,
-            enc_version=enc_version,
-            enc_nonce=enc_nonce,
-            )
-        self.session.add(block)
-        self._flush_block_counter += 1
-        if self._flush_block_counter % self.FLUSH_EVERY_N_BLOCKS == 0:
-            t1 = time.time()
-            self.session.flush()  # saves some ram
-            t2 = time.time()
-            logger.debug('Flushed meta backend in {:.2f}s'.format(t2-t1))
+        self._insert_block(id, version_uid, block_uid, checksum, size, valid, enc_envkey, enc_version, enc_nonce)
         if _commit:
             self.session.commit()
-        return block
+
+
+    def _insert_block(self, id, version_uid, block_uid, checksum, size, valid, enc_envkey=None, enc_version=0, enc_nonce=None, date=None):
+        """ Inserts a block referencing its blob, which is created if it
+        doesn't exist yet. enc_envkey and enc_nonce are hex strings.
+        """
+        valid = 1 if valid else 0
+        key = block_uid if block_uid is not None else (None, size)
+        blob_id = self._blob_ids.get(key)
+        if blob_id is None:
+            if block_uid is None:
+                blob = self.session.query(Blob.id).filter(Blob.uid == None, Blob.size == size).first()
+            else:
+                blob = self.session.query(Blob.id).filter(Blob.uid == block_uid).first()
+            if blob is not None:
+                blob_id = blob.id
+            else:
+                blob_id = self.session.execute(Blob.__table__.insert().values(
+                    uid=block_uid,
+                    date=date or datetime.datetime.utcnow(),  # as func.now creates timezone stamps...
+                    checksum=checksum,
+                    size=size,
+                    valid=valid,
+                    enc_version=enc_version,
+                    enc_envkey=enc_envkey,
+                    enc_nonce=enc_nonce,
+                    )).inserted_primary_key[0]
+            if len(self._blob_ids) >= self.BLOB_ID_CACHE_SIZE:
+                self._blob_ids.clear()
+            self._blob_ids[key] = blob_id
+        if not valid and block_uid is not None:
+            self.session.query(Blob).filter_by(id=blob_id).update({Blob.valid: 0}, synchronize_session=False)
+        self.session.execute(BlockMap.__table__.insert().values(
+            version_uid=version_uid,
+            id=id,
+            blob_id=blob_id,
+            ))
+
+
+    def _insert_blocks(self, version_uid, blocks):
+        """ Inserts dereferenced blocks like _insert_block, but with a few
+        statements for all of them instead of several per block. """
+        first_blocks = {}  # key: first block referencing the blob
+        for block in blocks:
+            first_blocks.setdefault(block.uid if block.uid is not None else (None, block.size), block)
+        blob_ids = {}
+        missing_uids = []
+        for key, block in first_blocks.items():
+            if key in self._blob_ids:
+                blob_ids[key] = self._blob_ids[key]
+            elif block.uid is None:
+                # there's one sparse blob per size, so these are few
+                blob_ids[key] = self._sparse_blob_id(block)
+            else:
+                missing_uids.append(key)
+        blob_ids_by_uid = self.session.query(Blob.uid, Blob.id).filter(Blob.uid.in_(bindparam('uids', expanding=True)))
+        for uids in chunks(missing_uids, 500):
+            blob_ids.update(blob_ids_by_uid.params(uids=uids))
+        new_blocks = [first_blocks[uid] for uid in missing_uids if uid not in blob_ids]
+        if new_blocks:
+            # ids only grow, so the new blobs are the ones after the last id
+            last_id = self.session.query(func.max(Blob.id)).scalar() or 0
+            self.session.execute(Blob.__table__.insert(), [self._blob_values(block) for block in new_blocks])
+            new_uids = set(block.uid for block in new_blocks)
+            blob_ids.update((uid, id) for uid, id in self.session.query(Blob.uid, Blob.id).filter(
+                Blob.id > last_id) if uid in new_uids)
+
+        if len(self._blob_ids) + len(blob_ids) >= self.BLOB_ID_CACHE_SIZE:
+            self._blob_ids.clear()
+        self._blob_ids.update(blob_ids)
+        invalid_blob_ids = list(set(blob_ids[block.uid] for block in blocks if not block.valid and block.uid is not None))
+        if invalid_blob_ids:
+            self.session.execute(Blob.__table__.update().where(Blob.id == bindparam('_id')).values(valid=0),
+                [{'_id': blob_id} for blob_id in invalid_blob_ids])
+        self.session.execute(BlockMap.__table__.insert(), [{
+            'version_uid': version_uid,
+            'id': block.id,
+            'blob_id': blob_ids[block.uid if block.uid is not None else (None, block.size)],
+            } for block in blocks])
+
+
+    def _blob_values(self, block):
+        return {
+            'uid': block.uid,
+            'date': block.date,
+            'checksum': block.checksum,
+            'size': block.size,
+            'valid': 1 if block.valid else 0,
+            'enc_version': block.enc_version,
+            'enc_envkey': block.enc_envkey,
+            'enc_nonce': block.enc_nonce,
+            }
+
+
+    def _sparse_blob_id(self, block):
+        """ Returns the id of a sparse block's blob, which is created if
+        it doesn't exist yet. """
+        blob = self.session.query(Blob.id).filter(Blob.uid == None, Blob.size == block.size).first()
+        if blob is not None:
+            return blob.id
+        return self.session.execute(Blob.__table__.insert().values(**self._blob_values(block))).inserted_primary_key[0]
 
 
     def set_block_enc_envkey(self, block, enc_envkey):
+        """ Sets the envelope key of a blob returned by get_blocks """
         block.enc_envkey = binascii.hexlify(enc_envkey).decode('ascii')
         self.session.add(block)
         self._flush_block_counter += 1
@@ -470,9 +938,10 @@ class MetaBackend(_MetaBackend):
 
 
     def set_blocks_invalid(self, uid, checksum):
-        _affected_version_uids = self.session.query(distinct(Block.version_uid)).filter_by(uid=uid, checksum=checksum).all()
+        blob_ids = self.session.query(Blob.id).filter_by(uid=uid, checksum=checksum)
+        _affected_version_uids = self.session.query(distinct(BlockMap.version_uid)).filter(BlockMap.blob_id.in_(blob_ids.subquery())).all()
         affected_version_uids = [v[0] for v in _affected_version_uids]
-        self.session.query(Block).filter_by(uid=uid, checksum=checksum).update({'valid': 0}, synchronize_session='fetch')
+        self.session.query(Blob).filter_by(uid=uid, checksum=checksum).update({'valid': 0}, synchronize_session=False)
         self.session.commit()
         logger.info('Marked block invalid (UID {}, Checksum {}. Affected versions: {}'.format(
             uid,
@@ -496,59 +965,213 @@ class MetaBackend(_MetaBackend):
         return self.session.query(Block).filter_by(version_uid=version_uid).order_by(Block.id)
 
 
+    def get_num_blocks_by_version(self, version_uid):
+        if self.session.query(PackedBlockMap.version_uid).filter_by(version_uid=version_uid).first():
+            return self.get_version(version_uid).size
+        return self.session.query(func.count(BlockMap.id)).filter_by(version_uid=version_uid).scalar()
+
+
     def get_blocks_by_version_deref(self, version_uid):
-        """ use blocks but don't hold them in the session, because
-        that makes the commit on the session slow"""
-        statement = text("""
-            select uid, id, date, checksum, size, valid, enc_version, enc_envkey, enc_nonce
-            from blocks
-                where version_uid=:version_uid
-            """)
-        result = self.session.execute(statement, params={'version_uid': version_uid})
-        for block in result:
-            yield DereferencedBlock(
-                uid=block.uid,
-                version_uid=version_uid,
-                id=block.id,
-                date=block.date,
-                checksum=block.checksum,
-                size=block.size,
-                valid=block.valid,
-                enc_version=block.enc_version,
-                enc_envkey=block.enc_envkey,
-                enc_nonce=block.enc_nonce,
-            )
+        """ Yields DereferencedBlocks of a version ordered by id. These aren't
+        held in the session, because that makes the commit on the session
+        slow"""
+        packed = self.session.query(PackedBlockMap.data).filter_by(version_uid=version_uid).first()
+        if packed is not None:
+            yield from self._get_blocks_by_block_map(version_uid, blockmap.unpack(packed.data))
+            return
+        # A core select instead of the ORM: no identity map and one record
+        # per block. stream_results uses server side cursors where
+        # available (e.g. postgresql). Callers may commit while iterating
+        # (e.g. scrub or migrate_encryption), then the rest is buffered.
+        stream = _Stream(self.session.connection().execution_options(stream_results=True).execute(
+            sqlalchemy.select([
+                Blob.uid,
+                BlockMap.id,
+                Blob.date,
+                Blob.checksum,
+                Blob.size,
+                Blob.valid,
+                Blob.enc_envkey,
+                Blob.enc_version,
+                Blob.enc_nonce,
+                ]).select_from(Block.__table__).where(
+                    BlockMap.version_uid == version_uid,
+                ).order_by(BlockMap.id)))
+        self._streams.add(stream)
+        try:
+            for uid, id, date, checksum, size, valid, enc_envkey, enc_version, enc_nonce in stream:
+                yield DereferencedBlock(uid, version_uid, id, date, checksum, size, valid, enc_envkey, enc_version, enc_nonce)
+        finally:
+            self._streams.discard(stream)
+            stream.close()
+
+
+    def _get_blocks_by_block_map(self, version_uid, blob_ids, chunk_size=10000):
+        """ Yields DereferencedBlocks for a block map, loading each chunk's
+        blobs with one query. """
+        _iter = iter(blob_ids)
+        offset = 0
+        while True:
+            _blob_ids = list(islice(_iter, chunk_size))
+            if not _blob_ids:
+                break
+            blobs = {blob.id: blob for blob in self.session.query(
+                Blob.id,
+                Blob.uid,
+                Blob.date,
+                Blob.checksum,
+                Blob.size,
+                Blob.valid,
+                Blob.enc_version,
+                Blob.enc_envkey,
+                Blob.enc_nonce,
+                ).filter(Blob.id.in_(set(_blob_ids)))}
+            for id, blob_id in enumerate(_blob_ids, offset):
+                blob = blobs[blob_id]
+                yield DereferencedBlock(blob.uid, version_uid, id, blob.date, blob.checksum, blob.size, blob.valid, blob.enc_envkey, blob.enc_version, blob.enc_nonce)
+            offset += len(_blob_ids)
 
 
     def get_blocks(self):
-        return self.session.query(Block).order_by(Block.id)
+        """ Returns all blobs. Blocks share the key of their blob, so these
+        are what needs to be re-keyed. """
+        return self.session.query(Blob).order_by(Blob.id).all()
+
+
+    def get_scrub_candidates(self, older_than, exclude_version_uids=()):
+        """ Yields one dereferenced block per blob which has not been scrubbed
+        since older_than (datetime). Blobs which are only referenced by
+        excluded versions are not returned.
+        """
+        # One row per blob, however many versions reference it. The block
+        # which is returned for a blob is the first one of its first version.
+        included = BlockMap.version_uid.notin_(exclude_version_uids) if exclude_version_uids else sqlalchemy.true()
+        references = self.session.query(BlockMap).filter(BlockMap.blob_id == Blob.id, included)
+        version_uid = self.session.query(func.min(BlockMap.version_uid)).filter(
+            BlockMap.blob_id == Blob.id, included).correlate(Blob).as_scalar()
+        id = self.session.query(func.min(BlockMap.id)).filter(
+            BlockMap.blob_id == Blob.id, BlockMap.version_uid == version_uid).correlate(Blob).as_scalar()
+        blobs = self.session.query(Blob.id, Blob.uid, version_uid, id, Blob.date, Blob.checksum, Blob.size,
+            Blob.valid, Blob.enc_envkey, Blob.enc_version, Blob.enc_nonce).outerjoin(
+            BlobScrub, BlobScrub.uid == Blob.uid).filter(
+                Blob.uid.isnot(None),
+                (BlobScrub.last_scrubbed == None) | (BlobScrub.last_scrubbed < older_than),
+                references.exists(),
+            ).order_by(Blob.id)
+        # Fetch in pages so that the caller may commit in between.
+        last_id = 0
+        while True:
+            page = blobs.filter(Blob.id > last_id).limit(1000).all()
+            if not page:
+                break
+            for row in page:
+                yield DereferencedBlock(*row[1:])
+            last_id = page[-1][0]
+
+
+    def set_blob_scrubbed(self, uid, valid, _commit=True):
+        """ Records the result of a blob's scrub """
+        self.session.merge(BlobScrub(
+            uid=uid,
+            last_scrubbed=datetime.datetime.utcnow(),
+            valid=1 if valid else 0,
+            ))
+        if _commit:
+            self.session.commit()
+
+
+    def set_blob(self, uid, size, etag, _commit=True):
+        """ Records the stored size and etag of a blob which has been set
+        with set_block """
+        self.session.query(Blob).filter_by(uid=uid).update(
+            {Blob.stored_size: size, Blob.etag: etag}, synchronize_session=False)
+        if _commit:
+            self.session.commit()
+
+
+    def get_blobs(self, uids):
+        """ Returns a dict uid: (size, etag) for the given blob uids which
+        have been recorded.
+        """
+        result = {}
+        for _uids in chunks(list(uids), 500):
+            rows = self.session.query(Blob.uid, Blob.stored_size, Blob.etag).filter(
+                Blob.uid.in_(_uids), Blob.stored_size.isnot(None))
+            for uid, size, etag in rows:
+                result[uid] = (size, etag)
+        return result
+
+
+    def get_versions_scrub_state(self, version_uids):
+        """ Returns a dict version_uid: (invalid_blobs, unscrubbed_blobs)
+        from the recorded blob scrubs.
+        """
+        result = {}
+        for _version_uids in chunks(version_uids, 500):
+            rows = self.session.query(
+                Block.version_uid,
+                func.sum(case([(BlobScrub.valid == 0, 1)], else_=0)),
+                func.sum(case([(BlobScrub.uid == None, 1)], else_=0)),
+                ).outerjoin(BlobScrub, BlobScrub.uid == Block.uid).filter(
+                    Block.version_uid.in_(_version_uids),
+                    Block.uid.isnot(None),
+                ).group_by(Block.version_uid)
+            for version_uid, invalid_blobs, unscrubbed_blobs in rows:
+                result[version_uid] = (int(invalid_blobs or 0), int(unscrubbed_blobs or 0))
+        for version_uid in version_uids:
+            result.setdefault(version_uid, (0, 0))  # sparse only
+        return result
 
 
     def get_block_ids_by_version(self, version_uid):
-        _b = self.session.query(Block.id).filter_by(version_uid=version_uid).order_by(Block.id)
+        if self.session.query(PackedBlockMap.version_uid).filter_by(version_uid=version_uid).first():
+            # only complete versions are packed
+            return list(range(self.get_version(version_uid).size))
+        _b = self.session.query(BlockMap.id).filter_by(version_uid=version_uid).order_by(BlockMap.id)
         return [v[0] for v in _b.values('id')]
 
 
     def rm_version(self, version_uid):
-        affected_blocks = self.session.query(Block).filter_by(version_uid=version_uid)
-        num_blocks = affected_blocks.count()
-        for affected_block in affected_blocks:
-            if affected_block.uid:  # uid == None means sparse
-                deleted_block = DeletedBlock(
-                    uid=affected_block.uid,
-                    size=affected_block.size,
-                    delete_candidate=DELETE_CANDIDATE_MAYBE,  # TODO: obsolete
-                )
-                self.session.add(deleted_block)
-        affected_blocks.delete()
-        # TODO: This is a sqlalchemy stupidity. cascade only works if the version
-        # is deleted via session.delete() which first loads all objects into
-        # memory. A session.query().filter().delete does not work with cascade.
-        # Please see http://stackoverflow.com/questions/5033547/sqlalchemy-cascade-delete/12801654#12801654
-        # for reference.
-        self.session.query(Tag).filter_by(version_uid=version_uid).delete()
-        self.session.query(Version).filter_by(uid=version_uid).delete()
-        self.session.commit()
+        return self.rm_versions([version_uid])
+
+
+    def rm_versions(self, version_uids, chunk_size=20):
+        """ Removes versions in one transaction per chunk of versions.
+        The blocks are moved to deleted_blocks inside the database, so this
+        doesn't depend on the number of blocks.
+        """
+        num_blocks = 0
+        for _version_uids in chunks(list(version_uids), chunk_size):
+            for version_uid in _version_uids:
+                self._account_version(version_uid, -1, _commit=False)
+            affected_blocks = self.session.query(BlockMap).filter(BlockMap.version_uid.in_(_version_uids))
+            num_blocks += affected_blocks.count()
+            # uid == None means sparse
+            self.session.execute(DeletedBlock.__table__.insert().from_select(
+                ['uid', 'size', 'delete_candidate', 'time'],
+                self.session.query(
+                    Block.uid,
+                    Block.size,
+                    sqlalchemy.literal(DELETE_CANDIDATE_MAYBE),  # TODO: obsolete
+                    sqlalchemy.literal(inttime()),
+                    ).filter(
+                        Block.version_uid.in_(_version_uids),
+                        Block.uid.isnot(None),
+                    ).distinct(),
+                ))
+            if self._blocks_partitioned:
+                for version_uid in _version_uids:
+                    self.session.execute('DROP TABLE IF EXISTS "{}"'.format(_blocks_partition_name(version_uid)))
+            affected_blocks.delete(synchronize_session=False)  # blocks in the default partition
+            self.session.query(PackedBlockMap).filter(PackedBlockMap.version_uid.in_(_version_uids)).delete(synchronize_session=False)
+            # TODO: This is a sqlalchemy stupidity. cascade only works if the version
+            # is deleted via session.delete() which first loads all objects into
+            # memory. A session.query().filter().delete does not work with cascade.
+            # Please see http://stackoverflow.com/questions/5033547/sqlalchemy-cascade-delete/12801654#12801654
+            # for reference.
+            self.session.query(Tag).filter(Tag.version_uid.in_(_version_uids)).delete(synchronize_session=False)
+            self.session.query(Version).filter(Version.uid.in_(_version_uids)).delete(synchronize_session=False)
+            self.session.commit()
         return num_blocks
 
 
@@ -561,14 +1184,20 @@ class MetaBackend(_MetaBackend):
 
 
     def get_delete_candidates(self, dt=3600):
-        delete_candidates_query = self.session.query(distinct(DeletedBlock.uid)).join(Block, Block.uid == DeletedBlock.uid, isouter=True).filter(Block.uid == None).filter(DeletedBlock.time < (inttime() - dt))
+        delete_candidates_query = self.session.query(distinct(DeletedBlock.uid)).join(
+            Blob, Blob.uid == DeletedBlock.uid, isouter=True).join(
+            BlockMap, BlockMap.blob_id == Blob.id, isouter=True).filter(
+            BlockMap.blob_id == None).filter(DeletedBlock.time < (inttime() - dt))
         delete_candidates = [b[0] for b in delete_candidates_query.all()]
         return delete_candidates
 
 
     def del_delete_candidates(self, uids):
         self.session.query(DeletedBlock).filter(DeletedBlock.uid.in_(uids)).delete(synchronize_session=False)
+        self.session.query(BlobScrub).filter(BlobScrub.uid.in_(uids)).delete(synchronize_session=False)
+        self.session.query(Blob).filter(Blob.uid.in_(uids)).delete(synchronize_session=False)
         self.session.commit()
+        self._blob_ids.clear()
 
 
     def get_all_block_uids(self, prefix=None):
@@ -579,253 +1208,39 @@ class MetaBackend(_MetaBackend):
         return [b[0] for b in rows]
 
 
-    def export(self, version_uid, f):
-        blocks = self.get_blocks_by_version(version_uid)
-        _csv = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        _csv.writerow(['backy2 Version {} metadata dump'.format(METADATA_VERSION)])
+    def export(self, version_uid, f, as_csv=False):
         version = self.get_version(version_uid)
-        _csv.writerow([
-            version.uid,
-            version.date.strftime('%Y-%m-%d %H:%M:%S'),
-            version.name,
-            version.snapshot_name,
-            version.size,
-            version.size_bytes,
-            version.valid,
-            version.protected,
-            version.expire.strftime('%Y-%m-%d') if version.expire else '',
-            ])
-        for block in blocks.yield_per(1000):
-            _csv.writerow([
-                block.uid,
-                block.version_uid,
-                block.id,
-                block.date.strftime('%Y-%m-%d %H:%M:%S'),
-                block.checksum,
-                block.size,
-                block.valid,
-                block.enc_version,
-                block.enc_envkey,
-                block.enc_nonce,
-                ])
-        return _csv
-
-
-    def import_(self, f):
-        _csv = csv.reader(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        signature = next(_csv)
-        if signature[0] == 'backy2 Version 2.1 metadata dump':
-            self.import_2_1(_csv)
-        elif signature[0] == 'backy2 Version 2.2 metadata dump':
-            self.import_2_2(_csv)
-        elif signature[0] == 'backy2 Version 2.10 metadata dump':
-            self.import_2_10(_csv)
-        elif signature[0] == 'backy2 Version 2.12 metadata dump':
-            self.import_2_12(_csv)
-        else:
-            raise ValueError('Wrong import format.')
-
-
-    def import_2_1(self, _csv):
-        version_uid, version_date, version_name, version_size, version_size_bytes, version_valid = next(_csv)
-        try:
-            self.get_version(version_uid)
-        except KeyError:
-            pass  # does not exist
-        else:
-            raise KeyError('Version {} already exists and cannot be imported.'.format(version_uid))
-        version = Version(
-            uid=version_uid,
-            date=datetime.datetime.strptime(version_date, '%Y-%m-%d %H:%M:%S'),
-            name=version_name,
-            snapshot_name='',
-            size=version_size,
-            size_bytes=version_size_bytes,
-            valid=version_valid,
-            protected=0,
-            )
-        self.session.add(version)
-        for uid, version_uid, id, date, checksum, size, valid in _csv:
-            if uid == '':
-                uid = None
-            block = Block(
-                uid=uid,
-                version_uid=version_uid,
-                id=id,
-                date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
-                checksum=checksum,
-                size=size,
-                valid=valid,
-            )
-            self.session.add(block)
-        self.session.commit()
-
-
-    def import_2_2(self, _csv):
-        version_uid, version_date, version_name, version_snapshot_name, version_size, version_size_bytes, version_valid, version_protected = next(_csv)
-        try:
-            self.get_version(version_uid)
-        except KeyError:
-            pass  # does not exist
+        blocks = self.get_blocks_by_version_deref(version_uid)
+        if as_csv:
+            dump.write_csv(f, version, blocks)
         else:
-            raise KeyError('Version {} already exists and cannot be imported.'.format(version_uid))
-        version = Version(
-            uid=version_uid,
-            date=datetime.datetime.strptime(version_date, '%Y-%m-%d %H:%M:%S'),
-            name=version_name,
-            snapshot_name=version_snapshot_name,
-            size=version_size,
-            size_bytes=version_size_bytes,
-            valid=version_valid,
-            protected=version_protected,
-            )
-        self.session.add(version)
-        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        # SQLAlchemy Bug
-        # https://stackoverflow.com/questions/10154343/is-sqlalchemy-saves-order-in-adding-objects-to-session
-        #
-        # """
-        # Within the same class, the order is indeed determined by the order
-        # that add was called. However, you may see different orderings in the
-        # INSERTs between different classes. If you add object a of type A and
-        # later add object b of type B, but a turns out to have a foreign key
-        # to b, you'll see an INSERT for b before the INSERT for a.
-        # """
-        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        self.session.commit()
-        # and because of this bug we must also try/except here instead of
-        # simply leaving this to the database's transaction handling.
-        try:
-            for uid, version_uid, id, date, checksum, size, valid in _csv:
-                if uid == '':
-                    uid = None
-                block = Block(
-                    uid=uid,
-                    version_uid=version_uid,
-                    id=id,
-                    date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
-                    checksum=checksum,
-                    size=size,
-                    valid=valid,
-                )
-                self.session.add(block)
-        except:  # see above
-            self.rm_version(version_uid)
-        finally:
-            self.session.commit()
+            dump.write(f, version, blocks)
 
 
-    def import_2_10(self, _csv):
-        version_uid, version_date, version_name, version_snapshot_name, version_size, version_size_bytes, version_valid, version_protected, version_expire = next(_csv)
+    def import_(self, f):
+        version, blocks = dump.load(f)
+        version_uid = version['uid']
         try:
             self.get_version(version_uid)
         except KeyError:
             pass  # does not exist
         else:
             raise KeyError('Version {} already exists and cannot be imported.'.format(version_uid))
-        version = Version(
-            uid=version_uid,
-            date=datetime.datetime.strptime(version_date, '%Y-%m-%d %H:%M:%S'),
-            name=version_name,
-            snapshot_name=version_snapshot_name,
-            size=version_size,
-            size_bytes=version_size_bytes,
-            valid=version_valid,
-            protected=version_protected,
-            expire=datetime.datetime.strptime(version_expire, '%Y-%m-%d').date() if version_expire else None,
-            )
-        self.session.add(version)
-        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        # SQLAlchemy Bug
-        # https://stackoverflow.com/questions/10154343/is-sqlalchemy-saves-order-in-adding-objects-to-session
-        #
-        # """
-        # Within the same class, the order is indeed determined by the order
-        # that add was called. However, you may see different orderings in the
-        # INSERTs between different classes. If you add object a of type A and
-        # later add object b of type B, but a turns out to have a foreign key
-        # to b, you'll see an INSERT for b before the INSERT for a.
-        # """
-        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        self.session.commit()
-        # and because of this bug we must also try/except here instead of
-        # simply leaving this to the database's transaction handling.
+        self.session.add(Version(**version))
+        self._create_blocks_partition(version_uid)
+        self.session.flush()  # the blocks reference the version
+        # All in one transaction, so nothing remains of failed imports.
         try:
-            for uid, version_uid, id, date, checksum, size, valid in _csv:
-                if uid == '':
-                    uid = None
-                block = Block(
-                    uid=uid,
-                    version_uid=version_uid,
-                    id=id,
-                    date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
-                    checksum=checksum,
-                    size=size,
-                    valid=valid,
-                )
-                self.session.add(block)
-        except:  # see above
-            self.rm_version(version_uid)
-        finally:
-            self.session.commit()
-
-
-    def import_2_12(self, _csv):
-        version_uid, version_date, version_name, version_snapshot_name, version_size, version_size_bytes, version_valid, version_protected, version_expire = next(_csv)
-        try:
-            self.get_version(version_uid)
-        except KeyError:
-            pass  # does not exist
-        else:
-            raise KeyError('Version {} already exists and cannot be imported.'.format(version_uid))
-        version = Version(
-            uid=version_uid,
-            date=datetime.datetime.strptime(version_date, '%Y-%m-%d %H:%M:%S'),
-            name=version_name,
-            snapshot_name=version_snapshot_name,
-            size=version_size,
-            size_bytes=version_size_bytes,
-            valid=version_valid,
-            protected=version_protected,
-            expire=datetime.datetime.strptime(version_expire, '%Y-%m-%d').date() if version_expire else None,
-            )
-        self.session.add(version)
-        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        # SQLAlchemy Bug
-        # https://stackoverflow.com/questions/10154343/is-sqlalchemy-saves-order-in-adding-objects-to-session
-        #
-        # """
-        # Within the same class, the order is indeed determined by the order
-        # that add was called. However, you may see different orderings in the
-        # INSERTs between different classes. If you add object a of type A and
-        # later add object b of type B, but a turns out to have a foreign key
-        # to b, you'll see an INSERT for b before the INSERT for a.
-        # """
-        # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+            while True:
+                _blocks = list(islice(blocks, self.IMPORT_CHUNK_SIZE))
+                if not _blocks:
+                    break
+                self._insert_blocks(version_uid, _blocks)
+        except:
+            self.session.rollback()
+            self._blob_ids.clear()
+            raise
         self.session.commit()
-        # and because of this bug we must also try/except here instead of
-        # simply leaving this to the database's transaction handling.
-        try:
-            for uid, version_uid, id, date, checksum, size, valid, enc_version, enc_envkey, enc_nonce in _csv:
-                if uid == '':
-                    uid = None
-                block = Block(
-                    uid=uid,
-                    version_uid=version_uid,
-                    id=id,
-                    date=datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S'),
-                    checksum=checksum,
-                    size=size,
-                    valid=valid,
-                    enc_version=enc_version,
-                    enc_envkey=enc_envkey,
-                    enc_nonce=enc_nonce if enc_nonce != '\\x' else None,  # csv None is \x
-                )
-                self.session.add(block)
-        except:  # see above
-            self.rm_version(version_uid)
-        finally:
-            self.session.commit()
 
 
     def close(self):
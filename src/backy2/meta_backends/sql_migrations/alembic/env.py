@@ -10,6 +10,9 @@ engine_url = backy_config.get('engine')
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
+# migrate_db passes the backy config's options, when run with alembic they
+# are read here.
+config.attributes.setdefault('partition_blocks', backy_config.getboolean('partition_blocks', False))
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
@@ -0,0 +1,31 @@
+"""New table packed_block_maps
+
+Revision ID: a91f3c7d5e20
+Revises: e8b4a2d6c195
+Create Date: 2026-10-19 20:14:52.301846
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91f3c7d5e20'
+down_revision = 'e8b4a2d6c195'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Block maps are packed when versions are marked valid, existing versions
+    # are read from their blocks as before.
+    op.create_table('packed_block_maps',
+    sa.Column('version_uid', sa.String(length=36), nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.ForeignKeyConstraint(['version_uid'], ['versions.uid'], ),
+    sa.PrimaryKeyConstraint('version_uid')
+    )
+
+
+def downgrade():
+    op.drop_table('packed_block_maps')
@@ -0,0 +1,43 @@
+"""Blob reference counts and table version_space
+
+Revision ID: b5e8f0c4d217
+Revises: 7c1d2e5f9a30
+Create Date: 2026-10-19 15:41:07.392716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5e8f0c4d217'
+down_revision = '7c1d2e5f9a30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # All existing versions are accounted by the first du after the upgrade
+    # (see MetaBackend._account_versions), before any counters are read.
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.add_column(sa.Column('refcount', sa.Integer(), server_default='0', nullable=False))
+        batch_op.alter_column('size', existing_type=sa.BigInteger(), nullable=True)
+    op.create_table('version_space',
+    sa.Column('version_uid', sa.String(length=36), nullable=False),
+    sa.Column('real_space', sa.BigInteger(), nullable=False),
+    sa.Column('null_space', sa.BigInteger(), nullable=False),
+    sa.Column('dedup_own', sa.BigInteger(), nullable=False),
+    sa.Column('dedup_others', sa.BigInteger(), nullable=False),
+    sa.Column('nodedup', sa.BigInteger(), nullable=False),
+    sa.Column('backy_space', sa.Float(), nullable=False),
+    sa.Column('space_freed', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['version_uid'], ['versions.uid'], ),
+    sa.PrimaryKeyConstraint('version_uid')
+    )
+
+
+def downgrade():
+    op.drop_table('version_space')
+    with op.batch_alter_table('blobs') as batch_op:
+        batch_op.alter_column('size', existing_type=sa.BigInteger(), nullable=False)
+        batch_op.drop_column('refcount')
@@ -0,0 +1,82 @@
+"""Partition blocks by version on postgresql
+
+Revision ID: c4d8e2a7f913
+Revises: a91f3c7d5e20
+Create Date: 2026-10-19 21:08:17.554902
+
+"""
+import hashlib
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d8e2a7f913'
+down_revision = 'a91f3c7d5e20'
+branch_labels = None
+depends_on = None
+
+
+def _partition_name(version_uid):
+    return 'blocks_{}'.format(hashlib.md5(version_uid.encode('utf-8')).hexdigest())
+
+
+def _is_partitioned(bind):
+    return bind.execute(sa.text("""
+        SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = 'blocks' AND pg_table_is_visible(c.oid)
+        """)).first() is not None
+
+
+def _rename_constraints(old, new):
+    op.execute('ALTER INDEX {0}_pkey RENAME TO {1}_pkey'.format(old, new))
+    for column in ('version_uid', 'blob_id'):
+        op.execute('ALTER TABLE {1} RENAME CONSTRAINT {0}_{2}_fkey TO {1}_{2}_fkey'.format(old, new, column))
+
+
+def upgrade():
+    # Only with partition_blocks in the [MetaBackend] section. To partition
+    # an existing database later, downgrade to a91f3c7d5e20 and upgrade again.
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql' or not context.config.attributes.get('partition_blocks'):
+        return
+    if _is_partitioned(bind):
+        return
+    op.execute("""
+        CREATE TABLE blocks_partitioned (
+            version_uid VARCHAR(36) NOT NULL REFERENCES versions (uid),
+            id INTEGER NOT NULL,
+            blob_id BIGINT NOT NULL REFERENCES blobs (id),
+            PRIMARY KEY (version_uid, id)
+        ) PARTITION BY LIST (version_uid)
+        """)
+    # catches blocks of versions without a partition
+    op.execute('CREATE TABLE blocks_default PARTITION OF blocks_partitioned DEFAULT')
+    for version_uid, in bind.execute(sa.text('SELECT uid FROM versions')).fetchall():
+        bind.execute(sa.text('CREATE TABLE "{}" PARTITION OF blocks_partitioned FOR VALUES IN (:version_uid)'.format(
+            _partition_name(version_uid))), version_uid=version_uid)
+    op.execute('INSERT INTO blocks_partitioned (version_uid, id, blob_id) SELECT version_uid, id, blob_id FROM blocks')
+    op.drop_table('blocks')
+    op.rename_table('blocks_partitioned', 'blocks')
+    _rename_constraints('blocks_partitioned', 'blocks')
+    op.create_index(op.f('ix_blocks_blob_id'), 'blocks', ['blob_id'], unique=False)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql' or not _is_partitioned(bind):
+        return
+    op.create_table('blocks_unpartitioned',
+    sa.Column('version_uid', sa.String(length=36), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('blob_id', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['blob_id'], ['blobs.id'], ),
+    sa.ForeignKeyConstraint(['version_uid'], ['versions.uid'], ),
+    sa.PrimaryKeyConstraint('version_uid', 'id')
+    )
+    op.execute('INSERT INTO blocks_unpartitioned (version_uid, id, blob_id) SELECT version_uid, id, blob_id FROM blocks')
+    op.drop_table('blocks')  # with all partitions
+    op.rename_table('blocks_unpartitioned', 'blocks')
+    _rename_constraints('blocks_unpartitioned', 'blocks')
+    op.create_index(op.f('ix_blocks_blob_id'), 'blocks', ['blob_id'], unique=False)
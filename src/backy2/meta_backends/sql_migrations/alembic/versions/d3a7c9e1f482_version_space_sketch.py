@@ -0,0 +1,27 @@
+"""Sketch column in version_space
+
+Revision ID: d3a7c9e1f482
+Revises: b5e8f0c4d217
+Create Date: 2026-10-19 17:12:40.615283
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a7c9e1f482'
+down_revision = 'b5e8f0c4d217'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Sketches are computed lazily on the next approximate du.
+    with op.batch_alter_table('version_space') as batch_op:
+        batch_op.add_column(sa.Column('sketch', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('version_space') as batch_op:
+        batch_op.drop_column('sketch')
@@ -0,0 +1,148 @@
+"""Normalize blocks into blobs with binary checksums
+
+Revision ID: e8b4a2d6c195
+Revises: d3a7c9e1f482
+Create Date: 2026-10-19 19:03:26.874120
+
+"""
+import binascii
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b4a2d6c195'
+down_revision = 'd3a7c9e1f482'
+branch_labels = None
+depends_on = None
+
+
+def _unhex(bind):
+    """ Returns a format string converting a hex string column to binary. """
+    if bind.dialect.name == 'sqlite':
+        # sqlite has no unhex() before 3.41
+        bind.connection.create_function('backy2_unhex', 1,
+            lambda x: binascii.unhexlify(x) if x else None)
+        return 'backy2_unhex({})'
+    elif bind.dialect.name == 'postgresql':
+        return "decode(nullif({}, ''), 'hex')"
+    else:
+        return "unhex(nullif({}, ''))"
+
+
+def _hex(bind):
+    """ Returns a format string converting a binary column to a hex string. """
+    if bind.dialect.name == 'postgresql':
+        return "encode({}, 'hex')"
+    # hex(NULL) is '' in sqlite
+    return 'CASE WHEN {0} IS NULL THEN NULL ELSE lower(hex({0})) END'
+
+
+def upgrade():
+    bind = op.get_bind()
+    unhex = _unhex(bind)
+    op.create_table('blobs_new',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('uid', sa.String(length=32), nullable=True),
+    sa.Column('date', sa.DateTime(), nullable=False),
+    sa.Column('checksum', sa.LargeBinary(length=64).with_variant(sa.VARBINARY(length=64), 'mysql'), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('valid', sa.Integer(), nullable=False),
+    sa.Column('enc_version', sa.Integer(), nullable=False),
+    sa.Column('enc_envkey', sa.LargeBinary(length=40).with_variant(sa.VARBINARY(length=40), 'mysql'), nullable=True),
+    sa.Column('enc_nonce', sa.LargeBinary(length=16).with_variant(sa.VARBINARY(length=16), 'mysql'), nullable=True),
+    sa.Column('stored_size', sa.BigInteger(), nullable=True),
+    sa.Column('etag', sa.String(length=64), nullable=True),
+    sa.Column('refcount', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('blocks_new',
+    sa.Column('version_uid', sa.String(length=36), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('blob_id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.ForeignKeyConstraint(['blob_id'], ['blobs_new.id'], ),
+    sa.ForeignKeyConstraint(['version_uid'], ['versions.uid'], ),
+    sa.PrimaryKeyConstraint('version_uid', 'id')
+    )
+
+    # One blob per uid. All blocks with the same uid reference the same
+    # data, so any of their rows will do.
+    op.execute("""
+        INSERT INTO blobs_new (uid, date, checksum, size, valid, enc_version, enc_envkey, enc_nonce, stored_size, etag, refcount)
+        SELECT b.uid, b.date, {}, b.size, b.valid, b.enc_version, {}, {}, o.size, o.etag, coalesce(o.refcount, 0)
+        FROM (
+            SELECT uid, min(date) AS date, min(checksum) AS checksum, min(size) AS size, min(valid) AS valid,
+                min(enc_version) AS enc_version, min(enc_envkey) AS enc_envkey, min(enc_nonce) AS enc_nonce
+            FROM blocks WHERE uid IS NOT NULL GROUP BY uid
+        ) b LEFT JOIN blobs o ON o.uid = b.uid
+        """.format(unhex.format('b.checksum'), unhex.format('b.enc_envkey'), unhex.format('b.enc_nonce')))
+    # and one blob per size of sparse blocks
+    op.execute("""
+        INSERT INTO blobs_new (uid, date, checksum, size, valid, enc_version, refcount)
+        SELECT NULL, min(date), NULL, size, min(valid), 0, 0
+        FROM blocks WHERE uid IS NULL GROUP BY size
+        """)
+    op.execute("""
+        INSERT INTO blocks_new (version_uid, id, blob_id)
+        SELECT k.version_uid, k.id, n.id
+        FROM blocks k JOIN blobs_new n ON n.uid = k.uid
+        """)
+    op.execute("""
+        INSERT INTO blocks_new (version_uid, id, blob_id)
+        SELECT k.version_uid, k.id, n.id
+        FROM blocks k JOIN blobs_new n ON n.uid IS NULL
+            AND (n.size = k.size OR (n.size IS NULL AND k.size IS NULL))
+        WHERE k.uid IS NULL
+        """)
+
+    op.drop_table('blocks')
+    op.drop_table('blobs')
+    op.rename_table('blobs_new', 'blobs')
+    op.rename_table('blocks_new', 'blocks')
+    op.create_index(op.f('ix_blobs_uid'), 'blobs', ['uid'], unique=True)
+    op.create_index(op.f('ix_blobs_checksum'), 'blobs', ['checksum'], unique=False)
+    op.create_index(op.f('ix_blocks_blob_id'), 'blocks', ['blob_id'], unique=False)
+
+
+def downgrade():
+    bind = op.get_bind()
+    hex_ = _hex(bind)
+    op.create_table('blocks_old',
+    sa.Column('uid', sa.String(length=32), nullable=True),
+    sa.Column('version_uid', sa.String(length=36), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.DateTime(), nullable=False),
+    sa.Column('checksum', sa.String(length=128), nullable=True),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('valid', sa.Integer(), nullable=False),
+    sa.Column('enc_version', sa.Integer(), nullable=False),
+    sa.Column('enc_envkey', sa.String(length=80), nullable=True),
+    sa.Column('enc_nonce', sa.String(length=32), nullable=True),
+    sa.ForeignKeyConstraint(['version_uid'], ['versions.uid'], ),
+    sa.PrimaryKeyConstraint('version_uid', 'id')
+    )
+    op.create_table('blobs_old',
+    sa.Column('uid', sa.String(length=32), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=True),
+    sa.Column('etag', sa.String(length=64), nullable=True),
+    sa.Column('refcount', sa.Integer(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('uid')
+    )
+    op.execute("""
+        INSERT INTO blocks_old (uid, version_uid, id, date, checksum, size, valid, enc_version, enc_envkey, enc_nonce)
+        SELECT b.uid, k.version_uid, k.id, b.date, {}, b.size, b.valid, b.enc_version, {}, {}
+        FROM blocks k JOIN blobs b ON b.id = k.blob_id
+        """.format(hex_.format('b.checksum'), hex_.format('b.enc_envkey'), hex_.format('b.enc_nonce')))
+    op.execute("""
+        INSERT INTO blobs_old (uid, size, etag, refcount)
+        SELECT uid, stored_size, etag, refcount
+        FROM blobs WHERE uid IS NOT NULL
+        """)
+
+    op.drop_table('blocks')
+    op.drop_table('blobs')
+    op.rename_table('blobs_old', 'blobs')
+    op.rename_table('blocks_old', 'blocks')
+    op.create_index(op.f('ix_blocks_uid'), 'blocks', ['uid'], unique=False)
+    op.create_index(op.f('ix_blocks_checksum'), 'blocks', ['checksum'], unique=False)
@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+""" Serves versions as block devices over the NBD protocol (fixed newstyle
+handshake), see
+https://github.com/NetworkBlockDevice/nbd/blob/master/doc/proto.md
+
+Each version is an export named by its uid. Requests of a connection are
+processed by a pool of workers, so many of them can be in flight, and their
+replies are sent as they're done. With structured replies, the
+base:allocation meta context reports sparse blocks as holes.
+"""
+
+from backy2.blockreader import TemporaryBlockStore, VersionBlocks
+from backy2.logging import logger
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock, Thread
+import socket
+import struct
+
+NBDMAGIC = b'NBDMAGIC'
+IHAVEOPT = b'IHAVEOPT'
+REPLY_MAGIC = 0x3e889045565a9
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY_MAGIC = 0x67446698
+STRUCTURED_REPLY_MAGIC = 0x668e33ef
+
+# handshake flags
+FLAG_FIXED_NEWSTYLE = 1 << 0
+FLAG_NO_ZEROES = 1 << 1
+FLAG_C_NO_ZEROES = 1 << 1
+
+# transmission flags
+FLAG_HAS_FLAGS = 1 << 0
+FLAG_READ_ONLY = 1 << 1
+FLAG_SEND_FLUSH = 1 << 2
+FLAG_SEND_WRITE_ZEROES = 1 << 6
+FLAG_CAN_MULTI_CONN = 1 << 8
+
+# options
+OPT_EXPORT_NAME = 1
+OPT_ABORT = 2
+OPT_LIST = 3
+OPT_INFO = 6
+OPT_GO = 7
+OPT_STRUCTURED_REPLY = 8
+OPT_LIST_META_CONTEXT = 9
+OPT_SET_META_CONTEXT = 10
+
+# option replies
+REP_ACK = 1
+REP_SERVER = 2
+REP_INFO = 3
+REP_META_CONTEXT = 4
+REP_ERR_UNSUP = 2**31 + 1
+REP_ERR_INVALID = 2**31 + 3
+REP_ERR_UNKNOWN = 2**31 + 6
+
+INFO_EXPORT = 0
+INFO_BLOCK_SIZE = 3
+
+# commands
+CMD_READ = 0
+CMD_WRITE = 1
+CMD_DISC = 2
+CMD_FLUSH = 3
+CMD_WRITE_ZEROES = 6
+CMD_BLOCK_STATUS = 7
+
+# structured replies
+REPLY_FLAG_DONE = 1 << 0
+REPLY_TYPE_NONE = 0
+REPLY_TYPE_OFFSET_DATA = 1
+REPLY_TYPE_BLOCK_STATUS = 5
+REPLY_TYPE_ERROR = 2**15 + 1
+
+BASE_ALLOCATION = b'base:allocation'
+BASE_ALLOCATION_ID = 1
+STATE_HOLE = 1 << 0
+STATE_ZERO = 1 << 1
+
+# errors
+EPERM = 1
+EIO = 5
+EINVAL = 22
+ENOSPC = 28
+
+MAX_REQUEST_SIZE = 32 * 1024 * 1024
+
+_option = struct.Struct('>QII')  # IHAVEOPT, option, length
+_option_reply = struct.Struct('>QIII')  # magic, option, reply type, length
+_request = struct.Struct('>IHHQQI')  # magic, flags, type, handle, offset, length
+_simple_reply = struct.Struct('>IIQ')  # magic, error, handle
+_structured_reply = struct.Struct('>IHHQI')  # magic, flags, type, handle, length
+
+
+class NbdError(Exception):
+    """ Fails a request with the NBD error number error """
+
+    def __init__(self, error, message):
+        super().__init__(message)
+        self.error = error
+
+
+class Export():
+    """ A version served by the NBD server """
+
+    def __init__(self, version_blocks, size, block_size, block_reader, cachedir, writable):
+        self.version_blocks = version_blocks
+        self.size = size
+        self.block_size = block_size
+        self.block_reader = block_reader
+        self.writable = writable
+        self.temporary_block_store = TemporaryBlockStore(cachedir) if writable else None
+        self._cow_lock = Lock()
+        self._sparse_block = bytes(block_size)  # shared by all sparse reads
+
+
+    def flags(self):
+        if not self.writable:
+            return FLAG_HAS_FLAGS | FLAG_READ_ONLY | FLAG_CAN_MULTI_CONN
+        return FLAG_HAS_FLAGS | FLAG_SEND_FLUSH | FLAG_SEND_WRITE_ZEROES
+
+
+    def _blocks(self, offset, length):
+        """ Yields (block_id, offset in the block, length) covering the range """
+        while length > 0:
+            block_id, block_offset = divmod(offset, self.block_size)
+            _length = min(length, self.block_size - block_offset)
+            yield block_id, block_offset, _length
+            offset += _length
+            length -= _length
+
+
+    def _check_range(self, offset, length, error=EINVAL):
+        if offset + length > self.size:
+            raise NbdError(error, 'Request beyond the end of the export ({} bytes at {}).'.format(length, offset))
+
+
+    def _block(self, block_id):
+        """ Returns the block or None if it's sparse """
+        try:
+            return self.version_blocks.get(block_id)
+        except KeyError as e:
+            raise NbdError(EIO, e.args[0])
+
+
+    def _read_block(self, block_id):
+        if self.temporary_block_store and self.temporary_block_store.has_block(block_id):
+            return self.temporary_block_store.read_block(block_id)
+        block = self._block(block_id)
+        if block is None:
+            return self._sparse_block
+        try:
+            return self.block_reader.read(block)
+        except Exception:  # logged by the block reader
+            raise NbdError(EIO, 'Reading block {} failed.'.format(block_id))
+
+
+    def read(self, offset, length):
+        self._check_range(offset, length)
+        return b''.join([
+            memoryview(self._read_block(block_id))[block_offset:block_offset+_length]
+            for block_id, block_offset, _length in self._blocks(offset, length)])
+
+
+    def readahead(self, offset, blocks):
+        """ Starts reading the blocks from offset on """
+        first_block_id = offset // self.block_size
+        for block_id in range(first_block_id, min(first_block_id + blocks, len(self.version_blocks))):
+            if self.temporary_block_store and self.temporary_block_store.has_block(block_id):
+                continue
+            try:
+                block = self.version_blocks.get(block_id)
+            except KeyError:
+                continue
+            if block is not None:
+                self.block_reader.fetch(block)
+
+
+    def write(self, offset, data):
+        if not self.writable:
+            raise NbdError(EPERM, 'The export is read only.')
+        self._check_range(offset, len(data), ENOSPC)
+        data = memoryview(data)
+        for block_id, block_offset, _length in self._blocks(offset, len(data)):
+            with self._cow_lock:  # or concurrent writes to a new block would overwrite each other
+                if not self.temporary_block_store.has_block(block_id):
+                    self.temporary_block_store.write_block(block_id, self._read_block(block_id))
+            self.temporary_block_store.patch_block(block_id, data[:_length], block_offset)
+            data = data[_length:]
+
+
+    def block_status(self, offset, length):
+        """ Returns a list of (length, flags) of base:allocation from offset
+        on. Blocks with the same state are merged. """
+        self._check_range(offset, length)
+        descriptors = []
+        for block_id, block_offset, _length in self._blocks(offset, length):
+            if self.temporary_block_store and self.temporary_block_store.has_block(block_id):
+                flags = 0
+            else:
+                try:
+                    flags = 0 if self.version_blocks.get(block_id) else STATE_HOLE | STATE_ZERO
+                except KeyError:
+                    flags = 0  # missing, reads fail
+            if descriptors and descriptors[-1][1] == flags:
+                descriptors[-1][0] += _length
+            else:
+                descriptors.append([_length, flags])
+        return [tuple(descriptor) for descriptor in descriptors]
+
+
+class Connection():
+    """ A client's connection. Requests are read here and processed by the
+    server's workers. Replies are sent by the workers. """
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.export = None
+        self.structured_replies = False
+        self.meta_context = False  # base:allocation has been selected
+        self._send_lock = Lock()
+        self._last_read_end = None
+
+
+    def _recv(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise EOFError('Connection closed by the client.')
+            data.extend(chunk)
+        return bytes(data)
+
+
+    def _send(self, *parts):
+        with self._send_lock:
+            self.sock.sendall(b''.join(parts))
+
+
+    def _reply_option(self, option, reply_type, data=b''):
+        self._send(_option_reply.pack(REPLY_MAGIC, option, reply_type, len(data)), data)
+
+
+    def handle(self):
+        try:
+            if self._handshake():
+                self._transmission()
+        except (EOFError, ConnectionError) as e:
+            logger.debug('NBD connection ended: {}'.format(e))
+        except RuntimeError as e:
+            if not self.server._closing:
+                raise
+            logger.debug('NBD connection ended by the shutdown: {}'.format(e))  # the workers are gone
+        finally:
+            self.sock.close()
+            self.server._ended(self)
+
+
+    def close(self):
+        """ Ends the connection. Requests in flight are still processed, but
+        their replies fail. """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # already closed
+
+
+    def _handshake(self):
+        """ Negotiates the export. Returns False if the client aborted. """
+        self._send(NBDMAGIC, IHAVEOPT, struct.pack('>H', FLAG_FIXED_NEWSTYLE | FLAG_NO_ZEROES))
+        client_flags, = struct.unpack('>I', self._recv(4))
+        while True:
+            magic, option, length = _option.unpack(self._recv(_option.size))
+            if magic != struct.unpack('>Q', IHAVEOPT)[0]:
+                raise EOFError('Invalid option magic.')
+            if length > 65536:
+                raise EOFError('Option too long.')
+            data = self._recv(length)
+
+            if option == OPT_EXPORT_NAME:
+                export = self.server.get_export(data.decode('utf-8', 'replace'))
+                if export is None:
+                    return False  # the protocol only allows to close the connection
+                self.export = export
+                self._send(struct.pack('>QH', export.size, export.flags()), b'' if client_flags & FLAG_C_NO_ZEROES else bytes(124))
+                return True
+            elif option == OPT_ABORT:
+                self._reply_option(option, REP_ACK)
+                return False
+            elif option == OPT_LIST:
+                for name in self.server.exports:
+                    name = name.encode('utf-8')
+                    self._reply_option(option, REP_SERVER, struct.pack('>I', len(name)) + name)
+                self._reply_option(option, REP_ACK)
+            elif option in (OPT_INFO, OPT_GO):
+                try:
+                    name_length, = struct.unpack_from('>I', data)
+                    name = data[4:4 + name_length].decode('utf-8', 'replace')
+                except struct.error:
+                    self._reply_option(option, REP_ERR_INVALID)
+                    continue
+                export = self.server.get_export(name)
+                if export is None:
+                    self._reply_option(option, REP_ERR_UNKNOWN)
+                    continue
+                self._reply_option(option, REP_INFO, struct.pack('>HQH', INFO_EXPORT, export.size, export.flags()))
+                self._reply_option(option, REP_INFO, struct.pack('>HIII', INFO_BLOCK_SIZE, 1, export.block_size, MAX_REQUEST_SIZE))
+                self._reply_option(option, REP_ACK)
+                if option == OPT_GO:
+                    self.export = export
+                    return True
+            elif option == OPT_STRUCTURED_REPLY:
+                self.structured_replies = True
+                self._reply_option(option, REP_ACK)
+            elif option in (OPT_LIST_META_CONTEXT, OPT_SET_META_CONTEXT):
+                if option == OPT_SET_META_CONTEXT and not self.structured_replies:
+                    self._reply_option(option, REP_ERR_INVALID)
+                    continue
+                try:
+                    queries = self._meta_context_queries(data)
+                except struct.error:
+                    self._reply_option(option, REP_ERR_INVALID)
+                    continue
+                selected = any(query in (BASE_ALLOCATION, b'base:') for query in queries) or \
+                    (option == OPT_LIST_META_CONTEXT and not queries)
+                if option == OPT_SET_META_CONTEXT:
+                    self.meta_context = selected
+                if selected:
+                    self._reply_option(option, REP_META_CONTEXT, struct.pack('>I', BASE_ALLOCATION_ID) + BASE_ALLOCATION)
+                self._reply_option(option, REP_ACK)
+            else:
+                self._reply_option(option, REP_ERR_UNSUP)
+
+
+    def _meta_context_queries(self, data):
+        name_length, = struct.unpack_from('>I', data)
+        offset = 4 + name_length
+        num_queries, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        queries = []
+        for i in range(num_queries):
+            query_length, = struct.unpack_from('>I', data, offset)
+            offset += 4
+            queries.append(data[offset:offset + query_length])
+            offset += query_length
+        return queries
+
+
+    def _transmission(self):
+        in_flight = []
+        try:
+            while True:
+                magic, flags, _type, handle, offset, length = _request.unpack(self._recv(_request.size))
+                if magic != REQUEST_MAGIC:
+                    raise EOFError('Invalid request magic.')
+                if _type == CMD_DISC:
+                    break
+                data = None
+                if _type == CMD_WRITE:
+                    if length > MAX_REQUEST_SIZE:
+                        raise EOFError('Write request too big.')  # the data can't be skipped reliably
+                    data = self._recv(length)
+                elif _type == CMD_READ and self._last_read_end == offset:
+                    self.export.readahead(offset + length, self.server.readahead_blocks)
+                if _type == CMD_READ:
+                    self._last_read_end = offset + length
+                in_flight = [f for f in in_flight if not f.done()]
+                in_flight.append(self.server.workers.submit(self._process, _type, handle, offset, length, data))
+        finally:
+            wait(in_flight)  # finish all requests before disconnecting, also when the connection broke
+
+
+    def _process(self, _type, handle, offset, length, data):
+        try:
+            try:
+                if length > MAX_REQUEST_SIZE:
+                    raise NbdError(EINVAL, 'Request too big ({} bytes).'.format(length))
+                if _type == CMD_READ:
+                    self._reply_data(handle, offset, self.export.read(offset, length))
+                elif _type == CMD_WRITE:
+                    self.export.write(offset, data)
+                    self._reply(handle)
+                elif _type == CMD_WRITE_ZEROES:
+                    self.export.write(offset, bytes(length))
+                    self._reply(handle)
+                elif _type == CMD_FLUSH:
+                    self._reply(handle)  # writes are in the temporary block store when they're replied
+                elif _type == CMD_BLOCK_STATUS and self.meta_context:
+                    self._reply_block_status(handle, self.export.block_status(offset, length))
+                else:
+                    raise NbdError(EINVAL, 'Unsupported command {}.'.format(_type))
+            except NbdError as e:
+                logger.error('NBD request failed: {}'.format(e))
+                self._reply_error(handle, e.error, str(e))
+        except OSError as e:
+            logger.debug('NBD reply failed: {}'.format(e))
+
+
+    def _reply(self, handle):
+        if self.structured_replies:
+            self._send(_structured_reply.pack(STRUCTURED_REPLY_MAGIC, REPLY_FLAG_DONE, REPLY_TYPE_NONE, handle, 0))
+        else:
+            self._send(_simple_reply.pack(SIMPLE_REPLY_MAGIC, 0, handle))
+
+
+    def _reply_data(self, handle, offset, data):
+        if self.structured_replies:
+            self._send(_structured_reply.pack(STRUCTURED_REPLY_MAGIC, REPLY_FLAG_DONE, REPLY_TYPE_OFFSET_DATA, handle, 8 + len(data)),
+                struct.pack('>Q', offset), data)
+        else:
+            self._send(_simple_reply.pack(SIMPLE_REPLY_MAGIC, 0, handle), data)
+
+
+    def _reply_block_status(self, handle, descriptors):
+        payload = struct.pack('>I', BASE_ALLOCATION_ID) + b''.join(struct.pack('>II', length, flags) for length, flags in descriptors)
+        self._send(_structured_reply.pack(STRUCTURED_REPLY_MAGIC, REPLY_FLAG_DONE, REPLY_TYPE_BLOCK_STATUS, handle, len(payload)), payload)
+
+
+    def _reply_error(self, handle, error, message):
+        if self.structured_replies:
+            message = message.encode('utf-8')[:4096]
+            payload = struct.pack('>IH', error, len(message)) + message
+            self._send(_structured_reply.pack(STRUCTURED_REPLY_MAGIC, REPLY_FLAG_DONE, REPLY_TYPE_ERROR, handle, len(payload)), payload)
+        else:
+            self._send(_simple_reply.pack(SIMPLE_REPLY_MAGIC, error, handle))
+
+
+class NbdServer():
+    """ Serves versions over NBD. The first version is the default export
+    for clients which ask for an empty name. With writable, writes are
+    kept in a temporary file in cachedir per version (copy-on-write). """
+
+    READAHEAD_BLOCKS = 8  # blocks to prefetch after sequential reads
+
+    def __init__(self, backy, version_uids, block_reader, cachedir='/tmp', writable=False, workers=16):
+        self.backy = backy
+        self.block_reader = block_reader
+        self.readahead_blocks = self.READAHEAD_BLOCKS
+        self.exports = {}
+        for version_uid in version_uids:
+            version = backy.meta_backend.get_version(version_uid)
+            self.exports[version.uid] = Export(
+                VersionBlocks.load(backy.meta_backend, version.uid),
+                version.size_bytes,
+                backy.block_size,
+                block_reader,
+                cachedir,
+                writable,
+                )
+        self.workers = ThreadPoolExecutor(max_workers=workers)
+        self._sock = None
+        self._closing = False
+        self._lock = Lock()
+        self._connections = {}  # Connection: Thread handling it
+
+
+    def get_export(self, name):
+        if name == '':
+            return next(iter(self.exports.values()))
+        return self.exports.get(name)
+
+
+    def listen(self, address='127.0.0.1', port=10809, unix_socket=None):
+        if unix_socket:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(unix_socket)
+        else:
+            self._sock = socket.socket(socket.AF_INET6 if ':' in address else socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind((address, port))
+        self._sock.listen(16)
+        logger.info('Serving versions {} via NBD on {}.'.format(', '.join(self.exports), unix_socket or '{}:{}'.format(address, port)))
+
+
+    def serve(self):
+        """ Accepts connections until shutdown is called """
+        while True:
+            try:
+                sock, address = self._sock.accept()
+            except OSError:
+                if self._closing:
+                    break
+                raise
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            logger.debug('NBD connection from {}'.format(address))
+            connection = Connection(self, sock)
+            with self._lock:
+                if self._closing:
+                    sock.close()
+                    break
+                self._connections[connection] = Thread(target=connection.handle, daemon=True)
+                self._connections[connection].start()
+
+
+    def _ended(self, connection):
+        with self._lock:
+            self._connections.pop(connection, None)
+
+
+    def shutdown(self):
+        """ Stops accepting connections and ends the open ones. Returns when
+        their requests in flight are processed, so that changes() is complete
+        afterwards. """
+        with self._lock:
+            self._closing = True
+            connections = dict(self._connections)
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)  # wakes up accept in another thread
+        except OSError:
+            pass
+        self._sock.close()
+        for connection in connections:
+            connection.close()
+        for thread in connections.values():
+            thread.join()
+
+
+    def changes(self):
+        """ Returns a dict version_uid: iterable of (block_id, data) of
+        all written versions, see Backy.commit_blocks. """
+        return dict((version_uid, export.temporary_block_store.blocks())
+            for version_uid, export in self.exports.items()
+            if export.temporary_block_store and export.temporary_block_store.db)
+
+
+    def close(self):
+        """ Call shutdown first, or connections may still submit requests. """
+        self.workers.shutdown(wait=True)
+        self.block_reader.close()
@@ -3,7 +3,7 @@
 
 from backy2.config import Config as _Config
 from backy2.logging import logger, init_logging
-from backy2.utils import hints_from_rbd_diff, backy_from_config, convert_to_timedelta, parse_expire_date, humanize
+from backy2.utils import hints_from_rbd_diff, backy_from_config, convert_to_timedelta, parse_expire_date, humanize, parse_range
 from datetime import date, datetime
 from functools import partial
 from io import StringIO
@@ -98,9 +98,36 @@ class Commands():
         backy.close()
 
 
-    def restore(self, version_uid, target, sparse, force, continue_from):
+    def clone(self, version_uid, name, snapshot_name, tag=None, expire=None):
+        expire_date = None
+        if expire:
+            try:
+                expire_date = parse_expire_date(expire)
+            except ValueError as e:
+                logger.error(str(e))
+                exit(1)
+        if tag:
+            tags = [t.strip() for t in list(csv.reader(StringIO(tag)))[0]]
+        else:
+            tags = None
+        backy = self.backy()
+        new_version_uid = backy.clone(version_uid, name, snapshot_name, tags, expire_date)
+        if self.machine_output:
+            print(new_version_uid)
+        backy.close()
+
+
+    def restore(self, version_uid, target, sparse, force, continue_from, range, pack, resume):
+        try:
+            ranges = [parse_range(r) for r in range] if range else None
+        except ValueError as e:
+            logger.error(str(e))
+            exit(1)
+        if pack and not ranges:
+            logger.error('--pack requires at least one --range.')
+            exit(1)
         backy = self.backy()
-        backy.restore(version_uid, target, sparse, force, int(continue_from))
+        backy.restore(version_uid, target, sparse, force, int(continue_from), ranges, pack, resume)
         backy.close()
 
 
@@ -124,27 +151,82 @@ class Commands():
         backy.close()
 
 
-    def scrub(self, version_uid, source, percentile):
+    def prune(self, name, schedulers, force, dry_run, fields):
+        config_DEFAULTS = self.Config(section='DEFAULTS')
+        disallow_rm_when_younger_than_days = int(config_DEFAULTS.get('disallow_rm_when_younger_than_days', '0'))
+        keeps = {}
+        if schedulers:
+            for scheduler in [s.strip() for s in list(csv.reader(StringIO(schedulers)))[0]]:
+                keeps[scheduler] = self.Config(section=scheduler).getint('keep')
+        backy = self.backy()
+        candidates = backy.get_prune_candidates(keeps, name, force, disallow_rm_when_younger_than_days)
+        values = []
+        for version, reason in candidates:
+            values.append({
+                'date': version.date,
+                'name': version.name,
+                'snapshot_name': version.snapshot_name,
+                'uid': version.uid,
+                'tags': ",".join([t.name for t in version.tags]),
+                'expire': version.expire if version.expire else '',
+                'reason': reason,
+            })
+        if not dry_run:
+            removed = set(backy.prune([v['uid'] for v in values]))
+            values = [v for v in values if v['uid'] in removed]
+        backy.close()
+
+        fields = [f.strip() for f in list(csv.reader(StringIO(fields)))[0]]
+        if self.machine_output:
+            self._machine_output(fields, values)
+        else:
+            self._tbl_output(fields, values, alignments={'name': 'l', 'snapshot_name': 'l', 'tags': 'l'})
+
+
+    def scrub(self, version_uid, source, percentile, all_versions, max_age, rate, mode):
+        if all_versions == bool(version_uid):
+            logger.error('Please give either a version_uid or --all.')
+            exit(1)
+        if mode != 'full' and (all_versions or source):
+            logger.error('--mode {} can neither be used with --all nor with --source.'.format(mode))
+            exit(1)
+        if not all_versions and (max_age is not None or rate is not None):
+            logger.error('--max-age and --rate can only be used with --all.')
+            exit(1)
         if percentile:
             percentile = int(percentile)
         backy = self.backy()
-        state = backy.scrub(version_uid, source, percentile)
+        if all_versions:
+            config_DEFAULTS = self.Config(section='DEFAULTS')
+            if max_age is None:
+                max_age = config_DEFAULTS.get('scrub_max_age', '0d')
+            if rate is None:
+                rate = config_DEFAULTS.getfloat('scrub_rate', 0)
+            state = backy.scrub_all(convert_to_timedelta(max_age), float(rate))
+        else:
+            state = backy.scrub(version_uid, source, percentile, mode)
         backy.close()
         if not state:
             exit(20)
 
 
+    def verify_target(self, version_uid, target, fields):
+        backy = self.backy()
+        ranges = backy.verify_target(version_uid, target)
+        backy.close()
+        fields = [f.strip() for f in list(csv.reader(StringIO(fields)))[0]]
+        values = [{'offset': offset, 'length': length} for offset, length in ranges]
+        if self.machine_output:
+            self._machine_output(fields, values, humanize_columns=('length', ))
+        elif values:
+            self._tbl_output(fields, values, alignments={'offset': 'r', 'length': 'r'}, humanize_columns=('length', ))
+        if ranges:
+            exit(20)
+
+
     def ls(self, name, snapshot_name, tag, expired, fields):
         backy = self.backy()
-        versions = backy.ls()
-        if name:
-            versions = [v for v in versions if v.name == name]
-        if snapshot_name:
-            versions = [v for v in versions if v.snapshot_name == snapshot_name]
-        if tag:
-            versions = [v for v in versions if tag in [t.name for t in v.tags]]
-        if expired:
-            versions = [v for v in versions if v.expire and v.expire < datetime.utcnow()]
+        versions = backy.ls(name=name or None, snapshot_name=snapshot_name or None, tag=tag or None, expired=expired)
 
         fields = [f.strip() for f in list(csv.reader(StringIO(fields)))[0]]
         values = []
@@ -178,45 +260,37 @@ class Commands():
         """
         # TODO: Feel free to create a default diff format.
         backy = self.backy()
-        blocks1 = backy.ls_version(version_uid1)
-        blocks2 = backy.ls_version(version_uid2)
-        max_len = max(len(blocks1), len(blocks2))
-        for i in range(max_len):
-            b1 = b2 = None
+        blob_ids1 = backy.get_block_map(version_uid1)
+        blob_ids2 = backy.get_block_map(version_uid2)
+        for i in range(max(len(blob_ids1), len(blob_ids2))):
             try:
-                b1 = blocks1.pop(0)
-            except IndexError:
-                pass
-            try:
-                b2 = blocks2.pop(0)
-            except IndexError:
-                pass
-            if b1 and b2:
-                assert b1.id == b2.id
-            try:
-                if b1.uid == b2.uid:
-                    print('SAME      {}'.format(b1.id))
-                elif b1 is None and b2:
-                    print('NEW RIGHT {}'.format(b2.id))
-                elif b1 and b2 is None:
-                    print('NEW LEFT  {}'.format(b1.id))
+                if i >= len(blob_ids1):
+                    print('NEW RIGHT {}'.format(i))
+                elif i >= len(blob_ids2):
+                    print('NEW LEFT  {}'.format(i))
+                elif blob_ids1[i] == blob_ids2[i]:
+                    print('SAME      {}'.format(i))
                 else:
-                    print('DIFF      {}'.format(b1.id))
+                    print('DIFF      {}'.format(i))
             except BrokenPipeError:
                 pass
         backy.close()
 
 
-    def du(self, version_uid=None, fields=None):
+    def du(self, version_uid=None, fields=None, approx=False, name=None, tag=None, older_than=None):
         """ Output disk usage for a version
         """
         backy = self.backy()
+        if approx:
+            return self._du_approx(backy, version_uid, fields, name, tag, older_than)
         if version_uid:
             version_uids = [version_uid]
         else:
             _versions = backy.ls()
             version_uids = [v.uid for v in _versions]
 
+        if fields is None:
+            fields = "Real,Null,Dedup Own,Dedup Others,Individual,Est. Space,Est. Space freed"
         fields = [f.strip() for f in list(csv.reader(StringIO(fields)))[0]]
         values = []
         for version_uid in version_uids:
@@ -246,6 +320,57 @@ class Commands():
             )
 
 
+    def _du_approx(self, backy, version_uid, fields, name, tag, older_than):
+        """ Output estimated disk usage for the selected group of versions or
+        for each version name
+        """
+        if version_uid or name or tag or older_than:
+            selected = backy.ls(name=name or None, tag=tag or None)
+            if version_uid:
+                selected = [v for v in selected if v.uid == version_uid]
+            if older_than:
+                dt = datetime.utcnow() - convert_to_timedelta(older_than)
+                selected = [v for v in selected if v.date < dt]
+            # named by the version or name, otherwise by the other criteria
+            label = name or version_uid or ', '.join(filter(None, [
+                tag and 'tag {}'.format(tag),
+                older_than and 'older than {}'.format(older_than),
+                ]))
+            groups = {label: [v.uid for v in selected]}
+        else:
+            groups = {}
+            for version in backy.ls():
+                groups.setdefault(version.name, []).append(version.uid)
+
+        estimates = backy.du_approx(groups)
+        backy.close()
+        if fields is None:
+            fields = "Name,Versions,Est. Space,Est. Shared,Est. Space freed"
+        fields = [f.strip() for f in list(csv.reader(StringIO(fields)))[0]]
+        values = []
+        for group_name, estimate in sorted(estimates.items()):
+            values.append({
+                'Name': group_name,
+                'Versions': estimate['versions'],
+                'Est. Space': estimate['space'],
+                'Est. Shared': estimate['shared'],
+                'Est. Space freed': estimate['space_freed'],
+                })
+
+        humanize_columns = ('Est. Space', 'Est. Shared', 'Est. Space freed')
+        if self.machine_output:
+            self._machine_output(fields, values, humanize_columns=humanize_columns)
+        else:
+            self._tbl_output(fields, values, alignments={
+                'Name': 'l',
+                'Versions': 'r',
+                'Est. Space': 'r',
+                'Est. Shared': 'r',
+                'Est. Space freed': 'r',
+                }, humanize_columns=humanize_columns,
+            )
+
+
     def stats(self, version_uid, fields, limit=None):
         backy = self.backy()
         if limit is not None:
@@ -304,23 +429,32 @@ class Commands():
         backy.close()
 
 
-    def export(self, version_uid, filename='-'):
+    def export(self, version_uid, filename='-', csv=False):
         backy = self.backy()
         if filename == '-':
-            f = StringIO()
-            backy.export(version_uid, f)
-            f.seek(0)
-            print(f.read())
-            f.close()
+            if csv:
+                f = StringIO()
+                backy.export(version_uid, f, as_csv=True)
+                f.seek(0)
+                print(f.read())
+                f.close()
+            else:
+                backy.export(version_uid, sys.stdout.buffer)
+                sys.stdout.buffer.flush()
         else:
-            with open(filename, 'w') as f:
-                backy.export(version_uid, f)
+            with open(filename, 'w' if csv else 'wb') as f:
+                backy.export(version_uid, f, as_csv=csv)
         backy.close()
 
 
-    def fuse(self, mount):
+    def fuse(self, mount, commit=False):
+        backy = self.backy()
+        backy.fuse(mount, commit)
+
+
+    def nbd(self, version_uid, address, port, unix_socket, writable, commit):
         backy = self.backy()
-        backy.fuse(mount)
+        backy.nbd(version_uid, address, port, unix_socket, writable, commit)
 
 
     def rekey(self, oldkey):
@@ -337,9 +471,9 @@ class Commands():
         backy = self.backy()
         try:
             if filename=='-':
-                backy.import_(sys.stdin)
+                backy.import_(sys.stdin.buffer)
             else:
-                with open(filename, 'r') as f:
+                with open(filename, 'rb') as f:
                     backy.import_(f)
         except KeyError as e:
             logger.error(str(e))
@@ -387,14 +521,34 @@ class Commands():
             logger.warn('Unable to expire version.')
 
 
-    def due(self, name, schedulers, fields):
-        schedulers = [s.strip() for s in list(csv.reader(StringIO(schedulers)))[0]]
-        backy = self.backy()
-        versions = backy.ls()
+    def _versions_by_name(self, backy, name, schedulers):
+        """ Loads all versions once for checking each name's versions in
+        memory. Returns the names, a dict name: valid versions sorted by date
+        and a dict scheduler: (interval, keep, sla).
+        """
+        versions_by_name = {}
+        for version in backy.ls(name=name or None):
+            versions_by_name.setdefault(version.name, [])
+            if version.valid:
+                versions_by_name[version.name].append(version)
         if not name:
-            names = set([v.name for v in versions])
+            names = list(versions_by_name)
         else:
             names = [name]
+        _schedulers = {}
+        for scheduler in schedulers:
+            _schedulers[scheduler] = (
+                convert_to_timedelta(self.Config(section=scheduler).get('interval')),
+                self.Config(section=scheduler).getint('keep'),
+                convert_to_timedelta(self.Config(section=scheduler).get('sla')),
+                )
+        return names, versions_by_name, _schedulers
+
+
+    def due(self, name, schedulers, fields):
+        schedulers = [s.strip() for s in list(csv.reader(StringIO(schedulers)))[0]]
+        backy = self.backy()
+        names, versions_by_name, _schedulers = self._versions_by_name(backy, name, schedulers)
 
         due_backups = {}   # name: list of tags
         for name in names:
@@ -402,11 +556,9 @@ class Commands():
             _due_backup_expire_date = datetime.utcnow()
             _due_backup_due_since = datetime.utcnow()
             for scheduler in schedulers:
-                interval = convert_to_timedelta(self.Config(section=scheduler).get('interval'))
-                keep = self.Config(section=scheduler).getint('keep')
-                sla = convert_to_timedelta(self.Config(section=scheduler).get('sla'))
+                interval, keep, sla = _schedulers[scheduler]
 
-                _due_backup = backy.get_due_backups(name, scheduler, interval, keep, sla)  # True/False
+                _due_backup = backy.get_due_backups(name, scheduler, interval, keep, sla, versions_by_name.get(name, []))  # True/False
                 if _due_backup:
                     _due_schedulers.add(scheduler)
                     _due_backup_expire_date = max(_due_backup_expire_date, datetime.utcnow() + (keep + 1) * interval)
@@ -437,20 +589,14 @@ class Commands():
     def sla(self, name, schedulers, fields):
         schedulers = [s.strip() for s in list(csv.reader(StringIO(schedulers)))[0]]
         backy = self.backy()
-        versions = backy.ls()
-        if not name:
-            names = set([v.name for v in versions])
-        else:
-            names = [name]
+        names, versions_by_name, _schedulers = self._versions_by_name(backy, name, schedulers)
 
         sla_breaches = {}  # name: list of breaches
         for name in names:
             for scheduler in schedulers:
-                interval = convert_to_timedelta(self.Config(section=scheduler).get('interval'))
-                keep = self.Config(section=scheduler).getint('keep')
-                sla = convert_to_timedelta(self.Config(section=scheduler).get('sla'))
+                interval, keep, sla = _schedulers[scheduler]
 
-                _sla_breaches = backy.get_sla_breaches(name, scheduler, interval, keep, sla)  # list of strings
+                _sla_breaches = backy.get_sla_breaches(name, scheduler, interval, keep, sla, versions_by_name.get(name, []))  # list of strings
                 sla_breaches.setdefault(name, []).extend(_sla_breaches)
 
         field_names = [f.strip() for f in list(csv.reader(StringIO(fields)))[0]]
@@ -517,6 +663,19 @@ def main():
     p.add_argument('-e', '--expire', default='', help='Expiration date (yyyy-mm-dd or "yyyy-mm-dd HH-MM-SS") (optional)')
     p.set_defaults(func='backup')
 
+    # CLONE
+    p = subparsers.add_parser(
+        'clone',
+        help="Create a new version with the same blocks as a given version. Only meta data is copied.")
+    p.add_argument('version_uid', help='The version uid to clone')
+    p.add_argument('name', help='Name of the new version')
+    p.add_argument('-s', '--snapshot-name', default='', help='Snapshot name of the new version')
+    p.add_argument(
+        '-t', '--tag', default=None,
+        help='Use a specific tag (or multiple comma-separated tags) for the new version')
+    p.add_argument('-e', '--expire', default='', help='Expiration date (yyyy-mm-dd or "yyyy-mm-dd HH-MM-SS") (optional)')
+    p.set_defaults(func='clone')
+
     # RESTORE
     p = subparsers.add_parser(
         'restore',
@@ -525,9 +684,16 @@ def main():
         'only existing blocks (works only with file- and rbd-restore, not with lvm)')
     p.add_argument('-f', '--force', action='store_true', help='Force overwrite of existing files/devices/images')
     p.add_argument('-c', '--continue-from', default=0, help='Continue from this block (only use this for partially failed restores!)')
+    p.add_argument('--resume', action='store_true', help='Continue an '
+        'interrupted restore with the same version, targets and ranges from its checkpoint')
+    p.add_argument('-R', '--range', action='append', default=None,
+        help='Restore only this byte range of the version (offset:length, e.g. 1G:4M). May be given multiple times.')
+    p.add_argument('-p', '--pack', action='store_true', help='Write the given '
+        'ranges one after another to the start of the target instead of to their original offsets')
     p.add_argument('version_uid')
-    p.add_argument('target',
-        help='Source (url-like, e.g. file:///dev/sda or rbd://pool/imagename)')
+    p.add_argument('target', nargs='+',
+        help='Target (url-like, e.g. file:///dev/sda or rbd://pool/imagename). '
+        'Multiple targets may be given, each block is then read once and written to all of them.')
     p.set_defaults(func='restore')
 
     # PROTECT
@@ -552,6 +718,21 @@ def main():
     p.add_argument('version_uid')
     p.set_defaults(func='rm')
 
+    # PRUNE
+    p = subparsers.add_parser(
+        'prune',
+        help="Remove all expired versions and, with --schedulers, all versions which are not kept by any of their schedulers. "
+             "This will only remove meta data and you will have to cleanup after this.")
+    p.add_argument('name', nargs='?', default=None, help='Only prune versions with this name (optional).')
+    p.add_argument('-s', '--schedulers', default=None,
+            help="Also remove versions tagged with one of these schedulers as defined in backy.cfg (e.g. daily,weekly,monthly) "
+                 "which are not among the 'keep' newest valid versions of any of their schedulers.")
+    p.add_argument('--force', action='store_true', help="Also remove versions younger than the configured disallow_rm_when_younger_than_days.")
+    p.add_argument('-n', '--dry-run', action='store_true', help="Only show which versions would be removed.")
+    p.add_argument('-f', '--fields', default="date,name,snapshot_name,uid,tags,expire,reason",
+            help="Show these fields (comma separated). Available: date,name,snapshot_name,uid,tags,expire,reason")
+    p.set_defaults(func='prune')
+
     # SCRUB
     p = subparsers.add_parser(
         'scrub',
@@ -560,15 +741,35 @@ def main():
         help="Source, optional. If given, check if source matches backup in addition to checksum tests. url-like format as in backup.")
     p.add_argument('-p', '--percentile', default=100,
         help="Only check PERCENTILE percent of the blocks (value 0..100). Default: 100")
-    p.add_argument('version_uid')
+    p.add_argument('-a', '--all', dest='all_versions', action='store_true',
+        help="Scrub all versions, reading each blob only once.")
+    p.add_argument('-m', '--max-age', default=None,
+        help="With --all: Only scrub blobs which have not been scrubbed for this time (e.g. 30d). Default: scrub_max_age from config")
+    p.add_argument('-r', '--rate', default=None,
+        help="With --all: Scrub at most this many blobs per second (0 is unlimited). Default: scrub_rate from config")
+    p.add_argument('-M', '--mode', default='full', choices=['full', 'crypto', 'light'],
+        help="full reads and checks all blobs, crypto reads all blobs but only checks the encryption's authentication tag (no decompression and hashing), light only checks that the blobs exist with the size and etag recorded at backup time (no download). Default: full")
+    p.add_argument('version_uid', nargs='?', default=None)
     p.set_defaults(func='scrub')
 
+    # VERIFY-TARGET
+    p = subparsers.add_parser(
+        'verify-target',
+        help="Check that a target (e.g. a restore) matches a version, without reading from the data backend.")
+    p.add_argument('-f', '--fields', default="offset,length",
+            help="Show these fields for each differing range (comma separated). Available: offset,length")
+    p.add_argument('version_uid')
+    p.add_argument('target', help='Target to verify. url-like format as in restore, e.g. file:///tmp/restore or rbd://pool/image')
+    p.set_defaults(func='verify_target')
+
     # Export
     p = subparsers.add_parser(
         'export',
         help="Export the metadata of a backup uid into a file.")
     p.add_argument('version_uid')
     p.add_argument('filename', help="Export into this filename ('-' is for stdout)")
+    p.add_argument('-c', '--csv', action='store_true', default=False,
+        help="Export in the CSV format of earlier backy2 versions instead of the compressed binary format.")
     p.set_defaults(func='export')
 
     # Import
@@ -639,17 +840,44 @@ def main():
         'du',
         help="Get disk usage for a version or for all versions")
     p.add_argument('version_uid', nargs='?', default=None, help='Show disk usage for this version')
-    p.add_argument('-f', '--fields', default="Real,Null,Dedup Own,Dedup Others,Individual,Est. Space,Est. Space freed",
-            help="Show these fields (comma separated). Available: Real,Null,Dedup Own,Dedup Others,Individual,Est. Space,Est. Space freed)")
+    p.add_argument('-f', '--fields', default=None,
+            help="Show these fields (comma separated). Available: Real,Null,Dedup Own,Dedup Others,Individual,Est. Space,Est. Space freed "
+                 "(default all) and with --approx: Name,Versions,Est. Space,Est. Shared,Est. Space freed")
+    p.add_argument('-a', '--approx', action='store_true', default=False,
+            help='Estimate the disk usage of the versions selected by version_uid, --name, --tag and --older-than '
+                 'together (or of each version name if none of these is given) from per-version sketches. '
+                 'This is fast even with many blocks.')
+    p.add_argument('-n', '--name', default=None, help='With --approx: Select versions with this name')
+    p.add_argument('-t', '--tag', default=None, help='With --approx: Select versions with this tag')
+    p.add_argument('--older-than', default=None, help='With --approx: Select versions older than this (e.g. 30d)')
     p.set_defaults(func='du')
 
     # FUSE
     p = subparsers.add_parser(
         'fuse',
         help="Fuse mount backy backups")
+    p.add_argument('--commit', action='store_true', default=False,
+            help='When unmounting, save the changes to each written data file as a new version.')
     p.add_argument('mount', help='Mountpoint')
     p.set_defaults(func='fuse')
 
+    # NBD
+    p = subparsers.add_parser(
+        'nbd',
+        help="Serve versions as block devices via NBD")
+    p.add_argument('-a', '--address', default='127.0.0.1',
+            help='Listen on this address (default: 127.0.0.1)')
+    p.add_argument('-p', '--port', type=int, default=10809,
+            help='Listen on this port (default: 10809)')
+    p.add_argument('-u', '--unix-socket', default=None,
+            help='Listen on this UNIX socket instead of TCP')
+    p.add_argument('-w', '--writable', action='store_true', default=False,
+            help='Allow writes. They are kept in a temporary file in cachedir and lost when the server stops.')
+    p.add_argument('--commit', action='store_true', default=False,
+            help='Allow writes and save the changes to each written version as a new version when the server stops.')
+    p.add_argument('version_uid', nargs='+', help='Version UIDs to serve. The first one is the default export.')
+    p.set_defaults(func='nbd')
+
     # Re-Keying
     p = subparsers.add_parser(
         'rekey',
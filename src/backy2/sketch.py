@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+from array import array
+import hashlib
+import heapq
+
+K = 1024  # number of minimum values kept per sketch
+HASH_RANGE = 2**64
+
+
+def blob_hash(uid):
+    """ A 64 bit hash of a blob uid """
+    return int.from_bytes(hashlib.blake2b(uid.encode('ascii'), digest_size=8).digest(), 'little')
+
+
+class KMVSketch():
+    """ A k minimum values sketch of the blobs of a version: the k smallest
+    hashes of all blob uids, each with the blob's size.
+    Sketches of several versions can be united and as each hash which is
+    one of the k smallest of a union is also one of the k smallest of each
+    set containing it, the united sample can be checked against the single
+    sketches to estimate the intersections and differences of versions.
+    """
+
+    def __init__(self, entries=None, k=K):
+        self.k = k
+        self.entries = entries or {}  # hash: size
+
+
+    @classmethod
+    def from_blobs(cls, blobs, k=K):
+        """ Creates a sketch from an iterable of (uid, size) """
+        return cls(dict(heapq.nsmallest(k, ((blob_hash(uid), size) for uid, size in blobs))), k)
+
+
+    @classmethod
+    def from_bytes(cls, data, k=K):
+        values = array('Q')
+        values.frombytes(data)
+        n = len(values) // 2
+        return cls(dict(zip(values[:n], values[n:])), k)
+
+
+    def to_bytes(self):
+        hashes = sorted(self.entries)
+        return array('Q', hashes).tobytes() + array('Q', [self.entries[h] for h in hashes]).tobytes()
+
+
+def estimate_space(sketches, groups, k=K):
+    """ Estimates the space of groups of versions from their sketches.
+    sketches is a dict version_uid: KMVSketch of all versions, groups a dict
+    group name: list of version_uids.
+    Returns a dict group name: dict with the number of versions and the
+    estimated bytes referenced by the group ('space'), of these the bytes
+    also referenced by other versions ('shared') and the bytes only
+    referenced by the group ('space_freed', i.e. freed when the group is
+    deleted). Sparse blocks are not counted.
+    """
+    # the sample: the k smallest hashes of all versions
+    sizes = {}
+    for sketch in sketches.values():
+        sizes.update(sketch.entries)
+    sample = heapq.nsmallest(k, sizes)
+    if len(sample) < k:
+        scale = 1.0  # all blobs are in the sample
+    else:
+        # KMV estimator of the number of distinct blobs divided by the sample size
+        scale = (k - 1) / (sample[-1] / HASH_RANGE) / k
+
+    # which versions contain each hash of the sample
+    sample = set(sample)
+    containing = {h: set() for h in sample}
+    for version_uid, sketch in sketches.items():
+        for h in sample.intersection(sketch.entries):
+            containing[h].add(version_uid)
+
+    result = {}
+    for name, version_uids in groups.items():
+        version_uids = set(version_uids)
+        space = shared = 0
+        for h, _version_uids in containing.items():
+            if _version_uids.isdisjoint(version_uids):
+                continue
+            space += sizes[h]
+            if not _version_uids <= version_uids:
+                shared += sizes[h]
+        result[name] = {
+            'versions': len(version_uids),
+            'space': round(space * scale),
+            'shared': round(shared * scale),
+            'space_freed': round((space - shared) * scale),
+        }
+    return result
@@ -52,6 +52,85 @@ def backy(request):
     return backy
 
 
+@pytest.fixture(scope="function")
+def meta_backend(test_path):
+    from backy2.config import Config
+    from backy2.meta_backends.sql import MetaBackend
+    config = Config(cfg='[MetaBackend]\nengine: sqlite:///{}/backy.sqlite\n'.format(test_path), section='MetaBackend')
+    backend = MetaBackend(config)
+    backend.initdb()
+    backend.open()
+    yield backend
+    backend.close()
+
+
+TEST_CONFIG = """
+[DEFAULTS]
+logfile: {path}/backy.log
+block_size: 4096
+hash_function: sha512
+lock_dir: {path}
+cachedir: {path}
+encryption_version: 0
+disallow_rm_when_younger_than_days: 0
+
+[MetaBackend]
+type: backy2.meta_backends.sql
+engine: sqlite:///{path}/backy.sqlite
+
+[DataBackend]
+type: backy2.data_backends.file
+path: {path}/data
+simultaneous_writes: 2
+simultaneous_reads: 2
+
+[io_file]
+simultaneous_reads: 2
+simultaneous_writes: 2
+"""
+
+
+@pytest.fixture(scope="function")
+def backy_config(test_path):
+    """ A Config for backys with a sqlite meta backend and a file data
+    backend in test_path. Each backy_from_config(backy_config)() gets its own
+    backends, as a backup closes its data backend. """
+    return _backy_config(test_path, TEST_CONFIG)
+
+
+def _backy_config(test_path, cfg):
+    from backy2.config import Config
+    from backy2.utils import backy_from_config
+    from functools import partial
+    os.mkdir(os.path.join(test_path, 'data'))
+    config = partial(Config, cfg=cfg.format(path=test_path))
+    backy_from_config(config)(initdb=True).close()
+    return config
+
+
+def _main(argv, test_path, *args, cfg=TEST_CONFIG):
+    """ Runs the command line with args and returns its exit code. """
+    from backy2.scripts.backy import main
+    cfg_path = os.path.join(test_path, 'backy.cfg')
+    with open(cfg_path, 'w') as f:
+        f.write(cfg.format(path=test_path))
+    argv[1:] = ['-c', cfg_path] + list(args)
+    with pytest.raises(SystemExit) as e:
+        main()
+    return e.value.code
+
+
+def _backup(backy_config, filename, data, name='test'):
+    """ Writes data to filename and backs it up. Returns the version uid. """
+    from backy2.utils import backy_from_config
+    with open(filename, 'wb') as f:
+        f.write(data)
+    backy = backy_from_config(backy_config)()
+    version_uid = backy.backup(name, 'snapname', 'file://' + filename, None, None)
+    backy.close()
+    return version_uid
+
+
 def test_blocks_from_hints():
     hints = [
         (10, 100, True),
@@ -68,6 +147,596 @@ def test_blocks_from_hints():
     assert sorted(list(cfh)) == [0, 1, 2, 4, 5, 6, 8, 9, 13, 15, 16]
 
 
+def test_blocks_from_ranges():
+    ranges = [(10, 100), (1000, 1100), (4096, 1024)]
+    block_size = 1024
+    segments = backy2.backy.blocks_from_ranges(ranges, block_size, 8192)
+    assert segments == {
+        0: [(10, 100, 10), (1000, 24, 1000)],
+        1: [(0, 1024, 1024)],
+        2: [(0, 52, 2048)],
+        4: [(0, 1024, 4096)],
+        }
+    segments = backy2.backy.blocks_from_ranges(ranges, block_size, 8192, pack=True)
+    assert segments[0] == [(10, 100, 0), (1000, 24, 100)]
+    assert segments[4] == [(0, 1024, 1200)]
+    with pytest.raises(ValueError):
+        backy2.backy.blocks_from_ranges([(8000, 1000)], block_size, 8192)
+
+
+def test_min_sequential():
+    ms = backy2.backy.MinSequential(4)
+    assert ms.get() is None
+    for entry in [6, 5, 8]:
+        ms.put(entry)
+    assert ms.get() is None
+    ms.skip(4)
+    assert ms.get() == 6
+    ms.put(7)
+    assert ms.get() == 8
+
+
+def test_checkpoint(test_path):
+    checkpoint = backy2.backy.Checkpoint(test_path, 'backup', 'name snapshot file:///x', 20)
+    assert checkpoint.load() == (None, [])
+    checkpoint.save({'version_uid': 'abc'})
+    checkpoint.set_done(3)
+    checkpoint.set_done(17)
+    checkpoint.journal({'id': 3})
+    checkpoint.journal({'id': 17})
+
+    checkpoint2 = backy2.backy.Checkpoint(test_path, 'backup', 'name snapshot file:///x', 20)
+    state, records = checkpoint2.load()
+    assert state == {'version_uid': 'abc'}
+    assert records == [{'id': 3}, {'id': 17}]
+    assert not checkpoint2.is_done(3)  # only saved state counts
+
+    checkpoint.save({'version_uid': 'abc'})
+    checkpoint2 = backy2.backy.Checkpoint(test_path, 'backup', 'name snapshot file:///x', 20)
+    state, records = checkpoint2.load()
+    assert records == []
+    assert [i for i in range(20) if checkpoint2.is_done(i)] == [3, 17]
+
+    checkpoint.remove()
+    assert backy2.backy.Checkpoint(test_path, 'backup', 'name snapshot file:///x', 20).load() == (None, [])
+
+
+def test_backup_resume(test_path):
+    from backy2.utils import backy_from_config
+    backy_config = _backy_config(test_path, TEST_CONFIG.replace('[DEFAULTS]\n', '[DEFAULTS]\ncheckpoint_interval: 0\n'))
+    image = os.urandom(4096 * 20)
+    image_path = os.path.join(test_path, 'image')
+    with open(image_path, 'wb') as f:
+        f.write(image)
+
+    # interrupted after 10 blocks
+    backy = backy_from_config(backy_config)()
+    get_io_by_source = backy.get_io_by_source
+    def _get_io_by_source(source):
+        io = get_io_by_source(source)
+        get = io.get
+        def _get(*args, **kwargs):
+            if len(blocks_read) == 10:
+                raise RuntimeError('Interrupted')
+            blocks_read.append(1)
+            return get(*args, **kwargs)
+        io.get = _get
+        return io
+    blocks_read = []
+    backy.get_io_by_source = _get_io_by_source
+    with pytest.raises(RuntimeError):
+        backy.backup('test', 'snapname', 'file://' + image_path, None, None)
+    version_uid = backy.meta_backend.get_versions()[0].uid
+    backy.data_backend.close()
+    backy.meta_backend.close()
+    backy.locking.unlock(version_uid)
+    saved_blobs = set(backy.data_backend.get_all_blob_uids())
+
+    # the rerun continues the version and only uploads the missing blocks
+    backy = backy_from_config(backy_config)()
+    done_block_ids = set(backy.meta_backend.get_block_ids_by_version(version_uid))
+    assert 0 < len(done_block_ids) <= 10
+    assert backy.backup('test', 'snapname', 'file://' + image_path, None, None) == version_uid
+    backy = backy_from_config(backy_config)()
+    uploaded = set(backy.data_backend.get_all_blob_uids()) - saved_blobs
+    assert len(uploaded) == 20 - len(done_block_ids)
+    assert {block.uid for block in backy.meta_backend.get_blocks_by_version(version_uid) if block.id not in done_block_ids} == uploaded
+    assert backy.meta_backend.get_version(version_uid).valid == 1
+    assert len(backy.meta_backend.get_versions()) == 1
+
+    target_path = os.path.join(test_path, 'target')
+    backy.restore(version_uid, 'file://' + target_path)
+    backy.close()
+    with open(target_path, 'rb') as f:
+        assert f.read() == image
+
+
+def test_restore_multiple_targets(backy_config, test_path):
+    from backy2.utils import backy_from_config
+    image = os.urandom(4096 * 3) + bytes(4096) + os.urandom(4096) + b'x' * 100
+    version_uid = _backup(backy_config, os.path.join(test_path, 'image'), image)
+    backy = backy_from_config(backy_config)()
+    read_uids = []
+    read = backy.data_backend.read
+    def _read(block, *args, **kwargs):
+        read_uids.append(block.uid)
+        return read(block, *args, **kwargs)
+    backy.data_backend.read = _read
+    targets = [os.path.join(test_path, 'target1'), os.path.join(test_path, 'target2')]
+    backy.restore(version_uid, ['file://' + target for target in targets])
+    blob_uids = [block.uid for block in backy.meta_backend.get_blocks_by_version(version_uid) if block.uid]
+    backy.close()
+    for target in targets:
+        with open(target, 'rb') as f:
+            assert f.read() == image
+    assert sorted(read_uids) == sorted(blob_uids) and len(blob_uids) == 5
+
+
+def test_restore_resume(backy_config, test_path):
+    from backy2.utils import backy_from_config
+    image = os.urandom(4096 * 5) + b'x' * 100
+    version_uid = _backup(backy_config, os.path.join(test_path, 'image'), image)
+    target_path = os.path.join(test_path, 'target')
+    target = 'file://' + target_path
+    backy = backy_from_config(backy_config)()
+    backy.restore(version_uid, target)
+    checkpoint = backy._checkpoint('restore', '{} {} None False'.format(version_uid, target), 6)
+
+    # interrupted after block 2, then the target has been changed
+    checkpoint.save({'continue_from': 3, 'target_sizes': [len(image)]})
+    _patch(target_path, 0, b'other data')
+    with pytest.raises(SystemExit):  # it exists and isn't forced
+        backy.restore(version_uid, target)
+    assert not os.path.exists(checkpoint.filename)  # a restore from the start
+
+    # the restored blocks are compared with the target
+    checkpoint.save({'continue_from': 3, 'target_sizes': [len(image)]})
+    with pytest.raises(ValueError, match='has been changed'):
+        backy.restore(version_uid, target, resume=True)
+    backy.restore(version_uid, target, force=True)
+    _patch(target_path, 4096 * 4, b'other data')  # not restored yet
+    checkpoint.save({'continue_from': 3, 'target_sizes': [len(image)]})
+    backy.restore(version_uid, target, resume=True)
+    with open(target_path, 'rb') as f:
+        assert f.read() == image
+
+    checkpoint.save({'continue_from': 3, 'target_sizes': [len(image)]})
+    _patch(target_path, len(image), b'longer')
+    with pytest.raises(ValueError):
+        backy.restore(version_uid, target, resume=True)
+    backy.close()
+
+
+def test_verify_target(backy_config, test_path, argv, capsys):
+    from backy2.utils import backy_from_config
+    image = os.urandom(4096 * 10) + bytes(4096) + b'x' * 100
+    version_uid = _backup(backy_config, os.path.join(test_path, 'image'), image)
+    target_path = os.path.join(test_path, 'target')
+    backy = backy_from_config(backy_config)()
+    backy.restore(version_uid, 'file://' + target_path)
+    assert backy.verify_target(version_uid, 'file://' + target_path) == []
+
+    # blocks 2 and 3, the sparse block 10 and the last, partial block
+    _patch(target_path, 4096 * 2 + 4000, b'changed')
+    _patch(target_path, 4096 * 3 + 10, b'changed')
+    _patch(target_path, 4096 * 10, b'changed')
+    _patch(target_path, 4096 * 11 + 99, b'y')
+    ranges = [(4096 * 2, 4096 * 2), (4096 * 10, 4096 + 100)]
+    assert backy.verify_target(version_uid, 'file://' + target_path) == ranges
+    backy.close()
+
+    capsys.readouterr()
+    assert _main(argv, test_path, '-m', 'verify-target', version_uid, 'file://' + target_path) == 20
+    assert capsys.readouterr().out.splitlines() == [
+        'offset|length',
+        '8192|8192',
+        '40960|4196',
+        ]
+
+    # a truncated target differs from its end on
+    with open(target_path, 'r+b') as f:
+        f.truncate(4096 * 5)
+    backy = backy_from_config(backy_config)()
+    assert backy.verify_target(version_uid, 'file://' + target_path) == [
+        (4096 * 2, 4096 * 2), (4096 * 5, 4096 * 6 + 100)]
+    backy.close()
+
+
+def test_scrub_source(backy_config, test_path):
+    from backy2.utils import backy_from_config
+    image = os.urandom(4096 * 20) + bytes(4096) + b'x' * 100
+    image_path = os.path.join(test_path, 'image')
+    version_uid = _backup(backy_config, image_path, image)
+    backy = backy_from_config(backy_config)()
+    assert backy.scrub(version_uid, 'file://' + image_path) == True
+    _patch(image_path, 4096 * 7 + 10, b'changed')
+    assert backy.scrub(version_uid, 'file://' + image_path) == False
+    # the source is wrong, not the backup
+    assert backy.meta_backend.get_version(version_uid).valid == 1
+    assert all(block.valid for block in backy.meta_backend.get_blocks_by_version(version_uid))
+    assert backy.scrub(version_uid) == True
+    backy.close()
+
+
+def test_scrub_light(backy_config, test_path):
+    from backy2.utils import backy_from_config
+    version_uids = [
+        _backup(backy_config, os.path.join(test_path, 'image1'), os.urandom(4096 * 10), 'a'),
+        _backup(backy_config, os.path.join(test_path, 'image2'), os.urandom(4096 * 10), 'b'),
+        ]
+    backy = backy_from_config(backy_config)()
+    assert backy.scrub(version_uids[0], mode='light') == True
+    blocks = list(backy.meta_backend.get_blocks_by_version(version_uids[0]))
+    os.unlink(backy.data_backend._filename(blocks[2].uid))
+    with open(backy.data_backend._filename(blocks[5].uid), 'r+b') as f:
+        f.truncate(100)
+    assert backy.scrub(version_uids[0], mode='light') == False
+    assert backy.meta_backend.get_version(version_uids[0]).valid == 0
+    assert [block.valid for block in backy.meta_backend.get_blocks_by_version(version_uids[0])] == [1, 1, 0, 1, 1, 0, 1, 1, 1, 1]
+    # the other version isn't affected
+    assert backy.scrub(version_uids[1], mode='light') == True
+    assert backy.meta_backend.get_version(version_uids[1]).valid == 1
+    backy.close()
+
+
+def test_scrub_crypto(test_path):
+    from backy2.utils import backy_from_config
+    cfg = TEST_CONFIG.replace('encryption_version: 0', 'encryption_version: 1\nencryption_key: ' + 'decafbad' * 8)
+    backy_config = _backy_config(test_path, cfg)
+    version_uids = [
+        _backup(backy_config, os.path.join(test_path, 'image1'), os.urandom(4096 * 5), 'a'),
+        _backup(backy_config, os.path.join(test_path, 'image2'), os.urandom(4096 * 5), 'b'),
+        ]
+    backy = backy_from_config(backy_config)()
+    assert backy.scrub(version_uids[0], mode='crypto') == True
+    block = list(backy.meta_backend.get_blocks_by_version(version_uids[0]))[3]
+    assert block.enc_version == 1
+    with open(backy.data_backend._filename(block.uid), 'r+b') as f:
+        f.seek(50)
+        byte = f.read(1)[0]
+        f.seek(50)
+        f.write(bytes([byte ^ 1]))  # flip a bit
+    assert backy.scrub(version_uids[0], mode='crypto') == False
+    assert backy.meta_backend.get_version(version_uids[0]).valid == 0
+    assert [b.valid for b in backy.meta_backend.get_blocks_by_version(version_uids[0])] == [1, 1, 1, 0, 1]
+    assert backy.scrub(version_uids[1], mode='crypto') == True
+    assert backy.meta_backend.get_version(version_uids[1]).valid == 1
+    backy.close()
+
+
+def test_scrub_all(backy_config, test_path):
+    from backy2.utils import backy_from_config
+    import datetime
+    shared = os.urandom(4096)
+    version_uids = [
+        _backup(backy_config, os.path.join(test_path, 'image1'), os.urandom(4096 * 2) + shared, 'a'),
+        _backup(backy_config, os.path.join(test_path, 'image2'), os.urandom(4096) + shared, 'b'),
+        ]
+    backy = backy_from_config(backy_config)()
+    read_uids = []
+    read = backy.data_backend.read
+    def _read(block, *args, **kwargs):
+        read_uids.append(block.uid)
+        return read(block, *args, **kwargs)
+    backy.data_backend.read = _read
+    blob_uids = [set(block.uid for block in backy.meta_backend.get_blocks_by_version(version_uid))
+        for version_uid in version_uids]
+
+    # the shared blob is read once
+    assert backy.scrub_all() == True
+    assert sorted(read_uids) == sorted(blob_uids[0] | blob_uids[1]) and len(read_uids) == 4
+    del read_uids[:]
+    assert backy.scrub_all(max_age=datetime.timedelta(hours=1)) == True
+    assert read_uids == []
+
+    # blobs only referenced by locked versions are skipped
+    backy.locking.lock(version_uids[1])
+    assert backy.scrub_all() == True
+    assert sorted(read_uids) == sorted(blob_uids[0])
+    backy.locking.unlock(version_uids[1])
+    backy.close()
+
+
+def test_scrub_missing_blobs(test_path):
+    # Several reader threads failing at the same time each report their
+    # block, none of the failed reads is lost.
+    from backy2.utils import backy_from_config
+    backy_config = _backy_config(test_path, TEST_CONFIG.replace('simultaneous_reads: 2', 'simultaneous_reads: 8'))
+    version_uids = [
+        _backup(backy_config, os.path.join(test_path, 'image1'), os.urandom(4096 * 20), 'a'),
+        _backup(backy_config, os.path.join(test_path, 'image2'), os.urandom(4096 * 20), 'b'),
+        ]
+    backy = backy_from_config(backy_config)()
+    for version_uid in version_uids:
+        for block in list(backy.meta_backend.get_blocks_by_version(version_uid))[3:5]:
+            os.unlink(backy.data_backend._filename(block.uid))
+    assert backy.scrub_all() == False
+    for version_uid in version_uids:
+        assert backy.meta_backend.get_version(version_uid).valid == 0
+        assert backy.scrub(version_uid) == False
+        assert [block.valid for block in backy.meta_backend.get_blocks_by_version(version_uid)] == [1] * 3 + [0] * 2 + [1] * 15
+
+    # other errors are reported with their block, too
+    from backy2.data_backends import ReadError
+    block = backy.meta_backend.get_block_by_checksum(
+        list(backy.meta_backend.get_blocks_by_version(version_uids[0]))[0].checksum, 0)
+    def _read_raw(block):
+        raise OSError('Connection reset')
+    backy.data_backend.read_raw = _read_raw
+    backy.data_backend.read(block)
+    with pytest.raises(ReadError) as e:
+        backy.data_backend.read_get()
+    assert e.value.args[1] is block
+    backy.close()
+
+
+def test_scrub_cli(backy_config, test_path, argv):
+    version_uid = _backup(backy_config, os.path.join(test_path, 'image'), os.urandom(4096 * 3))
+    # options of --all aren't ignored without it
+    assert _main(argv, test_path, 'scrub', '-m', '1d', version_uid) == 1
+    assert _main(argv, test_path, 'scrub', '-r', '5', version_uid) == 1
+    assert _main(argv, test_path, 'scrub', '-M', 'light', '--all') == 1
+    assert _main(argv, test_path, 'scrub', version_uid) == 0
+    assert _main(argv, test_path, 'scrub', '--all', '-m', '1d', '-r', '5') == 0
+
+
+def _set_version(meta_backend, name, days, tags=(), valid=1, expire=None, protected=0):
+    """ Creates a version with one block which is days old. """
+    from backy2.meta_backends.sql import Version
+    import datetime
+    version_uid = meta_backend.set_version(name, 'snapname', 1, 4096, valid, protected)
+    meta_backend.set_block(0, version_uid, None, None, 4096, 1)
+    for tag in tags:
+        meta_backend.add_tag(version_uid, tag)
+    meta_backend.session.query(Version).filter_by(uid=version_uid).update({
+        'date': datetime.datetime.utcnow() - datetime.timedelta(days=days, hours=1),
+        'expire': expire,
+        })
+    meta_backend._commit()
+    return version_uid
+
+
+def test_prune(backy_config):
+    from backy2.utils import backy_from_config
+    import datetime
+    backy = backy_from_config(backy_config)()
+    meta_backend = backy.meta_backend
+    yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    a = [
+        _set_version(meta_backend, 'a', 5, ['daily', 'weekly']),
+        _set_version(meta_backend, 'a', 4, ['daily']),
+        _set_version(meta_backend, 'a', 3, ['daily'], valid=0),
+        _set_version(meta_backend, 'a', 2, ['daily']),
+        _set_version(meta_backend, 'a', 1, ['daily'], valid=0),
+        _set_version(meta_backend, 'a', 0, ['daily']),
+        ]
+    b = [
+        _set_version(meta_backend, 'b', 3, ['daily']),
+        _set_version(meta_backend, 'b', 2, expire=yesterday),
+        _set_version(meta_backend, 'b', 1, ['daily'], expire=yesterday, protected=1),
+        _set_version(meta_backend, 'b', 0, expire=yesterday),
+        ]
+    candidates = lambda *args, **kwargs: sorted(
+        (v.uid, reason) for v, reason in backy.get_prune_candidates(*args, **kwargs))
+
+    # the 2 newest valid daily versions of a and the invalid one between
+    # them are retained, the oldest one is still kept by weekly
+    assert candidates({'daily': 2, 'weekly': 5}, 'a') == sorted([(a[1], 'retention'), (a[2], 'retention')])
+    assert candidates({'daily': 2}, 'a') == sorted([(a[0], 'retention'), (a[1], 'retention'), (a[2], 'retention')])
+    # not enough valid versions: all are retained
+    assert candidates({'daily': 5}, 'a') == []
+    assert candidates({'daily': 0}, 'a') == sorted((v, 'retention') for v in a)
+    # without schedulers only expired versions are candidates, never
+    # protected ones
+    assert candidates({}, 'b') == sorted([(b[1], 'expired'), (b[3], 'expired')])
+    assert candidates({}) == candidates({}, 'b')
+    # too young versions are only candidates with force
+    assert candidates({}, 'b', disallow_rm_when_younger_than_days=1) == [(b[1], 'expired')]
+    assert candidates({}, 'b', True, disallow_rm_when_younger_than_days=1) == candidates({}, 'b')
+    assert candidates({'daily': 2}, disallow_rm_when_younger_than_days=5) == [(a[0], 'retention')]
+
+    # locked versions are skipped
+    backy.locking.lock(b[3])
+    assert backy.prune([b[1], b[3]]) == [b[1]]
+    backy.locking.unlock(b[3])
+    assert sorted(v.uid for v in backy.ls(name='b')) == sorted([b[0], b[2], b[3]])
+    backy.close()
+
+
+def test_prune_cli(backy_config, test_path, argv, capsys):
+    from backy2.utils import backy_from_config
+    import datetime
+    backy = backy_from_config(backy_config)()
+    meta_backend = backy.meta_backend
+    expired = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    version_uids = [
+        _set_version(meta_backend, 'a', 3, ['daily']),
+        _set_version(meta_backend, 'a', 2, ['daily']),
+        _set_version(meta_backend, 'a', 1, ['daily']),
+        _set_version(meta_backend, 'b', 0, expire=expired),
+        ]
+    backy.close()
+    cfg = TEST_CONFIG.replace('disallow_rm_when_younger_than_days: 0', 'disallow_rm_when_younger_than_days: 1') + \
+        '\n[daily]\nkeep: 2\n'
+    ls = lambda: sorted(v.uid for v in backy_from_config(backy_config)().ls())
+
+    capsys.readouterr()
+    assert _main(argv, test_path, '-m', '-s', 'prune', '-s', 'daily', '-n', '-f', 'uid,reason', cfg=cfg) == 0
+    assert capsys.readouterr().out.splitlines() == ['{}|retention'.format(version_uids[0])]
+    assert ls() == sorted(version_uids)
+
+    assert _main(argv, test_path, '-m', '-s', 'prune', '-s', 'daily', '--force', '-f', 'uid,reason', cfg=cfg) == 0
+    assert sorted(capsys.readouterr().out.splitlines()) == sorted([
+        '{}|retention'.format(version_uids[0]),
+        '{}|expired'.format(version_uids[3]),
+        ])
+    assert ls() == sorted(version_uids[1:3])
+
+
+def test_du_approx_cli(backy_config, test_path, argv, capsys):
+    from backy2.utils import backy_from_config
+    backy = backy_from_config(backy_config)()
+    _set_version(backy.meta_backend, 'a', 40, ['daily'])
+    _set_version(backy.meta_backend, 'b', 1, ['daily'])
+    _set_version(backy.meta_backend, 'b', 0, ['weekly'])
+    backy.close()
+    capsys.readouterr()
+    assert _main(argv, test_path, '-m', 'du', '-a', '-f', 'Name,Versions') == 0
+    assert capsys.readouterr().out.splitlines()[1:] == ['a|1', 'b|2']
+    assert _main(argv, test_path, '-m', 'du', '-a', '-t', 'daily', '-f', 'Name,Versions') == 0
+    assert capsys.readouterr().out.splitlines()[1:] == ['tag daily|2']
+    assert _main(argv, test_path, '-m', 'du', '-a', '-t', 'daily', '--older-than', '30d', '-f', 'Name,Versions') == 0
+    assert capsys.readouterr().out.splitlines()[1:] == ['tag daily, older than 30d|1']
+    assert _main(argv, test_path, '-m', 'du', '-a', '-n', 'b', '-t', 'daily', '-f', 'Name,Versions') == 0
+    assert capsys.readouterr().out.splitlines()[1:] == ['b|1']
+
+
+def test_clone(test_path, argv, capsys):
+    from backy2.utils import backy_from_config
+    import datetime
+    cfg = TEST_CONFIG.replace('encryption_version: 0', 'encryption_version: 1\nencryption_key: ' + 'decafbad' * 8)
+    backy_config = _backy_config(test_path, cfg)
+    image = os.urandom(4096 * 3) + bytes(4096) + b'x' * 100
+    version_uid = _backup(backy_config, os.path.join(test_path, 'image'), image)
+    expire = datetime.datetime(2030, 1, 2, 3, 4, 5)
+    backy = backy_from_config(backy_config)()
+    clone_uid = backy.clone(version_uid, 'clone', 'snap', ['daily', 'pinned'], expire)
+
+    version, clone = backy.meta_backend.get_version(version_uid), backy.meta_backend.get_version(clone_uid)
+    assert (clone.name, clone.snapshot_name, clone.expire) == ('clone', 'snap', expire)
+    assert (clone.size, clone.size_bytes, clone.valid) == (version.size, version.size_bytes, version.valid)
+    assert sorted(t.name for t in clone.tags) == ['daily', 'pinned']
+    columns = lambda b: (b.id, b.uid, b.checksum, b.size, b.valid, b.enc_version, b.enc_envkey, b.enc_nonce)
+    blocks = backy.meta_backend.get_blocks_by_version(clone_uid)
+    assert [columns(b) for b in blocks] == \
+        [columns(b) for b in backy.meta_backend.get_blocks_by_version(version_uid)]
+    assert all(b.enc_version == 1 and b.enc_envkey for b in blocks if b.uid)
+
+    # the clone outlives its source
+    backy.rm(version_uid)
+    backy.restore(clone_uid, 'file://' + os.path.join(test_path, 'target'))
+    with open(os.path.join(test_path, 'target'), 'rb') as f:
+        assert f.read() == image
+    backy.close()
+
+    capsys.readouterr()
+    assert _main(argv, test_path, '-m', 'clone', '-t', 'weekly', '-e', '2030-01-02', clone_uid, 'clone2', cfg=cfg) == 0
+    clone2 = backy_from_config(backy_config)().meta_backend.get_version(capsys.readouterr().out.strip())
+    assert (clone2.name, clone2.expire) == ('clone2', datetime.datetime(2030, 1, 2))
+    assert [t.name for t in clone2.tags] == ['weekly']
+
+
+def _skip_without_fuse():
+    try:
+        import backy2.fuse
+    except (ImportError, OSError):  # fusepy raises OSError without libfuse
+        pytest.skip('fuse is not available')
+
+
+def test_fuse_tree():
+    _skip_without_fuse()
+    from backy2.fuse import Tree
+    tree = Tree()
+    tree.mkdir('/dir')
+    tree.create('/dir/file', tree.file(size=4), data=b'data')
+    with pytest.raises(FileExistsError):
+        tree.mkdir('/dir')
+    copy = tree.copy()
+    copy.remove('/dir/file')
+    copy.mkdir('/dir2')
+    assert list(tree.get_path('/')['children']) == ['dir']
+    assert tree.get_path('/dir/file')['data'] == b'data'
+    assert list(copy.get_path('/')['children']) == ['dir', 'dir2']
+    with pytest.raises(FileNotFoundError):
+        copy.get_path('/dir/file')
+
+
+def test_fuse_update_tree(backy_config, test_path):
+    _skip_without_fuse()
+    from backy2.fuse import BackyFuse, FuseOSError
+    from backy2.utils import backy_from_config
+    backy = backy_from_config(backy_config)()
+    other = backy_from_config(backy_config)()  # like another process
+    a = _set_version(other.meta_backend, 'a', 1)
+    backy_fuse = BackyFuse(backy, test_path)
+    assert backy_fuse.readdir('/by_version_uid', None) == ['.', '..', a]
+    assert backy_fuse.readdir('/by_name/a', None) == ['.', '..', a]
+    assert backy_fuse.readlink('/by_name/a/' + a) == '../../by_version_uid/' + a
+    assert backy_fuse.read('/by_version_uid/{}/name'.format(a), 4096, 0, None) == b'a'
+
+    # nothing is fetched again until the tree is TREE_MAX_AGE old
+    b = _set_version(other.meta_backend, 'b', 0)
+    assert backy_fuse.readdir('/by_name', None) == ['.', '..', 'a']
+    backy_fuse._tree_time = 0
+    old_tree = backy_fuse.tree
+    assert sorted(backy_fuse.readdir('/by_name', None)) == ['.', '..', 'a', 'b']
+    assert backy_fuse.getattr('/by_version_uid/{}/data'.format(b))['st_size'] == 4096
+    # readers of the old tree are not affected by the update
+    assert list(old_tree.get_path('/by_name')['children']) == ['a']
+
+    # a changed version is replaced
+    other.meta_backend.add_tag(a, 'daily')
+    other.meta_backend.set_version_invalid(a)
+    backy_fuse._tree_time = 0
+    assert backy_fuse.read('/by_version_uid/{}/tags'.format(a), 4096, 0, None) == b'daily'
+    assert 'invalid' in backy_fuse.readdir('/by_version_uid/' + a, None)
+    assert 'valid' not in backy_fuse.readdir('/by_version_uid/' + a, None)
+
+    # removing the last version of a name removes its directory
+    other.meta_backend.rm_version(b)
+    backy_fuse._tree_time = 0
+    assert backy_fuse.readdir('/by_name', None) == ['.', '..', 'a']
+    assert backy_fuse.readdir('/by_version_uid', None) == ['.', '..', a]
+    with pytest.raises(FuseOSError):
+        backy_fuse.getattr('/by_version_uid/' + b)
+    backy_fuse.destroy('/')
+    other.close()
+    backy.close()
+
+
+def test_fuse_readahead(backy_config, test_path):
+    _skip_without_fuse()
+    from backy2.fuse import BackyFuse
+    from backy2.utils import backy_from_config
+    image = os.urandom(4096 * 20)
+    version_uid = _backup(backy_config, os.path.join(test_path, 'image'), image)
+    backy = backy_from_config(backy_config)()
+    backy_fuse = BackyFuse(backy, test_path)
+    path = '/by_version_uid/{}/data'.format(version_uid)
+    fh = backy_fuse.open(path, os.O_RDONLY)
+    fetched = []
+    fetch = backy_fuse.block_reader.fetch
+    def _fetch(block):
+        fetched.append(block.id)
+        return fetch(block)
+    backy_fuse.block_reader.fetch = _fetch
+
+    # fetched blocks are prefetched ones followed by the read ones
+    assert backy_fuse.read(path, 8192, 0, fh) == image[:8192]
+    assert fetched == [0, 1]  # the first read may be random
+    del fetched[:]
+    assert backy_fuse.read(path, 4096, 8192, fh) == image[8192:12288]
+    assert fetched == list(range(3, 3 + BackyFuse.READAHEAD_BLOCKS)) + [2]
+    del fetched[:]
+    assert backy_fuse.read(path, 4096, 4096 * 15, fh) == image[4096 * 15:4096 * 16]
+    assert fetched == [15]  # not sequential
+    del fetched[:]
+    assert backy_fuse.read(path, 4096, 4096 * 16, fh) == image[4096 * 16:4096 * 17]
+    assert fetched == [17, 18, 19, 16]  # up to the end
+    backy_fuse.release(path, fh)
+    backy_fuse.destroy('/')
+    backy.close()
+
+
+def test_crypt_verify():
+    from backy2.crypt import get_crypt
+    cc = get_crypt(1)(key=b'\xde\xca\xfb\xad' * 8)
+    blob, envelope_key, nonce = cc.encrypt(b'my block data')
+    assert cc.verify(blob, envelope_key) == True
+    assert cc.verify(blob[:-1] + bytes([blob[-1] ^ 1]), envelope_key) == False
+    assert get_crypt(0)(key=b'').verify(b'my block data') is None
+
+
 def test_FileBackend_path(test_path):
     uid = 'c2cac25a7afd11e5b45aa44e314f9270'
 
@@ -108,6 +777,383 @@ def test_FileBackend_save_read(test_path):
     backend.close()
 
 
+def test_FileBackend_stat_many(test_path):
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    config = Config(cfg='[DataBackend]\npath: {}\nsimultaneous_writes: 1\n'.format(test_path), section='DataBackend')
+    backend = DataBackend(config, encryption_key=b'', encryption_version=0)
+    uid = backend.save(b'test', _sync=True)
+    assert backend.stat_many([uid, 'c2cac25a7afd11e5b45aa44e314f9270']) == {uid: (4, None)}
+    backend.close()
+
+
+def test_S3Backend_stat_many():
+    pytest.importorskip('boto3')
+    from botocore.exceptions import ClientError
+    from backy2.data_backends.s3 import DataBackend
+
+    keys = sorted(uuid.uuid1().hex for i in range(5000))
+    requests = []
+
+    class Client:
+        def list_objects_v2(self, Bucket, StartAfter, MaxKeys):
+            requests.append('list')
+            page = [k for k in keys if k > StartAfter][:MaxKeys]
+            return {
+                'Contents': [{'Key': k, 'Size': 4, 'ETag': '"{}"'.format(k)} for k in page],
+                'IsTruncated': len(page) == MaxKeys,
+                }
+        def head_object(self, Bucket, Key):
+            requests.append('head')
+            if Key not in keys:
+                raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+            return {'ContentLength': 4, 'ETag': '"{}"'.format(Key)}
+
+    backend = DataBackend.__new__(DataBackend)
+    backend._bucket_name = 'backy2'
+    backend.simultaneous_reads = 2
+    backend._get_client = lambda: Client()
+    missing = uuid.uuid1().hex
+
+    # dense uids are found by a few listings
+    uids = keys[1000:3000] + [missing]
+    found = backend.stat_many(uids)
+    assert found == {k: (4, k) for k in keys[1000:3000]}
+    assert requests.count('list') <= 4 and requests.count('head') <= 1
+
+    # sparse uids are stat'ed one by one after the first listing
+    del requests[:]
+    uids = keys[::500] + [missing]
+    found = backend.stat_many(uids)
+    assert found == {k: (4, k) for k in keys[::500]}
+    assert requests.count('list') == 1
+    assert requests.count('head') < len(uids)
+
+
+def test_block_reader(test_path):
+    from backy2.blockreader import BlobCache, BlockReader
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    from backy2.meta_backends import DereferencedBlock
+    config = Config(cfg='[DataBackend]\npath: {}\nsimultaneous_writes: 1\nsimultaneous_reads: 2\n'.format(test_path), section='DataBackend')
+    backend = DataBackend(config, encryption_key=b'', encryption_version=0)
+    blocks = []
+    for id in range(3):
+        uid = backend.save(bytes([id]) * 1000, _sync=True)
+        blocks.append(DereferencedBlock(uid, None, id, None, None, 1000, 1, None, 0, None))
+    cache = BlobCache(2000, disk_size=3000, cachedir=test_path)
+    reader = BlockReader(backend, cache)
+    fetches = [reader.fetch(block) for block in blocks]
+    assert [fetch.result() for fetch in fetches] == [bytes([id]) * 1000 for id in range(3)]
+    assert cache.size == 2000 and cache.disk_used == 3000
+    dropped = [block for block in blocks if cache.get(block.uid) is None]  # from memory
+    assert len(dropped) == 1
+
+    # read from the disk cache
+    os.remove(backend._filename(dropped[0].uid))
+    assert reader.read(dropped[0]) == bytes([dropped[0].id]) * 1000
+
+    with pytest.raises(FileNotFoundError):
+        reader.read(DereferencedBlock('c2cac25a7afd11e5b45aa44e314f9270', None, 0, None, None, 1000, 1, None, 0, None))
+    reader.close()
+    assert not any(name.startswith('backy2cache') for name in os.listdir(test_path))
+    backend.close()
+
+
+def test_version_blocks():
+    from backy2.blockreader import VersionBlocks
+    from backy2.meta_backends import DereferencedBlock
+    block = lambda id, uid: DereferencedBlock(uid, 'v', id, None, None, 1000, 1, None, 0, None)
+    # block 3 is missing, e.g. of an incomplete version
+    version_blocks = VersionBlocks('v', 5, [block(0, 'a'), block(1, None), block(2, 'a'), block(4, 'b')])
+    assert len(version_blocks) == 5 and len(version_blocks.blocks) == 2
+    assert version_blocks.get(0) is version_blocks.get(2)  # one per blob
+    assert version_blocks.get(1) is None
+    assert version_blocks.get(4).uid == 'b'
+    with pytest.raises(KeyError):
+        version_blocks.get(3)
+
+
+def test_block_reader_single_flight(test_path):
+    from backy2.blockreader import BlobCache, BlockReader
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    from backy2.meta_backends import DereferencedBlock
+    config = Config(cfg='[DataBackend]\npath: {}\nsimultaneous_writes: 1\nsimultaneous_reads: 2\n'.format(test_path), section='DataBackend')
+    backend = DataBackend(config, encryption_key=b'', encryption_version=0)
+    uid = backend.save(b'x' * 1000, _sync=True)
+    block = DereferencedBlock(uid, None, 0, None, None, 1000, 1, None, 0, None)
+    reader = BlockReader(backend, BlobCache(2000), receivers=2)
+    queued = []
+    read, backend.read = backend.read, queued.append
+
+    # all fetches of a blob wait for the same read
+    fetches = [reader.fetch(block) for i in range(3)]
+    assert fetches[0] is fetches[1] is fetches[2] and queued == [block]
+    assert not fetches[0].done()
+    read(queued[0])
+    assert [fetch.result(timeout=10) for fetch in fetches] == [b'x' * 1000] * 3
+    assert reader.read(block) == b'x' * 1000 and len(queued) == 1  # cached
+
+    # close stops the receivers
+    reader.close()
+    assert not any(thread.is_alive() for thread in reader._receiver_threads)
+    backend.close()
+
+
+def test_block_reader_errors(test_path):
+    from backy2.blockreader import BlobCache, BlockReader
+    from backy2.config import Config
+    from backy2.data_backends import ReadError
+    from backy2.data_backends.file import DataBackend
+    from backy2.meta_backends import DereferencedBlock
+    from concurrent.futures import TimeoutError
+    config = Config(cfg='[DataBackend]\npath: {}\nsimultaneous_writes: 1\nsimultaneous_reads: 2\n'.format(test_path), section='DataBackend')
+    backend = DataBackend(config, encryption_key=b'', encryption_version=0)
+    blocks = []
+    for id in range(3):
+        uid = backend.save(bytes([id]) * 1000, _sync=True)
+        blocks.append(DereferencedBlock(uid, None, id, None, None, 1000, 1, None, 0, None))
+    reader = BlockReader(backend, BlobCache(3000), receivers=2)
+
+    # a failed read only fails its own block and the readers keep going
+    read_raw = backend.read_raw
+    def _read_raw(block):
+        if block.id == 1:
+            raise OSError('Connection reset')
+        return read_raw(block)
+    backend.read_raw = _read_raw
+    fetches = [reader.fetch(block) for block in blocks]
+    with pytest.raises(ReadError):
+        fetches[1].result(timeout=10)
+    assert [fetches[0].result(timeout=10), fetches[2].result(timeout=10)] == [bytes([0]) * 1000, bytes([2]) * 1000]
+    backend.read_raw = read_raw
+    assert reader.read(blocks[1]) == bytes([1]) * 1000
+
+    # a read that never returns times out, the next read retries
+    reader.cache = BlobCache(3000)
+    reader.READ_TIMEOUT = .1
+    read, backend.read = backend.read, lambda block: None
+    with pytest.raises(TimeoutError):
+        reader.read(blocks[0])
+    backend.read = read
+    assert reader.read(blocks[0]) == bytes([0]) * 1000
+    reader.close()
+    backend.close()
+
+
+def test_block_reader_threads(test_path):
+    from backy2.blockreader import BlobCache, BlockReader
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    from backy2.meta_backends import DereferencedBlock
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    config = Config(cfg='[DataBackend]\npath: {}\nsimultaneous_writes: 1\nsimultaneous_reads: 2\n'.format(test_path), section='DataBackend')
+    backend = DataBackend(config, encryption_key=b'\xde\xca\xfb\xad' * 8, encryption_version=1)
+    blocks, datas = [], []
+    for id in range(20):
+        datas.append(os.urandom(500) * 2)
+        envelopes = []
+        uid = backend.save(datas[-1], _sync=True, callback=lambda *args: envelopes.append(args))
+        _uid, enc_envkey, enc_version, enc_nonce = envelopes[0][:4]
+        blocks.append(DereferencedBlock(uid, None, id, None, None, 1000, 1, enc_envkey.hex(), enc_version, enc_nonce))
+    # most reads are decrypted from the disk cache by the reading threads
+    reader = BlockReader(backend, BlobCache(3000, disk_size=100000, cachedir=test_path))
+    with ThreadPoolExecutor(8) as executor:
+        for i in range(5):
+            assert list(executor.map(reader.read, blocks)) == datas
+    # each thread has its own crypt
+    crypts = []
+    threads = [threading.Thread(target=lambda: crypts.append(backend._cc_by_version(1))) for i in range(2)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    assert crypts[0] is not crypts[1] and crypts[0] is not backend._cc_by_version(1)
+    reader.close()
+    backend.close()
+
+
+def test_commit_blocks(test_path):
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    from backy2.meta_backends.memory import MetaBackend
+    meta_backend = MetaBackend(Config(cfg='[MetaBackend]\nname: test_commit\n', section='MetaBackend'))
+    config = Config(cfg='[DataBackend]\npath: {}\nsimultaneous_writes: 2\n'.format(test_path), section='DataBackend')
+    data_backend = DataBackend(config, encryption_key=b'', encryption_version=0)
+    backy = backy2.backy.Backy(meta_backend, data_backend, None, block_size=1000, initdb=True)
+    version_uid = meta_backend.set_version('backup', 'snapname', 4, 3500, 1)
+    for id, data in enumerate([b'a' * 1000, b'b' * 1000, None, b'd' * 500]):
+        if data is None:
+            meta_backend.set_block(id, version_uid, None, None, 1000, 1)
+        else:
+            uid = data_backend.save(data, _sync=True)
+            meta_backend.set_block(id, version_uid, uid, backy.hash_function(data).hexdigest(), len(data), 1)
+    meta_backend.set_version_valid(version_uid)
+
+    new_version_uids = backy.commit_blocks({version_uid: [
+        (1, b'\0' * 1000),
+        (2, b'a' * 1000),  # deduplicated
+        (3, b'e' * 1000),  # only 500 bytes belong to the version
+        ]})
+    new_version = meta_backend.get_version(new_version_uids[version_uid])
+    assert (new_version.name, new_version.size, new_version.size_bytes, new_version.valid) == ('backup', 4, 3500, 1)
+    old_blocks = meta_backend.get_blocks_by_version(version_uid)
+    new_blocks = meta_backend.get_blocks_by_version(new_version.uid)
+    assert new_blocks[0].uid == new_blocks[2].uid == old_blocks[0].uid
+    assert new_blocks[1].uid is None
+    assert new_blocks[3].size == 500 and new_blocks[3].uid != old_blocks[3].uid
+    assert data_backend.read_raw(new_blocks[3]) == b'e' * 500
+    meta_backend.close()
+
+
+def _recv(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def _nbd_option(sock, option, data=b''):
+    """ Sends an option, returns the replies [(type, data)] """
+    import struct
+    sock.sendall(b'IHAVEOPT' + struct.pack('>II', option, len(data)) + data)
+    replies = []
+    while True:
+        magic, _option, reply_type, length = struct.unpack('>QIII', _recv(sock, 20))
+        replies.append((reply_type, _recv(sock, length)))
+        if reply_type == 1 or reply_type >= 2**31:  # ack or error
+            return replies
+
+
+def _nbd_reply(sock):
+    """ Returns (handle, type, payload) of a structured reply """
+    import struct
+    magic, flags, _type, handle, length = struct.unpack('>IHHQI', _recv(sock, 20))
+    assert magic == 0x668e33ef and flags == 1
+    return handle, _type, _recv(sock, length)
+
+
+def _nbd_server(test_path):
+    """ Returns a writable NbdServer serving a version of 3500 bytes and
+    the version's image. """
+    from backy2.blockreader import BlobCache, BlockReader
+    from backy2.config import Config
+    from backy2.data_backends.file import DataBackend
+    from backy2.meta_backends.memory import MetaBackend
+    from backy2.nbd import NbdServer
+    import threading
+    meta_backend = MetaBackend(Config(cfg='[MetaBackend]\nname: test_nbd\n', section='MetaBackend'))
+    config = Config(cfg='[DataBackend]\npath: {}\nsimultaneous_writes: 1\nsimultaneous_reads: 2\n'.format(test_path), section='DataBackend')
+    data_backend = DataBackend(config, encryption_key=b'', encryption_version=0)
+    backy = backy2.backy.Backy(meta_backend, data_backend, None, block_size=1000, initdb=True)
+    version_uid = meta_backend.set_version('backup', 'snapname', 4, 3500, 1)
+    image = b'a' * 1000 + bytes(1000) + b'c' * 1000 + b'd' * 500
+    for id in range(4):
+        data = image[id * 1000:(id + 1) * 1000]
+        if id == 1:
+            meta_backend.set_block(id, version_uid, None, None, 1000, 1)
+        else:
+            meta_backend.set_block(id, version_uid, data_backend.save(data, _sync=True), None, len(data), 1)
+    meta_backend.set_version_valid(version_uid)
+
+    server = NbdServer(backy, [version_uid], BlockReader(data_backend, BlobCache(10000)), test_path, writable=True)
+    server.listen(unix_socket=os.path.join(test_path, 'nbd.sock'))
+    threading.Thread(target=server.serve, daemon=True).start()
+    return server, version_uid, image
+
+
+def _nbd_connect(test_path, version_uid):
+    """ Returns a socket connected to the export of version_uid with
+    structured replies """
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(os.path.join(test_path, 'nbd.sock'))
+    _nbd_handshake(sock, version_uid)
+    return sock
+
+
+def _nbd_handshake(sock, version_uid):
+    import struct
+    assert _recv(sock, 18) == b'NBDMAGICIHAVEOPT\x00\x03'
+    sock.sendall(struct.pack('>I', 2))  # no zeroes
+    assert _nbd_option(sock, 8) == [(1, b'')]  # structured replies
+    name = version_uid.encode('ascii')
+    assert _nbd_option(sock, 7, struct.pack('>I', len(name)) + name + struct.pack('>H', 0))[-1] == (1, b'')
+
+
+def test_nbd_server(test_path):
+    import socket
+    import struct
+    server, version_uid, image = _nbd_server(test_path)
+    meta_backend = server.backy.meta_backend
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(os.path.join(test_path, 'nbd.sock'))
+    assert _recv(sock, 18) == b'NBDMAGICIHAVEOPT\x00\x03'
+    sock.sendall(struct.pack('>I', 2))  # no zeroes
+    assert _nbd_option(sock, 8) == [(1, b'')]  # structured replies
+    name = version_uid.encode('ascii')
+    assert _nbd_option(sock, 10, struct.pack('>I', len(name)) + name + struct.pack('>II', 1, 15) + b'base:allocation') == \
+        [(4, struct.pack('>I', 1) + b'base:allocation'), (1, b'')]
+    assert _nbd_option(sock, 7, struct.pack('>I', 0) + struct.pack('>H', 0))[0] == (3, struct.pack('>HQH', 0, 3500, 1 | 4 | 64))
+
+    # requests in flight at the same time
+    request = struct.Struct('>IHHQQI')
+    sock.sendall(request.pack(0x25609513, 0, 0, 1, 990, 2020) + request.pack(0x25609513, 0, 7, 2, 0, 3500))
+    replies = dict((handle, (_type, payload)) for handle, _type, payload in [_nbd_reply(sock), _nbd_reply(sock)])
+    assert replies[1] == (1, struct.pack('>Q', 990) + image[990:3010])
+    assert replies[2] == (5, struct.pack('>IIIIIII', 1, 1000, 0, 1000, 3, 1500, 0))
+
+    # copy-on-write
+    sock.sendall(request.pack(0x25609513, 0, 1, 3, 1998, 4) + b'xxxx')
+    assert _nbd_reply(sock) == (3, 0, b'')
+    sock.sendall(request.pack(0x25609513, 0, 0, 4, 1990, 20))
+    assert _nbd_reply(sock) == (4, 1, struct.pack('>Q', 1990) + bytes(8) + b'xxxx' + b'c' * 8)
+    sock.sendall(request.pack(0x25609513, 0, 1, 5, 3400, 200) + bytes(200))
+    assert _nbd_reply(sock)[1] == 2**15 + 1  # error beyond the end
+    sock.sendall(request.pack(0x25609513, 0, 2, 6, 0, 0))  # disconnect
+    sock.close()
+
+    server.shutdown()
+    server.close()
+    assert sorted(block_id for block_id, data in server.changes()[version_uid]) == [1, 2]
+    meta_backend.close()
+
+
+def test_nbd_server_shutdown(test_path):
+    from backy2.nbd import Connection
+    from concurrent.futures import ThreadPoolExecutor
+    import socket
+    import struct
+    server, version_uid, image = _nbd_server(test_path)
+    request = struct.Struct('>IHHQQI')
+    socks = [_nbd_connect(test_path, version_uid) for i in range(2)]
+    socks[0].sendall(request.pack(0x25609513, 0, 1, 1, 10, 4) + b'xxxx')
+    assert _nbd_reply(socks[0]) == (1, 0, b'')
+
+    # open connections are ended before shutdown returns
+    server.shutdown()
+    assert server._connections == {}
+    for sock in socks:
+        assert sock.recv(1) == b''
+        sock.close()
+    server.close()
+    assert [(block_id, data[:20]) for block_id, data in server.changes()[version_uid]] == [(0, b'a' * 10 + b'xxxx' + b'a' * 6)]
+
+    # requests which arrive after the workers have been shut down
+    sock, client = socket.socketpair()
+    handler = ThreadPoolExecutor(1).submit(Connection(server, sock).handle)
+    _nbd_handshake(client, version_uid)
+    client.sendall(request.pack(0x25609513, 0, 0, 1, 0, 10))
+    assert handler.result(timeout=10) is None  # doesn't raise
+    assert client.recv(1) == b''
+    client.close()
+    server.backy.meta_backend.close()
+
+
 def test_metabackend_set_version(test_path):
     backend = backy2.backy.SQLBackend('sqlite:///'+test_path+'/backy.sqlite')
     name = 'backup-mysystem1-20150110140015'
@@ -182,6 +1228,425 @@ def test_metabackend_blocks_by_version(test_path):
 
 
 
+def test_metabackend_du(meta_backend):
+    version_uids = []
+    for blob_uids in (['a', 'b', 'b', None], ['a', 'c', 'd', 'd'], ['c', 'e', None, None]):
+        version_uid = meta_backend.set_version('backup', 'snapname', len(blob_uids), 4096*len(blob_uids), 0)
+        for id, blob_uid in enumerate(blob_uids):
+            meta_backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, _commit=False)
+        meta_backend._commit()
+        meta_backend.set_version_valid(version_uid)
+        version_uids.append(version_uid)
+    meta_backend.rm_version(version_uids.pop(1))
+    for version_uid in version_uids:
+        assert meta_backend.du(version_uid) == meta_backend._du(version_uid)
+    assert meta_backend.du(version_uids[0])['dedup_own'] == 4096
+    assert meta_backend.du(version_uids[1])['space_freed'] == 2*4096
+
+
+def test_metabackend_du_unaccounted(meta_backend):
+    from backy2.meta_backends.sql import Blob, VersionSpace
+    version_uids = []
+    for blob_uids in (['a', 'b'], ['a', 'c'], ['b', 'b', None]):
+        version_uid = meta_backend.set_version('backup', 'snapname', len(blob_uids), 4096*len(blob_uids), 0)
+        for id, blob_uid in enumerate(blob_uids):
+            meta_backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, _commit=False)
+        meta_backend._commit()
+        version_uids.append(version_uid)
+    # sketches for du --approx don't account versions
+    assert len(meta_backend.get_version_sketches(version_uids)) == 3
+    assert meta_backend.session.query(VersionSpace).count() == 0
+    assert set(refcount for refcount, in meta_backend.session.query(Blob.refcount)) == {0}
+    # only the second version is accounted, the others have not been marked valid
+    meta_backend.set_version_valid(version_uids[1])
+    assert meta_backend.du(version_uids[0]) == meta_backend._du(version_uids[0])
+    assert meta_backend.du(version_uids[0])['space_freed'] == 0
+    for version_uid in version_uids:
+        assert meta_backend.du(version_uid) == meta_backend._du(version_uid)
+
+    # like after upgrading the database
+    meta_backend.session.query(VersionSpace).delete()
+    meta_backend.session.query(Blob).update({Blob.refcount: 0})
+    meta_backend.session.commit()
+    assert meta_backend.du(version_uids[2])['space_freed'] == 0
+    for version_uid in version_uids:
+        assert meta_backend.du(version_uid) == meta_backend._du(version_uid)
+
+
+def test_metabackend_get_versions_filtered(meta_backend):
+    import datetime
+    uid1 = meta_backend.set_version('vm1', 'snap1', 1, 4096, 1)
+    uid2 = meta_backend.set_version('vm1', 'snap2', 1, 4096, 0)
+    uid3 = meta_backend.set_version('vm2', 'snap1', 1, 4096, 1)
+    meta_backend.add_tag(uid1, 'daily')
+    meta_backend.add_tag(uid3, 'daily')
+    meta_backend.expire_version(uid2, datetime.datetime(2000, 1, 1))
+    uids = lambda versions: [v.uid for v in versions]
+    assert uids(meta_backend.get_versions()) == [uid1, uid2, uid3]
+    assert uids(meta_backend.get_versions(name='vm1')) == [uid1, uid2]
+    assert uids(meta_backend.get_versions(snapshot_name='snap1')) == [uid1, uid3]
+    assert uids(meta_backend.get_versions(tag='daily', name='vm2')) == [uid3]
+    assert uids(meta_backend.get_versions(expired=True)) == [uid2]
+    assert uids(meta_backend.get_versions(valid=False)) == [uid2]
+    assert [t.name for t in meta_backend.get_versions(valid=True)[0].tags] == ['daily']
+
+
+def test_metabackend_rm_versions(meta_backend):
+    from backy2.meta_backends.sql import DeletedBlock
+    version_uids = []
+    for blob_uids in (['a', 'b', 'b', None], ['a', 'c'], ['c', 'd']):
+        version_uid = meta_backend.set_version('backup', 'snapname', len(blob_uids), 4096*len(blob_uids), 1)
+        for id, blob_uid in enumerate(blob_uids):
+            meta_backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, _commit=False)
+        meta_backend._commit()
+        meta_backend.add_tag(version_uid, 'daily')
+        version_uids.append(version_uid)
+    assert meta_backend.rm_versions(version_uids[:2]) == 6
+    assert [v.uid for v in meta_backend.get_versions()] == version_uids[2:]
+    assert sorted(d.uid for d in meta_backend.session.query(DeletedBlock)) == ['a', 'b', 'c']
+    assert sorted(meta_backend.get_delete_candidates(dt=-1)) == ['a', 'b']
+
+
+def test_metabackend_copy_version(meta_backend):
+    version_uid = meta_backend.set_version('backup', 'snapname', 3, 3*4096, 1)
+    for id, blob_uid in enumerate(['a', None, 'b']):
+        meta_backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, enc_envkey=b'\x01\x02', enc_version=1, enc_nonce=b'\x03', _commit=False)
+    meta_backend._commit()
+    new_version_uid = meta_backend.copy_version(version_uid, 'pinned', 'snap')
+    assert meta_backend.get_version(new_version_uid).valid == 1
+    columns = lambda b: (b.id, b.uid, b.checksum, b.size, b.valid, b.enc_version, b.enc_envkey, b.enc_nonce)
+    assert [columns(b) for b in meta_backend.get_blocks_by_version(new_version_uid)] == \
+        [columns(b) for b in meta_backend.get_blocks_by_version(version_uid)]
+    assert meta_backend.du(version_uid)['dedup_others'] == 2*4096
+
+
+
+def test_metabackend_blobs_normalized(meta_backend):
+    from backy2.meta_backends.sql import Blob
+    checksum = uuid.uuid4().hex * 4
+    version_uids = []
+    for i in range(2):
+        version_uid = meta_backend.set_version('backup', 'snapname', 3, 3*4096, 1)
+        meta_backend.set_block(0, version_uid, 'a', checksum, 4096, 1, enc_envkey=b'\x01\x02', enc_version=1, _commit=False)
+        meta_backend.set_block(1, version_uid, None, None, 4096, 1, _commit=False)
+        meta_backend.set_block(2, version_uid, None, None, 4096, 1, _commit=False)
+        meta_backend._commit()
+        version_uids.append(version_uid)
+    meta_backend.set_blob('a', 1234, 'etag')
+    assert meta_backend.session.query(Blob).count() == 2
+    assert meta_backend.get_blobs(['a']) == {'a': (1234, 'etag')}
+    block = meta_backend.get_block_by_checksum(checksum, 1)
+    assert (block.uid, block.checksum, block.enc_envkey) == ('a', checksum, '0102')
+    assert sorted(meta_backend.set_blocks_invalid('a', checksum)) == sorted(version_uids)
+    assert [b.valid for b in meta_backend.get_blocks_by_version(version_uids[1])] == [0, 1, 1]
+
+
+
+def test_metabackend_blocks_by_version_deref(meta_backend):
+    version_uid = meta_backend.set_version('backup', 'snapname', 2500, 2500*4096, 0)
+    for id in range(2500):
+        blob_uid = uuid.uuid4().hex if id % 3 else None
+        meta_backend.set_block(id, version_uid, blob_uid, blob_uid, 4096, 1, enc_envkey=b'\x01\x02', enc_version=1, _commit=False)
+    meta_backend._commit()
+    blocks = list(meta_backend.get_blocks_by_version_deref(version_uid))
+    assert [b.id for b in blocks] == list(range(2500))
+    assert blocks == [b.deref() for b in meta_backend.get_blocks_by_version(version_uid)]
+    assert len(set(blocks) | set(blocks[:10])) == 2500
+    assert blocks[1].enc_envkey == '0102' and blocks[0].uid is None
+
+
+def test_metabackend_blocks_by_version_deref_commit(meta_backend):
+    # Commits close server side cursors, so an open stream is buffered
+    # before the commit instead of losing its remaining rows.
+    version_uid = meta_backend.set_version('backup', 'snapname', 2500, 2500*4096, 0)
+    for id in range(2500):
+        meta_backend.set_block(id, version_uid, 'uid{}'.format(id), '{:064x}'.format(id), 4096, 1, _commit=False)
+    meta_backend._commit()
+    blocks = []
+    for block in meta_backend.get_blocks_by_version_deref(version_uid):
+        blocks.append(block)
+        if block.id in (0, 1500):
+            assert meta_backend._streams
+            meta_backend.set_blob(block.uid, 4096, 'etag', _commit=True)
+            assert all(stream.result is None for stream in meta_backend._streams)
+    assert [b.id for b in blocks] == list(range(2500))
+    assert not meta_backend._streams
+    assert meta_backend.get_blobs(['uid0', 'uid1500']) == {'uid0': (4096, 'etag'), 'uid1500': (4096, 'etag')}
+
+
+def test_blockmap_pack():
+    from backy2 import blockmap
+    blob_ids = list(range(100, 200)) + [7] * 50 + [3, 1, 4, 1, 5] + list(range(300, 100, -2))
+    assert list(blockmap.unpack(blockmap.pack(blob_ids))) == blob_ids
+    assert list(blockmap.unpack(blockmap.pack([]))) == []
+    assert len(blockmap.pack(range(1000000))) < 100
+
+
+def test_metabackend_packed_block_map(meta_backend):
+    from backy2.meta_backends.sql import PackedBlockMap
+    meta_backend.pack_block_maps = True
+    blob_uids = ['a', 'b', None, 'c', None, 'a']
+    version_uid = meta_backend.set_version('backup', 'snapname', len(blob_uids), 4096*len(blob_uids), 0)
+    for id, blob_uid in enumerate(blob_uids):
+        meta_backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, _commit=False)
+    meta_backend._commit()
+    unpacked = list(meta_backend.get_blocks_by_version_deref(version_uid))
+    block_map = meta_backend.get_block_map(version_uid)
+    meta_backend.set_version_valid(version_uid)
+    assert meta_backend.session.query(PackedBlockMap).count() == 1
+    assert list(meta_backend.get_blocks_by_version_deref(version_uid)) == unpacked
+    assert meta_backend.get_block_map(version_uid) == block_map
+    assert block_map[0] == block_map[5] and block_map[2] == block_map[4]
+    assert meta_backend.get_block_ids_by_version(version_uid) == list(range(len(blob_uids)))
+    new_version_uid = meta_backend.copy_version(version_uid, 'copy')
+    assert meta_backend.get_block_map(new_version_uid) == block_map
+    meta_backend.rm_versions([version_uid, new_version_uid])
+    assert meta_backend.session.query(PackedBlockMap).count() == 0
+
+def test_file_metabackend(test_path):
+    from backy2.config import Config
+    from backy2.meta_backends.file import MetaBackend
+    config = Config(cfg='[MetaBackend]\npath: {}/meta\n'.format(test_path), section='MetaBackend')
+    backend = MetaBackend(config)
+    backend.initdb()
+    backend.open()
+    version_uids = []
+    for blob_uids in (['a', 'b', 'b', None], ['a', 'c']):
+        version_uid = backend.set_version('backup', 'snapname', len(blob_uids), 4096*len(blob_uids), 0)
+        for id, blob_uid in enumerate(blob_uids):
+            backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, enc_envkey=b'\x01\x02', enc_version=1, _commit=False)
+        backend._commit()
+        backend.set_version_valid(version_uid)
+        backend.add_tag(version_uid, 'daily')
+        version_uids.append(version_uid)
+    assert os.path.exists(os.path.join(test_path, 'meta', 'maps', version_uids[0] + '.packed'))
+    assert backend.get_block_by_checksum('c' * 64, 1).uid == 'c'
+    assert backend.du(version_uids[0])['dedup_own'] == 4096
+    blocks = list(backend.get_blocks_by_version_deref(version_uids[0]))
+    backend.close()
+
+    backend = MetaBackend(config).open()
+    assert [v.uid for v in backend.get_versions(tag='daily')] == version_uids
+    assert list(backend.get_blocks_by_version_deref(version_uids[0])) == blocks
+    assert blocks[0].enc_envkey == '0102' and blocks[3].uid is None
+    assert backend.get_num_blocks_by_version(version_uids[1]) == 2
+    assert backend.rm_versions(version_uids[:1]) == 4
+    assert sorted(backend.get_delete_candidates(dt=-1)) == ['b']
+    backend.del_delete_candidates(['b'])
+    assert backend.get_all_block_uids() == ['a', 'c']
+
+    # reading a version which is being written doesn't flush it
+    version_uid = backend.set_version('backup', 'snapname', 3, 3*4096, 0)
+    backend.set_block(0, version_uid, 'd', 'd' * 64, 4096, 1, _commit=False)
+    backend._commit()
+    backend.set_block(1, version_uid, 'e', 'e' * 64, 4096, 1, _commit=False)
+    map_size = os.path.getsize(os.path.join(test_path, 'meta', 'maps', version_uid))
+    assert backend.get_num_blocks_by_version(version_uid) == 2
+    assert [b.uid for b in backend.get_blocks_by_version_deref(version_uid)] == ['d', 'e']
+    assert os.path.getsize(os.path.join(test_path, 'meta', 'maps', version_uid)) == map_size
+    backend.set_block(2, version_uid, 'f', 'f' * 64, 4096, 1, _commit=False)
+    backend.set_version_valid(version_uid)
+    backend.close()
+    backend = MetaBackend(config).open()
+    assert [b.uid for b in backend.get_blocks_by_version_deref(version_uid)] == ['d', 'e', 'f']
+    backend.close()
+
+
+def test_file_metabackend_incomplete_record(test_path):
+    from backy2.config import Config
+    from backy2.meta_backends.file import MetaBackend
+    config = Config(cfg='[MetaBackend]\npath: {}/meta\n'.format(test_path), section='MetaBackend')
+    backend = MetaBackend(config)
+    backend.initdb()
+    backend.open()
+    version_uid = backend.set_version('backup', 'snapname', 1, 4096, 1)
+    backend.close()
+    with open(os.path.join(test_path, 'meta', 'meta.log'), 'a') as f:
+        f.write('["v", "')  # interrupted while writing
+    backend = MetaBackend(config).open()
+    assert [v.uid for v in backend.get_versions()] == [version_uid]
+    backend.set_version('backup', 'snapname', 1, 4096, 1)
+    backend.close()
+    assert len(MetaBackend(config).open().get_versions()) == 2
+
+
+def test_file_metabackend_lock(test_path):
+    from backy2.locking import LockError
+    from backy2.config import Config
+    from backy2.meta_backends.file import MetaBackend
+    config = Config(cfg='[MetaBackend]\npath: {}/meta\n'.format(test_path), section='MetaBackend')
+    writer = MetaBackend(config)
+    writer.initdb()
+    writer.open()
+    version_uid = writer.set_version('backup', 'snapname', 1, 4096, 1)
+    with pytest.raises(LockError):
+        MetaBackend(config).open()  # doesn't wait for the writer
+    writer.close()
+
+    # many readers, which don't keep the writer from changing it
+    readers = [MetaBackend(config).open() for i in range(2)]
+    assert [[v.uid for v in reader.get_versions()] for reader in readers] == [[version_uid]] * 2
+    readers[0].rm_version(version_uid)
+    readers[0]._commit()
+    with pytest.raises(LockError):
+        MetaBackend(config).open()  # doesn't wait for the writer
+    readers[1].LOCK_TIMEOUT = .2
+    with pytest.raises(LockError, match='being changed'):
+        readers[1].set_version('backup', 'snapname', 1, 4096, 1)
+    readers[0].close()
+    # readers which have loaded an older state can't change it until they refresh
+    with pytest.raises(LockError, match='has been changed'):
+        readers[1].set_version('backup', 'snapname', 1, 4096, 1)
+    assert [v.uid for v in readers[1].get_versions()] == [version_uid]
+    readers[1].refresh()
+    assert readers[1].get_versions() == []
+
+    # the first change waits for processes which are loading it
+    import fcntl
+    import threading
+    loading = open(os.path.join(test_path, 'meta', 'lock'))
+    fcntl.flock(loading, fcntl.LOCK_SH)
+    threading.Timer(.5, loading.close).start()
+    del readers[1].LOCK_TIMEOUT
+    readers[1].set_version('backup', 'snapname', 1, 4096, 1)
+    assert loading.closed
+    readers[1].close()
+
+    writer = MetaBackend(config).open()
+    assert len(writer.get_versions()) == 1
+    writer.set_version('backup', 'snapname', 1, 4096, 1)
+    writer.close()
+
+
+def test_memory_metabackend():
+    from backy2.config import Config
+    from backy2.meta_backends.memory import MetaBackend
+    import io
+    config = Config(cfg='[MetaBackend]\nname: test\n', section='MetaBackend')
+    backend = MetaBackend(config)
+    backend.initdb()
+    backend.open()
+    version_uid = backend.set_version('backup', 'snapname', 3, 4096*3, 0)
+    for id, blob_uid in enumerate(['a', None, 'a']):
+        backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, _commit=False)
+    backend.set_version_valid(version_uid)
+    assert backend.du(version_uid)['dedup_own'] == 4096
+    f = io.BytesIO()
+    backend.export(version_uid, f)
+    backend.close()
+
+    # same process, same name
+    backend = MetaBackend(config).open()
+    blocks = list(backend.get_blocks_by_version_deref(version_uid))
+    backend.rm_version(version_uid)
+    f.seek(0)
+    backend.import_(f)
+    assert list(backend.get_blocks_by_version_deref(version_uid)) == blocks
+    assert backend.get_num_blocks_by_version(version_uid) == 3
+    backend.close()
+
+    backend = MetaBackend(config)
+    backend.initdb()
+    assert backend.open().get_versions() == []
+
+
+def test_memory_metabackend_blob_versions():
+    # The reverse index of the block maps is kept up to date by the changes
+    from backy2.config import Config
+    from backy2.meta_backends.memory import MetaBackend
+    import datetime
+    backend = MetaBackend(Config(cfg='[MetaBackend]\nname: test_blob_versions\n', section='MetaBackend'))
+    backend.initdb()
+    backend.open()
+    version_uids = []
+    for blob_uids in (['a', 'b', 'a'], ['b', 'c']):
+        version_uid = backend.set_version('backup', 'snapname', len(blob_uids), 4096*len(blob_uids), 1)
+        for id, blob_uid in enumerate(blob_uids):
+            backend.set_block(id, version_uid, blob_uid, blob_uid * 64, 4096, 1, _commit=False)
+        version_uids.append(version_uid)
+    assert backend.get_block('c').version_uid == version_uids[1]
+    version_uids.append(backend.copy_version(version_uids[0], 'copy'))
+    backend.set_block(1, version_uids[2], 'd', 'd' * 64, 4096, 1)  # b is replaced
+    backend.rm_version(version_uids[1])
+    blob_versions = backend._blob_versions
+    backend._blob_versions = None
+    assert backend._get_blob_versions() == blob_versions
+    blob_id = lambda uid: backend._blob_ids[uid]
+    assert blob_versions == {
+        blob_id('a'): {version_uids[0]: 2, version_uids[2]: 2},
+        blob_id('b'): {version_uids[0]: 1},
+        blob_id('d'): {version_uids[2]: 1},
+        }
+    assert sorted(backend.set_blocks_invalid('a', 'a' * 64)) == sorted([version_uids[0], version_uids[2]])
+    assert backend.get_block('c') is None
+    candidates = list(backend.get_scrub_candidates(datetime.datetime.utcnow(), [version_uids[0]]))
+    assert [(block.uid, block.version_uid, block.id) for block in candidates] == [('a', version_uids[2], 0), ('d', version_uids[2], 1)]
+    assert backend.get_delete_candidates(dt=-1) == ['c']  # b is still referenced by the first version
+    backend.close()
+
+
+def test_metabackend_export_import(meta_backend):
+    import io
+    version_uid = meta_backend.set_version('backup', 'snapname', 3, 4096*3, 0)
+    for id, blob_uid in enumerate(['a', None, 'b']):
+        meta_backend.set_block(id, version_uid, blob_uid, blob_uid and blob_uid * 64, 4096, 1, enc_envkey=b'\x01\x02', enc_version=1, _commit=False)
+    meta_backend.set_version_valid(version_uid)
+    blocks = list(meta_backend.get_blocks_by_version_deref(version_uid))
+    f = io.BytesIO()
+    meta_backend.export(version_uid, f)
+    csv_f = io.StringIO()
+    meta_backend.export(version_uid, csv_f, as_csv=True)
+    assert csv_f.getvalue().startswith('backy2 Version 2.12 metadata dump')
+
+    with pytest.raises(KeyError):
+        meta_backend.import_(io.BytesIO(f.getvalue()))
+    meta_backend.rm_version(version_uid)
+    # truncated exports are not imported at all
+    with pytest.raises(ValueError):
+        meta_backend.import_(io.BytesIO(f.getvalue()[:-8]))
+    assert meta_backend.get_versions() == []
+
+    meta_backend.import_(io.BytesIO(f.getvalue()))
+    assert list(meta_backend.get_blocks_by_version_deref(version_uid)) == blocks
+    meta_backend.rm_version(version_uid)
+    meta_backend.import_(io.BytesIO(csv_f.getvalue().encode('utf-8')))
+    assert [b.checksum for b in meta_backend.get_blocks_by_version_deref(version_uid)] == [b.checksum for b in blocks]
+
+
+def test_import_csv_2_1():
+    from backy2 import dump
+    import io
+    version, blocks = dump.load(io.StringIO(
+        'backy2 Version 2.1 metadata dump\n'
+        'd91be794-2f21-11e7-b961-a44e314f9270,2017-05-02 10:26:48,test,25600,104857600,1\n'
+        '6ea578608ffuwQB2rhRMMevpJtVrNU7a,d91be794-2f21-11e7-b961-a44e314f9270,0,2017-05-02 12:26:51,04ca5d,4096,1\n'
+        ',d91be794-2f21-11e7-b961-a44e314f9270,1,2017-05-02 12:26:51,,4096,1\n'))
+    assert version['name'] == 'test' and version['snapshot_name'] == '' and version['expire'] is None
+    blocks = list(blocks)
+    assert [b.uid for b in blocks] == ['6ea578608ffuwQB2rhRMMevpJtVrNU7a', None]
+    assert blocks[0].enc_version == 0 and blocks[1].checksum is None
+
+
+def test_sketch_estimate_space():
+    from backy2.sketch import KMVSketch, estimate_space
+    sketches = {
+        'v1': KMVSketch.from_blobs([('a', 10), ('b', 20)]),
+        'v2': KMVSketch.from_blobs([('b', 20), ('c', 30)]),
+        'v3': KMVSketch.from_bytes(KMVSketch.from_blobs([('c', 30), ('d', 40)]).to_bytes()),
+        }
+    estimates = estimate_space(sketches, {'x': ['v1', 'v2'], 'y': ['v3']})
+    # small sets are exact
+    assert estimates['x'] == {'versions': 2, 'space': 60, 'shared': 30, 'space_freed': 30}
+    assert estimates['y'] == {'versions': 1, 'space': 70, 'shared': 30, 'space_freed': 40}
+
+    # large sets are estimated
+    blobs = [(uuid.uuid4().hex, 4096) for i in range(20000)]
+    sketches = {'v1': KMVSketch.from_blobs(blobs[:15000]), 'v2': KMVSketch.from_blobs(blobs[5000:])}
+    estimate = estimate_space(sketches, {'x': ['v1']})['x']
+    assert abs(estimate['space'] - 15000*4096) < 0.15 * 15000*4096
+    assert abs(estimate['space_freed'] - 5000*4096) < 0.15 * 15000*4096
+
+
 def _patch(filename, offset, data=None):
     """ write data into a file at offset """
     if not os.path.exists(filename):
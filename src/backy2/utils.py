@@ -9,7 +9,6 @@ import itertools
 import hashlib
 import importlib
 import json
-import random
 from datetime import timedelta, datetime
 
 
@@ -77,6 +76,28 @@ def parse_expire_date(date_string):
     return date
 
 
+def parse_size(size_string):
+    """ Parses a size like '4096', '4k', '10M', '2G' or '1T' (powers of 1024)
+    into bytes.
+    """
+    units = {'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+    size_string = size_string.strip()
+    if size_string[-1:].lower() in units:
+        return int(size_string[:-1]) * units[size_string[-1:].lower()]
+    return int(size_string)
+
+
+def parse_range(range_string):
+    """ Parses a byte range 'offset:length' (e.g. '1G:4M') into a tuple of
+    (offset, length).
+    """
+    try:
+        offset, length = range_string.split(':')
+        return (parse_size(offset), parse_size(length))
+    except ValueError:
+        raise ValueError('Invalid range: {}. Use offset:length, e.g. 1G:4M.'.format(range_string))
+
+
 def hints_from_rbd_diff(rbd_diff):
     """ Return the required offset:length tuples from a rbd json diff
     """
@@ -227,85 +248,44 @@ def status(msg, rq_len_pct, wq_len_pct, progress_pct, write_tp, eta_s, other="")
 
 
 class MinSequential():
-    OPTIMIZE_PROBABILITY = 0.001  # 1 means every put
+    """ Finds the highest entry up to which all entries (starting at
+    absolute_minimum) have been put or skipped, i.e. the watermark.
+    put and skip are O(1) amortized, get is O(1).
+    """
 
     def __init__(self, absolute_minimum=0):
-        self._entries = []
         self.lock = Lock()
         self.absolute_minimum = absolute_minimum
-        self._skip = list()
-        self._skip_sorted = False
+        self._next = absolute_minimum  # the smallest entry not yet seen
+        self._pending = set()  # entries seen above self._next
 
 
     def put(self, entry):
         with self.lock:
-            self._entries.append(entry)
-            if random.random() < self.OPTIMIZE_PROBABILITY:
-                self._optimize()
+            if entry < self._next:
+                return
+            self._pending.add(entry)
+            while self._next in self._pending:
+                self._pending.remove(self._next)
+                self._next += 1
 
 
     def skip(self, entry):
-        """ This entry is automatically in.
-        Do not append here after get() has been called (for optimization reasons)
-        """
-        self._skip_sorted = False
-        self._skip.append(entry)
-
-
-    def _optimize(self):
-        """
-        optimize self._entries
-        [0, 1, 2, 3, 5, 7] =>  [3, 5, 7]
-        """
-        if len(self._entries) < 2:
-            return
-
-        if not self._skip_sorted:
-            self._skip.sort()
-            self._skip_sorted = True
-
-        _biggest = max(self._entries)
-        _num_del = 0
-        for _skip in self._skip:
-            if _skip < _biggest:
-                self._entries.append(_skip)
-                _num_del += 1
-            else:
-                break
-        del(self._skip[:_num_del])
-
-        self._entries.sort()
-
-        new_entries = []
-        if self._entries[0] != self.absolute_minimum:
-            # we must start at this value.
-            return
-
-        for entry in self._entries[1:]:
-            if entry == self.absolute_minimum + 1:
-                self.absolute_minimum = entry
-            else:
-                new_entries.append(entry)
-        new_entries.insert(0, self.absolute_minimum)
-        self._entries = new_entries
+        """ This entry is automatically in. """
+        self.put(entry)
 
 
     def get(self):
         """
-        Returns the smallest integer in entries up to which numbers
-        are in sequence, i.e. where there's no gap.
+        Returns the highest entry up to which entries are in sequence,
+        i.e. where there's no gap, starting at absolute_minimum.
 
-        Example: In a list of [4, 5, 6, 8, 9] it would return 6.
-        In a list of [10, 13, 15] it would return 10.
-
-        Note: The list is ordered first.
+        Example: With absolute_minimum 4 and entries [4, 5, 6, 8, 9] it would
+        return 6. With absolute_minimum 10 and entries [11, 13, 15] it would
+        return None.
         """
-        if len(self._entries) == 0:
-            return None
-
         with self.lock:
-            self._optimize()
-            return self._entries[0] if self._entries[0] == self.absolute_minimum else None
+            return self._next - 1 if self._next > self.absolute_minimum else None
 
 
 #print(status("Restoring to null://", 23, 87, 23.5, 71541112, 3700))